@@ -4,27 +4,52 @@ Script to process files and either compute embeddings or insert them into the da
 import os
 import re
 import json
-import uuid
+import queue
+import hashlib
+import functools
 import pickle
+import threading
 
+from typing import Callable
 from difflib import SequenceMatcher
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import click
-import requests
-import pymupdf4llm
 
-from bs4 import BeautifulSoup
 from tqdm import tqdm
 from openai import OpenAI
 from unidecode import unidecode
 from qdrant_client import QdrantClient
+from tokenizers import Tokenizer
 
-from src import agent, utils
-from src.database import qdrant_db
+from src import agent, dedup, pdf_extraction, url_resolver, utils
+from src.database import embedding_store, qdrant_db
 from src.constants import METADATA_PATH, UNIVERSITY_DATA_DIR
 
 opj = os.path.join
 
+# How documents are chunked. Set in each parse worker by configure_chunking.
+CHUNKING = {'method': 'words', 'chunk_size': 256, 'overlap_size': 32, 'tokenizer': None}
+
+
+def configure_chunking(method: str, chunk_size: int, overlap_size: int, tokenizer_json: str | None = None) -> None:
+    """
+    Set how documents are chunked. Used as the initializer of the parse workers.
+
+    Args:
+        method (str): 'words' to split on whitespace, 'tokens' to split on the
+        embedding model's tokenizer.
+        chunk_size (int): The size of each chunk in words or tokens.
+        overlap_size (int): The overlap between chunks in words or tokens.
+        tokenizer_json (str | None): The serialized tokenizer, needed for 'tokens'.
+    Returns:
+        None
+    """
+    CHUNKING['method'] = method
+    CHUNKING['chunk_size'] = chunk_size
+    CHUNKING['overlap_size'] = overlap_size
+    CHUNKING['tokenizer'] = Tokenizer.from_str(tokenizer_json) if tokenizer_json is not None else None
+
 
 def get_doc_id_from_path(path: str) -> str:
     """
@@ -42,63 +67,6 @@ def get_doc_id_from_path(path: str) -> str:
     return doc_id
 
 
-def get_html_url(university_name: str, file_path: str) -> str | None:
-    """
-    Try and get the URL of the HTML file
-
-    Args:
-        file_path (str): The local path to the HTML file.
-    Returns:
-        str: The valid URL (with or without .html) or None.
-    """
-
-    # Extract base URL from the file path by removing the root directory and file extension
-    base_url = file_path.split(university_name)[1].replace('.html', '')
-
-    if base_url.startswith('/') or base_url.startswith('\\'):
-        base_url = base_url[1:]
-
-    base_url = 'https://' + base_url
-
-    base_url = base_url.replace('\\', '/')
-
-    # TODO - look if .cfm is in the URL, I had wget --adjust-extension so they all
-    # turned from index.cfm to index.cfm.html
-    variants = [
-        base_url.rstrip('/index') + '/',
-        base_url,
-        base_url + '.html',
-        base_url + '/index.html',
-        base_url + '/index.php',
-        base_url + '/index.php.html',
-        base_url.rstrip('/index'),
-        base_url + '.cfm'
-    ]
-
-    #print('university_name:', university_name)
-    #print('file_path:', file_path)
-    #print('base_url:', base_url, '\n')
-    #[print(x) for x in variants]
-
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36',
-        'Referer': base_url,
-        'Accept-Language': 'en-US,en;q=0.9',
-    }
-
-    for variant in variants:
-        try:
-            response = requests.get(variant, headers=headers)
-            if response.status_code == 200:
-                return variant
-        except Exception as e:#requests.exceptions.RequestException:
-            print('WARNING: Failed to get variant', variant)
-            print('Exception:', e)
-            continue
-
-    return None
-
-
 def select_files(root_directory: str, instructions: dict) -> dict:
     """
     Select the files to insert into the database
@@ -130,52 +98,23 @@ def select_files(root_directory: str, instructions: dict) -> dict:
     return selected_files
 
 
-def get_html_metadata(html_file: str) -> dict:
-    """
-    Get the metadata from an html file.
-
-    Args:
-        html_file (str): The path to the html file.
-    Returns:
-        dict: The metadata of the html file.
-    """
-    metadata = {}
-
-    with open(html_file, 'r', encoding='utf-8') as file:
-        soup = BeautifulSoup(file, 'html.parser')
-
-    metadata['title'] = soup.title.string.strip().replace('\xa0', ' ') if soup.title else ''
-
-    description = soup.find('meta', attrs={'name': 'description'})
-    metadata['description'] = description['content'].strip() if description else ''
-
-    keywords = soup.find('meta', attrs={'name': 'keywords'})
-    metadata['keywords'] = keywords['content'].strip() if keywords else ''
-
-    # Check for h1 to h6
-    metadata['headers'] = {}
-    for i in range(1, 7):
-        headers = [header.get_text().strip() for header in soup.find_all(f'h{i}')]
-        if headers:
-            metadata['headers'][f'h{i}'] = headers
-
-    metadata['language'] = soup.html.get('lang', '')
-
-    return metadata
-
-
-def extract_pdf_pages(pdf_file: str) -> list[str]:
+def extract_pdf_pages(pdf_file: str, file_hash: str | None = None) -> list[str]:
     """
-    Extract the text from each page of a pdf file as a list of strings.
+    Extract the markdown of each page of a pdf file as a list of strings. Pages
+    converted before, e.g. by pdf_extraction.extract_pdfs, come from the page cache.
 
     Args:
         pdf_file (str): The path to the pdf file.
-        text_type (str): The type of text to extract. Defaults to 'text'.
-        text, html, dict, json, xml, blocks, words, xhtml
+        file_hash (str | None): Hash of the file's contents. Computed if None.
     Returns:
         list[str]: A list of strings, one for each page of the pdf file.
     """
-    return pymupdf4llm.to_markdown(pdf_file, page_chunks=True)
+    file_hash = file_hash or utils.get_file_hash(pdf_file)
+    pages = pdf_extraction.load_pdf_pages(file_hash)
+    if pages is None:
+        pdf_extraction.extract_to_cache(pdf_file, file_hash)
+        pages = pdf_extraction.load_pdf_pages(file_hash)
+    return pages
 
 
 def get_files(directory: str, extension: str) -> list[str]:
@@ -208,366 +147,751 @@ def get_files(directory: str, extension: str) -> list[str]:
     return sorted(list(set(result_files)))
 
 
-def compute_html_embeddings(
-        university_name: str,
-        html_files: list[str],
-        embedding_model: qdrant_db.EmbeddingModel,
-        data_dir: str
-    ) -> None:
+def fingerprint_html_file(path: str) -> dict | None:
     """
-    Compute embeddings for html files and save to pickle file.
+    Fingerprint an html file for deduplication. Runs in a worker process.
 
     Args:
-        university_name (str): Name of the university.
-        html_files (list[str]): List of html files.
-        embedding_model (qdrant_db.EmbeddingModel): Embedding model to use.
-        data_dir (str): Directory to save pickle files.
+        path (str): Path to the html file.
+    Returns:
+        dict | None: The dedup.fingerprint_page result, or None if the file can't be parsed.
     """
-    batch_size = 100  # Save embeddings every 10 files
-    embeddings_file = os.path.join(data_dir, 'html_embeddings.pkl')
+    try:
+        return dedup.fingerprint_page(utils.extract_html(path)['text'])
+    except Exception as e:
+        print('WARNING: Could not fingerprint', path)
+        print('Exception:', e)
+        return None
 
-    # Load existing embeddings if file exists
-    if os.path.exists(embeddings_file):
-        with open(embeddings_file, 'rb') as f:
-            embeddings_dict = pickle.load(f)
-    else:
-        embeddings_dict = {}
 
-    files_processed = 0
+def simhash_html_file(path: str, boilerplate: frozenset) -> int | None:
+    """
+    Get the SimHash of an html file without the site's boilerplate lines. Runs in a worker process.
 
-    for path in tqdm(html_files):
+    Args:
+        path (str): Path to the html file.
+        boilerplate (frozenset): Hashes of the site's boilerplate lines.
+    Returns:
+        int | None: The dedup.page_simhash result, or None if the file can't be parsed.
+    """
+    try:
+        return dedup.page_simhash(utils.extract_html(path)['text'], boilerplate)
+    except Exception as e:
+        print('WARNING: Could not fingerprint', path)
+        print('Exception:', e)
+        return None
+
+
+def deduplicate_html_files(
+        files: list[str],
+        file_hashes: dict,
+        data_dir: str,
+        executor: ProcessPoolExecutor
+    ) -> tuple[list[str], frozenset]:
+    """
+    Drop near-duplicate html files and find the boilerplate lines shared across the site.
 
-        doc_id = get_doc_id_from_path(path)
-        parent_point_id = str(uuid.uuid4())
+    Line fingerprints are computed first to find the boilerplate, then files are
+    compared by the SimHash of their text without it. Both are cached by content
+    hash next to the embedding store, the SimHashes for as long as the boilerplate
+    doesn't change, so only new or changed files are parsed again. A report of
+    what was removed is written to html_dedup_report.json.
 
-        if doc_id in embeddings_dict:
-            continue
+    Args:
+        files (list[str]): Every current html file of the university.
+        file_hashes (dict): Content hash of each file.
+        data_dir (str): Directory holding the embedding store.
+        executor (ProcessPoolExecutor): Process pool for parsing.
+    Returns:
+        tuple[list[str], frozenset, dict]: The files to keep, the boilerplate line
+        hashes and the content hash of each file, see dedup.get_content_hash.
+    """
+    cache_path = opj(data_dir, 'html_fingerprints.json')
+    fingerprints = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            fingerprints = json.load(f)
+
+    missing = [x for x in files if file_hashes[x] not in fingerprints]
+    for path, fingerprint in zip(missing, executor.map(fingerprint_html_file, missing, chunksize=16)):
+        if fingerprint is not None:
+            fingerprints[file_hashes[path]] = fingerprint
+
+    # Only keep the fingerprints of current files
+    fingerprints = {file_hashes[x]: fingerprints[file_hashes[x]] for x in files if file_hashes[x] in fingerprints}
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump(fingerprints, f)
+    os.replace(cache_path + '.tmp', cache_path)
+
+    boilerplate = frozenset(dedup.find_boilerplate_lines(list(fingerprints.values())))
+    boilerplate_hash = hashlib.sha256(json.dumps(sorted(boilerplate)).encode('utf-8')).hexdigest()
+
+    # SimHashes depend on the boilerplate, so they're recomputed whenever it changes
+    simhash_path = opj(data_dir, 'html_simhashes.json')
+    simhashes = {}
+    if os.path.exists(simhash_path):
+        with open(simhash_path, 'r') as f:
+            simhash_cache = json.load(f)
+        if simhash_cache['boilerplate'] == boilerplate_hash:
+            simhashes = simhash_cache['simhashes']
+
+    missing = [x for x in files if file_hashes[x] in fingerprints and file_hashes[x] not in simhashes]
+    simhash_fn = functools.partial(simhash_html_file, boilerplate=boilerplate)
+    for path, value in zip(missing, executor.map(simhash_fn, missing, chunksize=16)):
+        if value is not None:
+            simhashes[file_hashes[path]] = value
+
+    simhashes = {file_hashes[x]: simhashes[file_hashes[x]] for x in files if file_hashes[x] in simhashes}
+    with open(simhash_path + '.tmp', 'w') as f:
+        json.dump({'boilerplate': boilerplate_hash, 'simhashes': simhashes}, f)
+    os.replace(simhash_path + '.tmp', simhash_path)
+
+    # Shorter paths are preferred as the copy to keep, since they're usually the
+    # canonical page. Files that couldn't be fingerprinted are kept as they are.
+    pages = [x for x in sorted(files, key=lambda x: (len(x), x)) if file_hashes[x] in simhashes]
+    kept, report = dedup.deduplicate_pages(
+        {x: fingerprints[file_hashes[x]] for x in pages},
+        {x: simhashes[file_hashes[x]] for x in pages},
+        boilerplate
+    )
+    kept = set(kept)
+    files = [x for x in files if x in kept or file_hashes[x] not in simhashes]
+
+    # Stripping boilerplate changes the embedded text without changing the file
+    content_hashes = {
+        x: dedup.get_content_hash(file_hashes[x], fingerprints[file_hashes[x]]['lines'], boilerplate)
+        if file_hashes[x] in fingerprints else file_hashes[x]
+        for x in files
+    }
 
-        print('PATH:', path)
-        text = utils.get_text_from_html(path)
+    print(
+        f"Dedup: dropped {report['duplicate_pages']} of {report['pages']} pages as near-duplicates, "
+        f"{report['boilerplate_lines']} boilerplate lines, "
+        f"{100 * report['removed_fraction']:.1f}% of the text removed."
+    )
+    with open(opj(data_dir, 'html_dedup_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
 
-        url = get_html_url(university_name, path)
+    return files, boilerplate, content_hashes
 
-        if url is None:
-            print(f"Warning: No corresponding web page found for {path}")
-            with open('missing_html_urls.txt', 'a', encoding='utf-8', errors='ignore') as f:
-                f.write(path + '\n')
 
-        # Compute embedding for the full text
-        parent_vector = embedding_model.embed(text)
-        parent_payload = {
+def prepare_html_document(
+        university_name: str,
+        path: str,
+        url: str | None,
+        boilerplate: frozenset = frozenset()) -> dict:
+    """
+    Parse and chunk an html file. Runs in a worker process.
+
+    Args:
+        university_name (str): Name of the university.
+        path (str): Path to the html file.
+        url (str | None): The web URL of the file, from url_resolver.resolve_urls.
+        boilerplate (frozenset): Hashes of the site's boilerplate lines, which are
+        removed before chunking.
+    Returns:
+        dict: The parent and chunk payloads for the document, without vectors.
+    """
+    doc_id = get_doc_id_from_path(path)
+    parent_point_id = qdrant_db.get_point_id(doc_id)
+
+    # Text and metadata come from a single pass over the file
+    page = utils.extract_html(path)
+    text = dedup.strip_boilerplate(page['text'], boilerplate)
+    content_hash = dedup.get_content_hash(utils.get_file_hash(path), dedup.get_line_hashes(page['text']), boilerplate)
+
+    parent_payload = {
+        'filepath': path,
+        'doc_id': doc_id,
+        'university': university_name,
+        'type': 'html',
+        'url': url,
+        'title': page['title'],
+        'description': page['description'],
+        'content': text,
+        'content_hash': content_hash,
+        'point_id': parent_point_id,
+        'parent_point_id': parent_point_id
+    }
+
+    # Process chunks
+    if CHUNKING['method'] == 'tokens':
+        text_chunks = utils.chunk_text_by_tokens(
+            text, CHUNKING['tokenizer'], CHUNKING['chunk_size'], CHUNKING['overlap_size']
+        )
+    else:
+        text_chunks = utils.chunk_text(text, CHUNKING['chunk_size'], CHUNKING['overlap_size'])
+
+    chunks = []
+    for chunk_id, chunk_text in enumerate(text_chunks):
+        chunk_point_id = qdrant_db.get_point_id(doc_id, chunk_id)
+        chunk_payload = {
             'filepath': path,
             'doc_id': doc_id,
             'university': university_name,
             'type': 'html',
             'url': url,
-            'content': text,
-            'point_id': parent_point_id,
-            'parent_point_id': parent_point_id
-        }
-
-        # Process chunks
-        text_chunks = utils.chunk_text(text, chunk_size=256, overlap_size=32)
-
-        chunk_embeddings = []
-        for chunk_id, chunk_text in enumerate(text_chunks):
-            chunk_point_id = str(uuid.uuid4())
-            chunk_vector = embedding_model.embed(chunk_text)
-            chunk_payload = {
-                'filepath': path,
-                'doc_id': doc_id,
-                'university': university_name,
-                'type': 'html',
-                'url': url,
-                'point_id': chunk_point_id,
-                'parent_point_id': parent_point_id,
-                'chunk_id': chunk_id,
-                'content': chunk_text
-            }
-            chunk_embeddings.append({'vector': chunk_vector, 'payload': chunk_payload})
-
-        # Store embeddings in embeddings_dict
-        embeddings_dict[doc_id] = {
-            'parent': {'vector': parent_vector, 'payload': parent_payload},
-            'chunks': chunk_embeddings
+            'content_hash': content_hash,
+            'point_id': chunk_point_id,
+            'parent_point_id': parent_point_id,
+            'chunk_id': chunk_id,
+            'content': chunk_text
         }
+        chunks.append({'payload': chunk_payload})
 
-        files_processed += 1
-
-        # Save embeddings_dict every batch_size files
-        if files_processed % batch_size == 0:
-            with open(embeddings_file, 'wb') as f:
-                pickle.dump(embeddings_dict, f)
-            print(f"Saved embeddings for {files_processed} files.")
-
-    # Save any remaining embeddings
-    with open(embeddings_file, 'wb') as f:
-        pickle.dump(embeddings_dict, f)
-    print(f"Saved embeddings for total of {len(embeddings_dict)} files.")
+    return {
+        'doc_id': doc_id,
+        'content_hash': content_hash,
+        'parent': {'payload': parent_payload},
+        'chunks': chunks
+    }
 
 
-def compute_pdf_embeddings(university_name: str, pdf_files: list[str], embedding_model: qdrant_db.EmbeddingModel, data_dir: str) -> None:
+def prepare_pdf_document(university_name: str, path: str) -> dict:
     """
-    Compute embeddings for pdf files and save to pickle file.
+    Extract and chunk a pdf file. Runs in a worker process.
 
     Args:
         university_name (str): Name of the university.
-        pdf_files (list[str]): List of pdf files.
-        embedding_model (qdrant_db.EmbeddingModel): Embedding model to use.
-        data_dir (str): Directory to save pickle files.
+        path (str): Path to the pdf file.
+    Returns:
+        dict: The parent and chunk payloads for the document, without vectors.
     """
-    batch_size = 50  # Save embeddings every 10 files
-    embeddings_file = os.path.join(data_dir, 'pdf_embeddings.pkl')
+    doc_id = get_doc_id_from_path(path)
+    parent_point_id = qdrant_db.get_point_id(doc_id)
+    file_hash = utils.get_file_hash(path)
+
+    text_pages = extract_pdf_pages(path, file_hash)
+    content_hash = pdf_extraction.get_content_hash(file_hash)
+
+    full_text = "\n".join(text_pages)
+
+    url = 'https:/' + path.split(UNIVERSITY_DATA_DIR)[1]
+
+    parent_payload = {
+        'filepath': path,
+        'doc_id': doc_id,
+        'university': university_name,
+        'type': 'pdf',
+        'url': url,
+        'content': full_text,
+        'content_hash': content_hash,
+        'point_id': parent_point_id,
+        'parent_point_id': parent_point_id
+    }
 
-    # Load existing embeddings if file exists
-    if os.path.exists(embeddings_file):
-        with open(embeddings_file, 'rb') as f:
-            embeddings_dict = pickle.load(f)
+    # Process chunks
+    if CHUNKING['method'] == 'tokens':
+        page_chunks = utils.chunk_pages_by_tokens(
+            text_pages,
+            CHUNKING['tokenizer'],
+            CHUNKING['chunk_size'],
+            CHUNKING['overlap_size']
+        )
     else:
-        embeddings_dict = {}
-
-    files_processed = 0
-
-    for path in tqdm(pdf_files):
-
-        doc_id = get_doc_id_from_path(path)
-
-        if doc_id in embeddings_dict:
-            continue
-
-        parent_point_id = str(uuid.uuid4())
-
-        try:
-            text_pages = extract_pdf_pages(path)
-        except Exception as e:
-            print('WARNING: Could not extract text from', path)
-            print(e)
-            continue
-
-        full_text = "\n".join([page['text'] for page in text_pages])
-
-        url = 'https:/' + path.split(UNIVERSITY_DATA_DIR)[1]
+        page_chunks = utils.chunk_pages(
+            text_pages, CHUNKING['chunk_size'], CHUNKING['overlap_size']
+        )
 
-        # Compute embedding for the full text
-        parent_vector = embedding_model.embed(full_text)
-        parent_payload = {
+    chunks = []
+    for chunk_id, chunk in enumerate(page_chunks):
+        chunk_point_id = qdrant_db.get_point_id(doc_id, chunk_id)
+        chunk_payload = {
             'filepath': path,
             'doc_id': doc_id,
             'university': university_name,
             'type': 'pdf',
             'url': url,
-            'content': full_text,
-            'point_id': parent_point_id,
-            'parent_point_id': parent_point_id
+            'content_hash': content_hash,
+            'point_id': chunk_point_id,
+            'parent_point_id': parent_point_id,
+            'chunk_id': chunk_id,
+            'content': chunk['text'],
+            'start_page': chunk['metadata']['start_page'],
+            'end_page': chunk['metadata']['end_page']
         }
+        chunks.append({'payload': chunk_payload})
 
-        # Process chunks
-        page_chunks = utils.chunk_pages(
-            [page['text'] for page in text_pages], chunk_size=256, overlap_size=32
-        )
+    return {
+        'doc_id': doc_id,
+        'content_hash': content_hash,
+        'parent': {'payload': parent_payload},
+        'chunks': chunks
+    }
 
-        chunk_embeddings = []
-        for chunk_id, chunk in enumerate(page_chunks):
-            chunk_point_id = str(uuid.uuid4())
-            chunk_vector = embedding_model.embed(chunk['text'])
-            chunk_payload = {
-                'filepath': path,
-                'doc_id': doc_id,
-                'university': university_name,
-                'type': 'pdf',
-                'url': url,
-                'point_id': chunk_point_id,
-                'parent_point_id': parent_point_id,
-                'chunk_id': chunk_id,
-                'content': chunk['text'],
-                'start_page': chunk['metadata']['start_page'],
-                'end_page': chunk['metadata']['end_page']
-            }
-            chunk_embeddings.append({'vector': chunk_vector, 'payload': chunk_payload})
-
-        # Store embeddings in embeddings_dict
-        embeddings_dict[doc_id] = {
-            'parent': {'vector': parent_vector, 'payload': parent_payload},
-            'chunks': chunk_embeddings
-        }
 
-        files_processed += 1
+def embed_documents(documents: list[dict], embedding_model: qdrant_db.EmbeddingModel) -> None:
+    """
+    Embed the parent and chunk content of several documents in one batch.
+    Vectors are added to the documents in place.
+
+    Args:
+        documents (list[dict]): Documents returned by prepare_html_document or prepare_pdf_document.
+        embedding_model (qdrant_db.EmbeddingModel): Embedding model to use.
+    """
+    entries = []
+    for document in documents:
+        entries.append(document['parent'])
+        entries.extend(document['chunks'])
 
-        # Save embeddings_dict every batch_size files
-        if files_processed % batch_size == 0:
-            with open(embeddings_file, 'wb') as f:
-                pickle.dump(embeddings_dict, f)
-            print(f"Saved embeddings for {files_processed} files.")
+    vectors = embedding_model.embed_batch([entry['payload']['content'] for entry in entries])
 
-    # Save any remaining embeddings
-    with open(embeddings_file, 'wb') as f:
-        pickle.dump(embeddings_dict, f)
-    print(f"Saved embeddings for total of {len(embeddings_dict)} files.")
+    for entry, vector in zip(entries, vectors):
+        entry['vector'] = vector
+
+
+def run_pipeline(
+        executor: ProcessPoolExecutor,
+        prepare_fn: Callable,
+        university_name: str,
+        paths: list[str],
+        embedding_model: qdrant_db.EmbeddingModel,
+        write_fn: Callable,
+        embed_workers: int = 1,
+        embed_batch_size: int = 256,
+        queue_size: int = 64,
+        urls: dict | None = None
+    ) -> list[str]:
+    """
+    Run the parse -> embed -> write pipeline over a list of files.
 
+    Files are parsed and chunked by `prepare_fn` in the process pool. Parsed
+    documents go through a bounded queue to the embedding threads, which
+    batch chunks across documents, and then to a single writer thread that
+    calls `write_fn` for each embedded document.
 
-def insert_html_embeddings(db: qdrant_db.QdrantDB, embeddings_file: str) -> None:
+    Args:
+        executor (ProcessPoolExecutor): Process pool for parsing and chunking.
+        prepare_fn (Callable): prepare_html_document or prepare_pdf_document.
+        university_name (str): Name of the university.
+        paths (list[str]): Files to process.
+        embedding_model (qdrant_db.EmbeddingModel): Embedding model to use.
+        write_fn (Callable): Called with each embedded document.
+        embed_workers (int): Number of embedding threads.
+        embed_batch_size (int): Target number of texts per embedding batch.
+        queue_size (int): Maximum number of documents in flight or waiting between stages.
+        urls (dict | None): URL of each file, passed on to `prepare_fn` when given.
+    Returns:
+        list[str]: Files that couldn't be parsed, embedded or written.
     """
-    Load embeddings from pickle file and insert into database.
+    parsed_queue = queue.Queue(maxsize=queue_size)
+    embedded_queue = queue.Queue(maxsize=queue_size)
+
+    # Every file is counted once, whether it's written or fails at any stage
+    progress = tqdm(total=len(paths))
+    failed = []
+
+    def fail(path):
+        failed.append(path)
+        progress.set_postfix(failed=len(failed))
+        progress.update(1)
+
+    def embed_worker():
+        done = False
+        while not done:
+            documents = [parsed_queue.get()]
+            if documents[0] is None:
+                break
+
+            # Fill the batch with whatever else is ready without waiting
+            num_texts = 1 + len(documents[0]['chunks'])
+            while num_texts < embed_batch_size:
+                try:
+                    document = parsed_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if document is None:
+                    done = True
+                    break
+                documents.append(document)
+                num_texts += 1 + len(document['chunks'])
+
+            try:
+                embed_documents(documents, embedding_model)
+            except Exception as e:
+                print('WARNING: Could not embed', [x['doc_id'] for x in documents])
+                print(e)
+                for document in documents:
+                    fail(document['parent']['payload']['filepath'])
+                continue
+
+            for document in documents:
+                embedded_queue.put(document)
+
+        embedded_queue.put(None)
+
+    def write_worker():
+        finished = 0
+        while finished < embed_workers:
+            document = embedded_queue.get()
+            if document is None:
+                finished += 1
+                continue
+            try:
+                write_fn(document)
+            except Exception as e:
+                print('WARNING: Could not write', document['doc_id'])
+                print(e)
+                fail(document['parent']['payload']['filepath'])
+                continue
+            progress.update(1)
+
+    threads = [threading.Thread(target=embed_worker) for _ in range(embed_workers)]
+    threads.append(threading.Thread(target=write_worker))
+    for thread in threads:
+        thread.start()
+
+    # Keep a bounded number of files in flight so parsed documents can't pile
+    # up in memory faster than they are embedded
+    paths = iter(paths)
+    in_flight = {}
+    while True:
+        for path in paths:
+            args = (university_name, path) if urls is None else (university_name, path, urls[path])
+            in_flight[executor.submit(prepare_fn, *args)] = path
+            if len(in_flight) >= queue_size:
+                break
+
+        if not in_flight:
+            break
+
+        completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in completed:
+            path = in_flight.pop(future)
+            try:
+                document = future.result()
+            except Exception as e:
+                print('WARNING: Could not extract text from', path)
+                print(e)
+                fail(path)
+                continue
+            parsed_queue.put(document)
+
+    for _ in range(embed_workers):
+        parsed_queue.put(None)
+    for thread in threads:
+        thread.join()
+    progress.close()
+
+    return failed
+
+
+def convert_legacy_embeddings(store: embedding_store.EmbeddingStore, data_dir: str, file_type: str) -> None:
+    """
+    Carry over embeddings from the old pickle format into an empty store, so they
+    aren't recomputed and insert mode finds them.
 
     Args:
-        db (qdrant_db.QdrantDB): Database to insert into.
-        embeddings_file (str): Path to embeddings pickle file.
+        store (embedding_store.EmbeddingStore): The store of the file type.
+        data_dir (str): Directory holding the embedding store.
+        file_type (str): 'html' or 'pdf'.
     """
-    with open(embeddings_file, 'rb') as f:
+    pickle_file = os.path.join(data_dir, f'{file_type}_embeddings.pkl')
+    if len(store) > 0 or not os.path.exists(pickle_file):
+        return
+
+    print('Converting', pickle_file, 'to', store.path)
+    with open(pickle_file, 'rb') as f:
         embeddings_dict = pickle.load(f)
+    for doc_id, data in embeddings_dict.items():
+        store.add_document({'doc_id': doc_id, **data})
+    store.flush()
 
-    batch_size = 4
-    ids = []
-    vectors = []
-    payloads = []
 
-    for path, data in tqdm(embeddings_dict.items()):
+def compute_file_embeddings(
+        university_name: str,
+        files: list[str],
+        file_type: str,
+        embedding_model: qdrant_db.EmbeddingModel,
+        data_dir: str,
+        executor: ProcessPoolExecutor,
+        embed_workers: int = 1,
+        embed_batch_size: int = 256,
+        resolve_urls: Callable | None = None,
+        deduplicate: bool = False,
+        extract_files: Callable | None = None,
+        get_content_hashes: Callable | None = None
+    ) -> None:
+    """
+    Compute embeddings for new or changed html or pdf files and append them to the
+    embedding store. Stored documents whose files are gone are removed from it.
 
-        parent_data = data['parent']
-        parent_point_id = parent_data['payload']['point_id']
-        doc_id = parent_data['payload']['doc_id']
+    Args:
+        university_name (str): Name of the university.
+        files (list[str]): Every current html or pdf file of the university.
+        file_type (str): 'html' or 'pdf'.
+        embedding_model (qdrant_db.EmbeddingModel): Embedding model to use.
+        data_dir (str): Directory holding the embedding store.
+        executor (ProcessPoolExecutor): Process pool for parsing and chunking.
+        embed_workers (int): Number of embedding threads.
+        embed_batch_size (int): Target number of texts per embedding batch.
+        resolve_urls (Callable | None): Maps a list of files to their URLs before
+        they are parsed. Needed for html files.
+        deduplicate (bool): Drop near-duplicate files and strip boilerplate lines.
+        Only supported for html files.
+        extract_files (Callable | None): Converts a list of files ahead of parsing,
+        given the files and their hashes, and returns the ones that failed.
+        get_content_hashes (Callable | None): Maps the converted files, given their
+        hashes, to the hash of the text they are embedded with. Defaults to the file hashes.
+    """
+    prepare_fn = prepare_html_document if file_type == 'html' else prepare_pdf_document
+    flush_size = 100 if file_type == 'html' else 50  # Write a shard every flush_size files
+
+    store = embedding_store.get_embedding_store(data_dir, file_type, flush_size)
+    convert_legacy_embeddings(store, data_dir, file_type)
+
+    # Hash the files in the process pool and only re-embed the ones whose
+    # content changed since an earlier run
+    file_hashes = dict(zip(files, executor.map(utils.get_file_hash, files, chunksize=64)))
+
+    # Near-duplicates are left out like removed files, so stored copies are dropped too
+    content_hashes = file_hashes
+    if deduplicate:
+        files, boilerplate, content_hashes = deduplicate_html_files(files, file_hashes, data_dir, executor)
+        prepare_fn = functools.partial(prepare_html_document, boilerplate=boilerplate)
+
+    current_doc_ids = {get_doc_id_from_path(x) for x in files}
+
+    vanished = store.doc_ids - current_doc_ids
+
+    # Convert files in isolated processes so one that hangs or crashes the parser
+    # is skipped instead of stopping the run. Every file is passed since converted
+    # ones are cached, and conversion can change the text of an unchanged file
+    if extract_files is not None:
+        failed = set(extract_files(files, file_hashes))
+        files = [x for x in files if x not in failed]
+    if get_content_hashes is not None:
+        content_hashes = get_content_hashes(files, file_hashes)
+
+    files = [x for x in files if store.content_hashes.get(get_doc_id_from_path(x), '') != content_hashes[x]]
+    print(f'{len(files)} new or changed files, {len(vanished)} removed files.')
+
+    # Resolve every URL up front so parsing never waits on the network
+    urls = None
+    if resolve_urls is not None:
+        urls = resolve_urls(files)
+        missing = [x for x in files if urls[x] is None]
+        if missing:
+            print(f"Warning: No corresponding web page found for {len(missing)} files")
+            with open('missing_html_urls.txt', 'a', encoding='utf-8', errors='ignore') as f:
+                f.writelines(x + '\n' for x in missing)
+
+    with store:
+        for doc_id in sorted(vanished):
+            store.remove_document(doc_id)
+
+        failed = run_pipeline(
+            executor,
+            prepare_fn,
+            university_name,
+            files,
+            embedding_model,
+            store.add_document,
+            embed_workers=embed_workers,
+            embed_batch_size=embed_batch_size,
+            urls=urls
+        )
 
-        # Check if document already exists in database
-        if db.point_exists(doc_id):
-            print(f'Document {doc_id} already exists.')
-            continue
+    print(f"Saved embeddings for total of {len(store)} files.")
 
-        ids.append(parent_point_id)
-        vectors.append(parent_data['vector'])
-        payloads.append(parent_data['payload'])
-
-        # Insert parent document embeddings in batches
-        if len(ids) >= batch_size:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=ids,
-                payloads=payloads,
-                vectors=vectors
-            )
-            ids = []
-            vectors = []
-            payloads = []
-
-        # Insert chunks
-        chunk_ids = []
-        chunk_vectors = []
-        chunk_payloads = []
-
-        for chunk_data in data['chunks']:
-            chunk_ids.append(chunk_data['payload']['point_id'])
-            chunk_vectors.append(chunk_data['vector'])
-            chunk_payloads.append(chunk_data['payload'])
-
-            if len(chunk_ids) >= batch_size:
-                db.add_batch(
-                    collection_name='suny',
-                    point_ids=chunk_ids,
-                    payloads=chunk_payloads,
-                    vectors=chunk_vectors
-                )
-                chunk_ids = []
-                chunk_vectors = []
-                chunk_payloads = []
-
-        # Insert any remaining chunks
-        if chunk_ids:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=chunk_ids,
-                payloads=chunk_payloads,
-                vectors=chunk_vectors
-            )
+    # Failed files aren't in the store, so the next run retries them
+    if failed:
+        failed_path = f'failed_{file_type}_files.txt'
+        print(f"Warning: Could not embed {len(failed)} of {len(files)} files, listed in {failed_path}")
+        with open(failed_path, 'a', encoding='utf-8', errors='ignore') as f:
+            f.writelines(x + '\n' for x in failed)
 
-    # Insert any remaining parent documents
-    if ids:
-        db.add_batch(
-            collection_name='suny',
-            point_ids=ids,
-            payloads=payloads,
-            vectors=vectors
-        )
 
+def compute_html_embeddings(
+        university_name: str,
+        html_files: list[str],
+        embedding_model: qdrant_db.EmbeddingModel,
+        data_dir: str,
+        executor: ProcessPoolExecutor,
+        embed_workers: int = 1,
+        embed_batch_size: int = 256,
+        resolve_urls: Callable | None = None,
+        deduplicate: bool = True
+    ) -> None:
+    """
+    Compute embeddings for html files and append them to the embedding store.
+
+    Args:
+        university_name (str): Name of the university.
+        html_files (list[str]): List of html files.
+        embedding_model (qdrant_db.EmbeddingModel): Embedding model to use.
+        data_dir (str): Directory holding the embedding store.
+        executor (ProcessPoolExecutor): Process pool for parsing and chunking.
+        embed_workers (int): Number of embedding threads.
+        embed_batch_size (int): Target number of texts per embedding batch.
+        resolve_urls (Callable | None): Maps a list of files to their URLs. Defaults
+        to url_resolver.resolve_urls without a cache.
+        deduplicate (bool): Drop near-duplicate files and strip boilerplate lines.
+    """
+    if resolve_urls is None:
+        resolve_urls = functools.partial(url_resolver.resolve_urls, university_name)
+
+    compute_file_embeddings(
+        university_name,
+        html_files,
+        'html',
+        embedding_model,
+        data_dir,
+        executor,
+        embed_workers=embed_workers,
+        embed_batch_size=embed_batch_size,
+        resolve_urls=resolve_urls,
+        deduplicate=deduplicate
+    )
+
+
+def compute_pdf_embeddings(
+        university_name: str,
+        pdf_files: list[str],
+        embedding_model: qdrant_db.EmbeddingModel,
+        data_dir: str,
+        executor: ProcessPoolExecutor,
+        embed_workers: int = 1,
+        embed_batch_size: int = 256,
+        extract_files: Callable | None = None
+    ) -> None:
+    """
+    Compute embeddings for pdf files and append them to the embedding store.
 
-def insert_pdf_embeddings(db: qdrant_db.QdrantDB, embeddings_file: str) -> None:
+    Args:
+        university_name (str): Name of the university.
+        pdf_files (list[str]): List of pdf files.
+        embedding_model (qdrant_db.EmbeddingModel): Embedding model to use.
+        data_dir (str): Directory holding the embedding store.
+        executor (ProcessPoolExecutor): Process pool for parsing and chunking.
+        embed_workers (int): Number of embedding threads.
+        embed_batch_size (int): Target number of texts per embedding batch.
+        extract_files (Callable | None): Converts a list of files ahead of parsing.
+        Defaults to pdf_extraction.extract_pdfs.
+    """
+    if extract_files is None:
+        extract_files = pdf_extraction.extract_pdfs
+
+    compute_file_embeddings(
+        university_name,
+        pdf_files,
+        'pdf',
+        embedding_model,
+        data_dir,
+        executor,
+        embed_workers=embed_workers,
+        embed_batch_size=embed_batch_size,
+        extract_files=extract_files,
+        get_content_hashes=pdf_extraction.get_content_hashes
+    )
+
+
+def delete_stale_documents(
+        db: qdrant_db.QdrantDB,
+        university_name: str,
+        current_hashes: dict,
+        prune_scopes: list[tuple[str, str]] | None = None) -> set[str]:
     """
-    Load embeddings from pickle file and insert into database.
+    Delete the documents of a university whose content changed so they are inserted
+    again. Points of unchanged documents are left in place.
 
     Args:
-        db (qdrant_db.QdrantDB): Database to insert into.
-        embeddings_file (str): Path to embeddings pickle file.
+        db (qdrant_db.QdrantDB): Database to delete from.
+        university_name (str): Name of the university.
+        current_hashes (dict): Mapping of doc_id to the content hash of each current
+        document. Documents that couldn't be read map to None and are left as they are.
+        prune_scopes (list[tuple[str, str]] | None): (doc_id prefix, file extension)
+        pairs that were scanned. Documents in them without a current file are deleted
+        too. Nothing is pruned if None.
+    Returns:
+        set[str]: doc_ids in the database that are up to date.
     """
-    with open(embeddings_file, 'rb') as f:
-        embeddings_dict = pickle.load(f)
+    # Load the documents already in the database once instead of checking each one
+    existing_doc_hashes = db.get_existing_doc_hashes(university_name)
+
+    changed = {x for x, h in existing_doc_hashes.items() if current_hashes.get(x) not in (None, h)}
+    vanished = set()
+    if prune_scopes is not None:
+        vanished = {
+            x for x in existing_doc_hashes.keys() - current_hashes.keys()
+            if any(x.startswith(prefix) and x.endswith(extension) for prefix, extension in prune_scopes)
+        }
 
-    batch_size = 8
-    ids = []
-    vectors = []
-    payloads = []
+    if changed or vanished:
+        print(f'Deleting {len(changed)} changed and {len(vanished)} removed documents.')
+        db.delete_documents(sorted(changed | vanished))
+    return existing_doc_hashes.keys() - changed - vanished
+
+
+def iter_store_points(store: embedding_store.EmbeddingStore, existing_doc_ids: set[str]):
+    """
+    Yield (point_id, vector, payload) for every parent and chunk in the store
+    whose document isn't already in the database.
+
+    Args:
+        store (embedding_store.EmbeddingStore): Store holding the computed embeddings.
+        existing_doc_ids (set[str]): doc_ids already in the database. Yielded doc_ids are added to it.
+    """
+    for data in tqdm(store.iter_documents(), total=len(store)):
 
-    for path, data in tqdm(embeddings_dict.items()):
-        parent_data = data['parent']
-        parent_point_id = parent_data['payload']['point_id']
-        doc_id = parent_data['payload']['doc_id']
+        doc_id = data['doc_id']
 
         # Check if document already exists in database
-        if db.point_exists(doc_id):
+        if doc_id in existing_doc_ids:
             print(f'Document {doc_id} already exists.')
             continue
+        existing_doc_ids.add(doc_id)
 
-        ids.append(parent_point_id)
-        vectors.append(parent_data['vector'])
-        payloads.append(parent_data['payload'])
-
-        # Insert parent document embeddings in batches
-        if len(ids) >= batch_size:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=ids,
-                payloads=payloads,
-                vectors=vectors
-            )
-            ids = []
-            vectors = []
-            payloads = []
-
-        # Insert chunks
-        chunk_ids = []
-        chunk_vectors = []
-        chunk_payloads = []
-
-        for chunk_data in data['chunks']:
-            chunk_ids.append(chunk_data['payload']['point_id'])
-            chunk_vectors.append(chunk_data['vector'])
-            chunk_payloads.append(chunk_data['payload'])
-
-            if len(chunk_ids) >= batch_size:
-                db.add_batch(
-                    collection_name='suny',
-                    point_ids=chunk_ids,
-                    payloads=chunk_payloads,
-                    vectors=chunk_vectors
-                )
-                chunk_ids = []
-                chunk_vectors = []
-                chunk_payloads = []
-
-        # Insert any remaining chunks
-        if chunk_ids:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=chunk_ids,
-                payloads=chunk_payloads,
-                vectors=chunk_vectors
-            )
+        for point in [data['parent']] + data['chunks']:
+            yield point['payload']['point_id'], point['vector'], point['payload']
 
-    # Insert any remaining parent documents
-    if ids:
-        db.add_batch(
-            collection_name='suny',
-            point_ids=ids,
-            payloads=payloads,
-            vectors=vectors
-        )
+
+def insert_html_embeddings(
+        db: qdrant_db.QdrantDB,
+        store: embedding_store.EmbeddingStore,
+        existing_doc_ids: set[str],
+        batch_size: int = 256,
+        max_in_flight: int = 4) -> None:
+    """
+    Stream embeddings from the embedding store and insert into database.
+
+    Args:
+        db (qdrant_db.QdrantDB): Database to insert into.
+        store (embedding_store.EmbeddingStore): Store holding the computed embeddings.
+        existing_doc_ids (set[str]): doc_ids already in the database. Inserted doc_ids are added to it.
+        batch_size (int): The number of points per upsert request.
+        max_in_flight (int): The maximum number of upsert requests running at once.
+    """
+    num_points = db.upload_points(
+        iter_store_points(store, existing_doc_ids),
+        batch_size=batch_size,
+        max_in_flight=max_in_flight
+    )
+    print(f'Inserted {num_points} html points.')
+
+
+def insert_pdf_embeddings(
+        db: qdrant_db.QdrantDB,
+        store: embedding_store.EmbeddingStore,
+        existing_doc_ids: set[str],
+        batch_size: int = 256,
+        max_in_flight: int = 4) -> None:
+    """
+    Stream embeddings from the embedding store and insert into database.
+
+    Args:
+        db (qdrant_db.QdrantDB): Database to insert into.
+        store (embedding_store.EmbeddingStore): Store holding the computed embeddings.
+        existing_doc_ids (set[str]): doc_ids already in the database. Inserted doc_ids are added to it.
+        batch_size (int): The number of points per upsert request.
+        max_in_flight (int): The maximum number of upsert requests running at once.
+    """
+    num_points = db.upload_points(
+        iter_store_points(store, existing_doc_ids),
+        batch_size=batch_size,
+        max_in_flight=max_in_flight
+    )
+    print(f'Inserted {num_points} pdf points.')
 
 
 @click.command()
@@ -576,7 +900,52 @@ def insert_pdf_embeddings(db: qdrant_db.QdrantDB, embeddings_file: str) -> None:
 @click.option('--debug', is_flag=True, default=False, help='Run in debug mode')
 @click.option('--model', type=click.Choice(['bge-small', 'jina']), default='jina', help='Embedding model')
 @click.option('--mode', type=click.Choice(['compute', 'insert']), required=True, help='Mode to run: compute embeddings or insert into database')
-def main(data_dir: str | None, university_dir: str | None, debug: bool, model: str, mode: str):
+@click.option('--parse_workers', type=int, default=os.cpu_count(), help='Number of processes parsing and chunking files')
+@click.option('--embed_workers', type=int, default=1, help='Number of threads computing embeddings')
+@click.option('--embed_batch_size', type=int, default=256, help='Target number of texts per embedding batch')
+@click.option('--upload_batch_size', type=int, default=256, help='Number of points per upsert request')
+@click.option('--upload_workers', type=int, default=4, help='Number of upsert requests in flight at once')
+@click.option('--chunking', type=click.Choice(['words', 'tokens']), default='words', help='Split chunks on words or on the embedding model\'s tokens')
+@click.option('--chunk_size', type=int, default=256, help='Size of each chunk in words or tokens')
+@click.option('--chunk_overlap', type=int, default=32, help='Overlap between chunks in words or tokens')
+@click.option('--hybrid', is_flag=True, default=False, help='Create the collection with BM25 sparse vectors for hybrid search')
+@click.option('--quantization', type=click.Choice(['none', 'scalar', 'binary']), default=None, help='Quantize the stored vectors. Migrates an existing collection.')
+@click.option('--on_disk', is_flag=True, default=None, help='Keep the original vectors on disk. Migrates an existing collection.')
+@click.option('--prune', is_flag=True, default=False, help='Delete documents of the stored file types that are no longer in the embedding store')
+@click.option('--url_mode', type=click.Choice(['resolve', 'local']), default='resolve', help='Resolve html URLs over the network or derive them from the crawl layout')
+@click.option('--url_workers', type=int, default=16, help='Number of URL requests in flight at once')
+@click.option('--url_timeout', type=float, default=10.0, help='Seconds to wait for each URL request')
+@click.option('--no_dedup', is_flag=True, default=False, help='Embed near-duplicate html pages and boilerplate lines too')
+@click.option('--pdf_workers', type=int, default=os.cpu_count(), help='Number of pdfs converted at once')
+@click.option('--pdf_timeout', type=float, default=pdf_extraction.PDF_TIMEOUT, help='Seconds a single pdf may take to convert')
+@click.option('--ocr_dpi', type=int, default=pdf_extraction.OCR_DPI, help='Resolution scanned pdf pages are rasterized at for OCR')
+@click.option('--no_ocr', is_flag=True, help='Leave scanned pdf pages empty instead of running OCR')
+def main(
+        data_dir: str | None,
+        university_dir: str | None,
+        debug: bool,
+        model: str,
+        mode: str,
+        parse_workers: int,
+        embed_workers: int,
+        embed_batch_size: int,
+        upload_batch_size: int,
+        upload_workers: int,
+        chunking: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        hybrid: bool,
+        quantization: str | None,
+        on_disk: bool | None,
+        prune: bool,
+        url_mode: str,
+        url_workers: int,
+        url_timeout: float,
+        no_dedup: bool,
+        pdf_workers: int,
+        pdf_timeout: float,
+        ocr_dpi: int,
+        no_ocr: bool):
 
     if data_dir is None and university_dir is None:
         print('Error: data_dir or university_dir must be provided.')
@@ -590,8 +959,25 @@ def main(data_dir: str | None, university_dir: str | None, debug: bool, model: s
     embedding_model = qdrant_db.get_embedding_model(model)
 
     if mode == 'insert':
-        client_qdrant = qdrant_db.get_qdrant_client(host='192.168.0.8')
-        db = qdrant_db.QdrantDB(client_qdrant, 'suny', embedding_model.emb_dim)
+        client_qdrant = qdrant_db.get_qdrant_client()
+        db = qdrant_db.QdrantDB(client_qdrant, 'suny', embedding_model.emb_dim, hybrid=hybrid, quantization=quantization, on_disk=on_disk)
+
+    # Token chunks must fit in the model next to its special tokens
+    tokenizer_json = None
+    if chunking == 'tokens':
+        chunk_size = min(chunk_size, embedding_model.max_content_tokens)
+        tokenizer_json = embedding_model.tokenizer.to_str()
+    configure_chunking(chunking, chunk_size, chunk_overlap, tokenizer_json)
+
+    # Answers are kept across runs so only new pages are probed
+    url_cache = url_resolver.URLCache()
+
+    # Shared by every university so worker processes are only started once
+    executor = ProcessPoolExecutor(
+        max_workers=parse_workers,
+        initializer=configure_chunking,
+        initargs=(chunking, chunk_size, chunk_overlap, tokenizer_json)
+    )
 
     for data_dir in data_dirs:
 
@@ -613,31 +999,90 @@ def main(data_dir: str | None, university_dir: str | None, debug: bool, model: s
             html_files = [x for x in html_files if 'events' not in x]
             pdf_files = [x for x in pdf_files if 'events' not in x]
 
-            if len(html_files) > 0:
-                print('Computing embeddings for', len(html_files), 'html files...')
-                print('University:', university_name, '\n')
-                compute_html_embeddings(
+            # Run even without files so documents that vanished are removed from the store
+            print('Computing embeddings for', len(html_files), 'html files...')
+            print('University:', university_name, '\n')
+            compute_html_embeddings(
+                university_name,
+                html_files,
+                embedding_model,
+                data_dir,
+                executor,
+                embed_workers=embed_workers,
+                embed_batch_size=embed_batch_size,
+                resolve_urls=functools.partial(
+                    url_resolver.resolve_urls,
                     university_name,
-                    html_files,
-                    embedding_model,
-                    data_dir
+                    cache=url_cache,
+                    local_only=url_mode == 'local',
+                    max_workers=url_workers,
+                    timeout=url_timeout
+                ),
+                deduplicate=not no_dedup
+            )
+
+            print('Computing embeddings for', len(pdf_files), 'pdf files...')
+            compute_pdf_embeddings(
+                university_name,
+                pdf_files,
+                embedding_model,
+                data_dir,
+                executor,
+                embed_workers=embed_workers,
+                embed_batch_size=embed_batch_size,
+                extract_files=functools.partial(
+                    pdf_extraction.extract_pdfs,
+                    max_workers=pdf_workers,
+                    timeout=pdf_timeout,
+                    ocr=not no_ocr,
+                    ocr_dpi=ocr_dpi
                 )
-            if len(pdf_files) > 0:
-                print('Computing embeddings for', len(pdf_files), 'pdf files...')
-                compute_pdf_embeddings(university_name, pdf_files, embedding_model, data_dir)
+            )
 
         elif mode == 'insert':
 
-            html_embeddings_file = os.path.join(data_dir, 'html_embeddings.pkl')
-            pdf_embeddings_file = os.path.join(data_dir, 'pdf_embeddings.pkl')
+            university_name = os.path.basename(os.path.dirname(data_dir))
+
+            html_store = embedding_store.get_embedding_store(data_dir, 'html')
+            pdf_store = embedding_store.get_embedding_store(data_dir, 'pdf')
+            convert_legacy_embeddings(html_store, data_dir, 'html')
+            convert_legacy_embeddings(pdf_store, data_dir, 'pdf')
+
+            stored_hashes = {**html_store.content_hashes, **pdf_store.content_hashes}
+
+            # Only file types with a store are pruned, so a missing store never
+            # deletes the points of its type
+            prune_scopes = None
+            if prune:
+                prefix = get_doc_id_from_path(data_dir)
+                stores = {'.html': html_store, '.pdf': pdf_store}
+                prune_scopes = [(prefix, extension) for extension, store in stores.items() if len(store) > 0]
+            existing_doc_ids = delete_stale_documents(db, university_name, stored_hashes, prune_scopes)
+
+            if len(html_store) > 0:
+                print('Inserting html embeddings from', html_store.path)
+                insert_html_embeddings(
+                    db,
+                    html_store,
+                    existing_doc_ids,
+                    batch_size=upload_batch_size,
+                    max_in_flight=upload_workers
+                )
+
+            if len(pdf_store) > 0:
+                print('Inserting pdf embeddings from', pdf_store.path)
+                insert_pdf_embeddings(
+                    db,
+                    pdf_store,
+                    existing_doc_ids,
+                    batch_size=upload_batch_size,
+                    max_in_flight=upload_workers
+                )
 
-            if os.path.exists(html_embeddings_file):
-                print('Inserting html embeddings from', html_embeddings_file)
-                insert_html_embeddings(db, html_embeddings_file)
+            # Drop cached answers about this university
+            db.record_ingest(university_name)
 
-            if os.path.exists(pdf_embeddings_file):
-                print('Inserting pdf embeddings from', pdf_embeddings_file)
-                insert_pdf_embeddings(db, pdf_embeddings_file)
+    executor.shutdown()
 
 
 if __name__ == '__main__':
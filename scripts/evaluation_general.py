@@ -62,9 +62,6 @@ def main():
         messages = _prep_counselor_conversation(USER_PROMPTS, client, user_profile.student_md_profile)
         ev.save_pickle(messages, counselor_messages_file_name)
 
-    counselor = lambda x: ev.run_counselor(
-        x, messages, client, user_profile.student_md_profile,
-        temperature)
 
     # These questions show fragility here with gpt-4o-mini.
 
@@ -118,6 +115,14 @@ def main():
         # )
     ]
 
+    # Every uncached run is an independent session, so they all run concurrently
+    keys = [(question, idx) for question, _ in questions_and_evals for idx in range(n_iter)]
+    keys = [key for key in keys if cache.get(key) is None]
+    results = ev.run_counselor_sessions(
+        [question for question, _ in keys], messages, client,
+        user_profile.student_md_profile, temperature)
+    new_results = dict(zip(keys, results))
+
     rows = []
 
     for question, eval_func in questions_and_evals:
@@ -128,7 +133,7 @@ def main():
             new_messages = cache.get(key)
 
             if new_messages is None:
-                new_messages = counselor(question)
+                new_messages = new_results[key]
 
             if new_messages is None:
                 # OpenAI error, try it again next round
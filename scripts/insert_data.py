@@ -4,18 +4,16 @@ Script to insert files found by scripts/find_relevant_files.py into the database
 import os
 import re
 import json
-import uuid
 import click
-import requests
-import pymupdf4llm
 
 from tqdm import tqdm
 from openai import OpenAI
-from bs4 import BeautifulSoup
 from difflib import SequenceMatcher
 from qdrant_client import QdrantClient
 
 from src import agent
+from src import pdf_extraction
+from src import url_resolver
 from src import utils
 from src.database import qdrant_db
 from src.constants import UNIVERSITY_DATA_DIR, METADATA_PATH
@@ -67,51 +65,41 @@ def get_doc_id_from_path(path: str) -> str:
     return doc_id
 
 
-def get_html_url(university_name: str, file_path: str) -> str | None:
+def delete_stale_documents(
+        db: qdrant_db.QdrantDB,
+        university_name: str,
+        current_hashes: dict,
+        prune_scopes: list[tuple[str, str]] | None = None) -> set[str]:
     """
-    Try and get the URL of the HTML file
-     
+    Delete the documents of a university whose content changed so they are inserted
+    again. Points of unchanged documents are left in place.
+
     Args:
-        file_path (str): The local path to the HTML file.
+        db (qdrant_db.QdrantDB): Database to delete from.
+        university_name (str): Name of the university.
+        current_hashes (dict): Mapping of doc_id to the content hash of each current
+        document. Documents that couldn't be read map to None and are left as they are.
+        prune_scopes (list[tuple[str, str]] | None): (doc_id prefix, file extension)
+        pairs that were scanned. Documents in them without a current file are deleted
+        too. Nothing is pruned if None.
     Returns:
-        str: The valid URL (with or without .html) or None.
+        set[str]: doc_ids in the database that are up to date.
     """
-    
-    # Extract base URL from the file path by removing the root directory and file extension
-    base_url = file_path.split(university_name)[1].replace('.html', '')
-    if base_url.startswith('/'):
-        base_url = base_url[1:]
-
-    base_url = 'https://' + base_url
-
-    # TODO - look if .cfm is in the URL, I had wget --adjust-extension so they all
-    # turned from index.cfm to index.cfm.html
-
-    variants = [
-        base_url.rstrip('/index') + '/',
-        base_url,
-        base_url + '.html',
-        base_url + '/index.html',
-        base_url + '/index.php',
-        base_url + '/index.php.html',
-        base_url.rstrip('/index'),
-    ]
+    # Load the documents already in the database once instead of checking each one
+    existing_doc_hashes = db.get_existing_doc_hashes(university_name)
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36',
-        'Referer': base_url,
-        'Accept-Language': 'en-US,en;q=0.9',
-    }
-
-    for variant in variants:
-        try:
-            response = requests.get(variant, headers=headers)
-            if response.status_code == 200:
-                return variant
-        except requests.exceptions.RequestException:
-            pass
+    changed = {x for x, h in existing_doc_hashes.items() if current_hashes.get(x) not in (None, h)}
+    vanished = set()
+    if prune_scopes is not None:
+        vanished = {
+            x for x in existing_doc_hashes.keys() - current_hashes.keys()
+            if any(x.startswith(prefix) and x.endswith(extension) for prefix, extension in prune_scopes)
+        }
 
-    return None
+    if changed or vanished:
+        print(f'Deleting {len(changed)} changed and {len(vanished)} removed documents.')
+        db.delete_documents(sorted(changed | vanished))
+    return existing_doc_hashes.keys() - changed - vanished
 
 
 def select_files(root_directory: str, instructions: dict) -> dict:
@@ -248,59 +236,33 @@ def ask_question(db, question):
     print('Answer:', response.choices[0].message.content)
 
 
-def get_html_metadata(html_file: str) -> dict:
+def extract_pdf_pages(pdf_file: str, file_hash: str | None = None) -> list[str]:
     """
-    Get the metadata from an html file.
-
-    Args:
-        html_file (str): The path to the html file.
-    Returns:
-        dict: The metadata of the html file.
-    """
-    metadata = {}
-
-    with open(html_file, 'r', encoding='utf-8') as file:
-        soup = BeautifulSoup(file, 'html.parser')
-
-    metadata['title'] = soup.title.string.strip().replace('\xa0', ' ') if soup.title else ''
-
-    description = soup.find('meta', attrs={'name': 'description'})
-    metadata['description'] = description['content'].strip() if description else ''
-
-    keywords = soup.find('meta', attrs={'name': 'keywords'})
-    metadata['keywords'] = keywords['content'].strip() if keywords else ''
-
-    # Check for h1 to h6
-    metadata['headers'] = {}
-    for i in range(1, 7):
-        headers = [header.get_text().strip() for header in soup.find_all(f'h{i}')]
-        if headers:
-            metadata['headers'][f'h{i}'] = headers
-
-    metadata['language'] = soup.html.get('lang', '')
-
-    return metadata
-
-
-def extract_pdf_pages(pdf_file: str) -> list[str]:
-    """
-    Extract the text from each page of a pdf file as a list of strings.
+    Extract the markdown of each page of a pdf file as a list of strings. Pages
+    converted before, e.g. by pdf_extraction.extract_pdfs, come from the page cache.
 
     Args:
         pdf_file (str): The path to the pdf file.
-        text_type (str): The type of text to extract. Defaults to 'text'.
-        text, html, dict, json, xml, blocks, words, xhtml
+        file_hash (str | None): Hash of the file's contents. Computed if None.
     Returns:
         list[str]: A list of strings, one for each page of the pdf file.
     """
-    return pymupdf4llm.to_markdown(pdf_file, page_chunks=True)
+    file_hash = file_hash or utils.get_file_hash(pdf_file)
+    pages = pdf_extraction.load_pdf_pages(file_hash)
+    if pages is None:
+        pdf_extraction.extract_to_cache(pdf_file, file_hash)
+        pages = pdf_extraction.load_pdf_pages(file_hash)
+    return pages
 
 
 def insert_pdf_files(
         db: qdrant_db.QdrantDB,
         university_name: str,
         pdf_files: list[str],
-        embedding_model: qdrant_db.EmbeddingModel) -> None:
+        embedding_model: qdrant_db.EmbeddingModel,
+        existing_doc_ids: set[str] | None = None,
+        batch_size: int = 256,
+        max_in_flight: int = 4) -> None:
     """
     Insert the pdf files into the database.
 
@@ -309,104 +271,85 @@ def insert_pdf_files(
         university_name (str): The name of the university.
         pdf_files (list[str]): The list of pdf files to insert.
         embedding_model (qdrant_db.EmbeddingModel): The embedding model to use.
+        existing_doc_ids (set[str] | None): doc_ids already in the database. Loaded
+        from the database if None. Inserted doc_ids are added to it.
+        batch_size (int): The number of points per upsert request.
+        max_in_flight (int): The maximum number of upsert requests running at once.
     Returns:
         None
     """
 
-    batch_size = 16
+    if existing_doc_ids is None:
+        existing_doc_ids = db.get_existing_doc_ids(university_name)
 
-    ids = []
-    vectors = []
-    payloads = []
+    def iter_points():
+        for path in tqdm(pdf_files):
 
-    for path in tqdm(pdf_files):
+            doc_id = get_doc_id_from_path(path)
+            parent_point_id = qdrant_db.get_point_id(doc_id)
 
-        doc_id = get_doc_id_from_path(path)
-        parent_point_id = str(uuid.uuid4())
+            if doc_id in existing_doc_ids:
+                print(f'Document {doc_id} already exists.')
+                continue
+            existing_doc_ids.add(doc_id)
+            file_hash = utils.get_file_hash(path)
 
-        if db.point_exists(doc_id):
-            print(f'Document {doc_id} already exists.')
-            continue
+            url = 'https:/' + path.split(UNIVERSITY_DATA_DIR)[1]
 
-        url = 'https:/' + path.split(UNIVERSITY_DATA_DIR)[1]
+            text_pages = extract_pdf_pages(path, file_hash)
+            content_hash = pdf_extraction.get_content_hash(file_hash)
+            full_text = "\n".join(text_pages)
+            page_chunks = utils.chunk_pages(text_pages, chunk_size=256, overlap_size=32)
 
-        text_pages = extract_pdf_pages(path)
-        full_text = "\n".join([page['text'] for page in text_pages])
+            # Embed the full text and every chunk in one batch
+            parent_vector, *chunk_vectors = embedding_model.embed_batch(
+                [full_text] + [chunk['text'] for chunk in page_chunks]
+            )
 
-        payloads.append(
-            {
+            parent_payload = {
                 'filepath': path,
                 'doc_id': doc_id,
                 'university': university_name,
                 'type': 'pdf',
                 'url': url,
                 'content': full_text,
+                'content_hash': content_hash,
                 'point_id': parent_point_id,
                 'parent_point_id': parent_point_id
             }
-        )
-        ids.append(parent_point_id)
-        vectors.append(embedding_model.embed(full_text))
-
-        if len(payloads) >= batch_size:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=ids,
-                payloads=payloads,
-                vectors=vectors
-            )
-            payloads = []
-            vectors = []
-            ids = []
-
-        # Insert chunks into the database
-        page_chunks = utils.chunk_pages([page['text'] for page in text_pages], chunk_size=256, overlap_size=32)
-
-        chunk_payloads = []
-        chunk_vectors = []
-        chunk_ids = []
-        for chunk_id, chunk in enumerate(page_chunks):
-            chunk_point_id = str(uuid.uuid4())
-            chunk_payload = {
-                'filepath': path,
-                'doc_id': doc_id,
-                'university': university_name,
-                'type': 'pdf',
-                'url': url,
-                'point_id': chunk_point_id,
-                'parent_point_id': parent_point_id,
-                'chunk_id': chunk_id,
-                'content': chunk['text'],
-                'start_page': chunk['metadata']['start_page'],
-                'end_page': chunk['metadata']['end_page']
-            }
-            chunk_payloads.append(chunk_payload)
-            chunk_vectors.append(embedding_model.embed(chunk['text']))
-            chunk_ids.append(chunk_point_id)
-
-        if chunk_payloads:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=chunk_ids,
-                payloads=chunk_payloads,
-                vectors=chunk_vectors
-            )
-
-    # Insert remaining payloads if len(payloads) < batch_size
-    if payloads:
-        db.add_batch(
-            collection_name='suny',
-            point_ids=ids,
-            payloads=payloads,
-            vectors=vectors
-        )
+            yield parent_point_id, parent_vector, parent_payload
+
+            for chunk_id, (chunk, chunk_vector) in enumerate(zip(page_chunks, chunk_vectors)):
+                chunk_point_id = qdrant_db.get_point_id(doc_id, chunk_id)
+                chunk_payload = {
+                    'filepath': path,
+                    'doc_id': doc_id,
+                    'university': university_name,
+                    'type': 'pdf',
+                    'url': url,
+                    'content_hash': content_hash,
+                    'point_id': chunk_point_id,
+                    'parent_point_id': parent_point_id,
+                    'chunk_id': chunk_id,
+                    'content': chunk['text'],
+                    'start_page': chunk['metadata']['start_page'],
+                    'end_page': chunk['metadata']['end_page']
+                }
+                yield chunk_point_id, chunk_vector, chunk_payload
+
+    # Points are embedded lazily while earlier batches are uploading
+    db.upload_points(iter_points(), batch_size=batch_size, max_in_flight=max_in_flight)
 
 
 def insert_html_files(
         db: qdrant_db.QdrantDB,
         university_name: str,
         html_files: list[str],
-        embedding_model: qdrant_db.EmbeddingModel) -> None:
+        embedding_model: qdrant_db.EmbeddingModel,
+        existing_doc_ids: set[str] | None = None,
+        batch_size: int = 256,
+        max_in_flight: int = 4,
+        urls: dict | None = None) -> None:
     """
     Insert the html files into the database
 
@@ -415,110 +358,111 @@ def insert_html_files(
         university_name (str): The name of the university.
         html_files (list[str]): The list of html files to insert.
         embedding_model (qdrant_db.EmbeddingModel): The embedding model to use.
-        debug (bool): Run in debug mode.
+        existing_doc_ids (set[str] | None): doc_ids already in the database. Loaded
+        from the database if None. Inserted doc_ids are added to it.
+        batch_size (int): The number of points per upsert request.
+        max_in_flight (int): The maximum number of upsert requests running at once.
+        urls (dict | None): URL of each html file. Resolved for the files not in the
+        database yet if None.
     Returns:
         None
     """
 
-    batch_size = 16
+    if existing_doc_ids is None:
+        existing_doc_ids = db.get_existing_doc_ids(university_name)
+
+    if urls is None:
+        urls = url_resolver.resolve_urls(
+            university_name,
+            [x for x in html_files if get_doc_id_from_path(x) not in existing_doc_ids],
+            cache=url_resolver.URLCache()
+        )
 
-    ids = []
-    vectors = []
-    payloads = []
+    def iter_points():
+        for path in tqdm(html_files):
 
-    for path in tqdm(html_files):
+            doc_id = get_doc_id_from_path(path)
+            parent_point_id = qdrant_db.get_point_id(doc_id)
 
-        doc_id = get_doc_id_from_path(path)
-        parent_point_id = str(uuid.uuid4())
+            if doc_id in existing_doc_ids:
+                print(f'Document {doc_id} already exists.')
+                continue
+            existing_doc_ids.add(doc_id)
+            content_hash = utils.get_file_hash(path)
 
-        if db.point_exists(doc_id):
-            print(f'Document {doc_id} already exists.')
-            continue
+            url = urls[path]
+            if url is None:
+                print(f"Warning: No corresponding web page found for {path}")
+                with open('missing_html_urls.txt', 'a') as f:
+                    f.write(path + '\n')
 
-        url = get_html_url(university_name, path)
-        if url is None:
-            print(f"Warning: No corresponding web page found for {path}")
-            with open('missing_html_urls.txt', 'a') as f:
-                f.write(path + '\n')
+            page = utils.extract_html(path)
+            text = page['text']
+            text_chunks = utils.chunk_text(text, chunk_size=256, overlap_size=32)
 
-        text = utils.get_text_from_html(path)
+            # Embed the full text and every chunk in one batch
+            parent_vector, *chunk_vectors = embedding_model.embed_batch([text] + text_chunks)
 
-        payloads.append(
-            {
+            parent_payload = {
                 'filepath': path,
                 'doc_id': doc_id,
                 'university': university_name,
                 'type': 'html',
                 'url': url,
+                'title': page['title'],
+                'description': page['description'],
                 'content': text,
+                'content_hash': content_hash,
                 'point_id': parent_point_id,
                 'parent_point_id': parent_point_id
             }
-        )
-        ids.append(parent_point_id)
-        vectors.append(embedding_model.embed(text))
-
-        if len(payloads) >= batch_size:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=ids,
-                payloads=payloads,
-                vectors=vectors
-            )
-            payloads = []
-            vectors = []
-            ids = []
-
-        # Insert chunks into the database
-        text_chunks = utils.chunk_text(text, chunk_size=256, overlap_size=32)
-
-        chunk_payloads = []
-        chunk_vectors = []
-        chunk_ids = []
-        for chunk_id, chunk_text in enumerate(text_chunks):
-            chunk_point_id = str(uuid.uuid4())
-            chunk_payload = {
-                'filepath': path,
-                'doc_id': doc_id,
-                'university': university_name,
-                'type': 'html',
-                'url': url,
-                'point_id': chunk_point_id,
-                'parent_point_id': parent_point_id,
-                'chunk_id': chunk_id,
-                'content': chunk_text
-            }
-            chunk_payloads.append(chunk_payload)
-            chunk_vectors.append(embedding_model.embed(chunk_text))
-            chunk_ids.append(chunk_point_id)
-
-        if chunk_payloads:
-            db.add_batch(
-                collection_name='suny',
-                point_ids=chunk_ids,
-                payloads=chunk_payloads,
-                vectors=chunk_vectors
-            )
-
-    # Insert the remaining payloads if len(payloads) < batch_size
-    if payloads:
-        db.add_batch(
-            collection_name='suny',
-            point_ids=ids,
-            payloads=payloads,
-            vectors=vectors
-        )
+            yield parent_point_id, parent_vector, parent_payload
+
+            for chunk_id, (chunk_text, chunk_vector) in enumerate(zip(text_chunks, chunk_vectors)):
+                chunk_point_id = qdrant_db.get_point_id(doc_id, chunk_id)
+                chunk_payload = {
+                    'filepath': path,
+                    'doc_id': doc_id,
+                    'university': university_name,
+                    'type': 'html',
+                    'url': url,
+                    'content_hash': content_hash,
+                    'point_id': chunk_point_id,
+                    'parent_point_id': parent_point_id,
+                    'chunk_id': chunk_id,
+                    'content': chunk_text
+                }
+                yield chunk_point_id, chunk_vector, chunk_payload
+
+    # Points are embedded lazily while earlier batches are uploading
+    db.upload_points(iter_points(), batch_size=batch_size, max_in_flight=max_in_flight)
 
 
 @click.command()
 @click.option('--data_dir', '-d', type=str, default=None, help='Root university directory to process')
 @click.option('--debug', is_flag=True, default=False, help='Run in debug mode')
 @click.option('--model', type=click.Choice(['bge-small', 'jina']), default='jina', help='Embedding model')
-def main(data_dir: str | None, debug: bool, model: str):
+@click.option('--upload_batch_size', type=int, default=256, help='Number of points per upsert request')
+@click.option('--upload_workers', type=int, default=4, help='Number of upsert requests in flight at once')
+@click.option('--hybrid', is_flag=True, default=False, help='Create the collection with BM25 sparse vectors for hybrid search')
+@click.option('--quantization', type=click.Choice(['none', 'scalar', 'binary']), default=None, help='Quantize the stored vectors. Migrates an existing collection.')
+@click.option('--on_disk', is_flag=True, default=None, help='Keep the original vectors on disk. Migrates an existing collection.')
+@click.option('--prune', is_flag=True, default=False, help='Delete documents under the scanned directories whose files are gone')
+@click.option('--url_mode', type=click.Choice(['resolve', 'local']), default='resolve', help='Resolve html URLs over the network or derive them from the crawl layout')
+@click.option('--url_workers', type=int, default=16, help='Number of URL requests in flight at once')
+@click.option('--url_timeout', type=float, default=10.0, help='Seconds to wait for each URL request')
+@click.option('--pdf_workers', type=int, default=os.cpu_count(), help='Number of pdfs converted at once')
+@click.option('--pdf_timeout', type=float, default=pdf_extraction.PDF_TIMEOUT, help='Seconds a single pdf may take to convert')
+@click.option('--ocr_dpi', type=int, default=pdf_extraction.OCR_DPI, help='Resolution scanned pdf pages are rasterized at for OCR')
+@click.option('--no_ocr', is_flag=True, help='Leave scanned pdf pages empty instead of running OCR')
+def main(data_dir: str | None, debug: bool, model: str, upload_batch_size: int, upload_workers: int,
+        hybrid: bool, quantization: str | None, on_disk: bool | None, prune: bool,
+        url_mode: str, url_workers: int, url_timeout: float, pdf_workers: int, pdf_timeout: float,
+        ocr_dpi: int, no_ocr: bool):
 
     embedding_model = qdrant_db.get_embedding_model(model)
     client_qdrant = qdrant_db.get_qdrant_client()
-    db = qdrant_db.QdrantDB(client_qdrant, 'suny', embedding_model.emb_dim)
+    db = qdrant_db.QdrantDB(client_qdrant, 'suny', embedding_model.emb_dim, hybrid=hybrid, quantization=quantization, on_disk=on_disk)
 
     with open(METADATA_PATH, 'r') as f:
         metadata = json.load(f)
@@ -529,25 +473,90 @@ def main(data_dir: str | None, debug: bool, model: str):
         print(f"Warning: University {university_name} not found in metadata")
         exit()
 
+    root_directory = opj(UNIVERSITY_DATA_DIR, metadata[university_name]['root_directory'])
+    html_directories = [opj(root_directory, x) for x in metadata[university_name]['html_directories']]
+    pdf_directories = [opj(root_directory, x) for x in metadata[university_name]['pdf_directories']]
+    listed_pdf_files = [opj(root_directory, x) for x in metadata[university_name]['pdf_files']]
+
     html_files = []
-    for directory in metadata[university_name]['html_directories']:
-        directory = opj(UNIVERSITY_DATA_DIR, metadata[university_name]['root_directory'], directory)
+    for directory in html_directories:
         html_files.extend(utils.get_files(directory, '.html'))
 
-    pdf_files = []
-    for directory in metadata[university_name]['pdf_directories']:
-        directory = opj(UNIVERSITY_DATA_DIR, metadata[university_name]['root_directory'], directory)
+    pdf_files = list(listed_pdf_files)
+    for directory in pdf_directories:
         pdf_files.extend(utils.get_files(directory, '.pdf'))
-    for file in metadata[university_name]['pdf_files']:
-        pdf_files.append(opj(UNIVERSITY_DATA_DIR, metadata[university_name]['root_directory'], file))
     pdf_files = sorted(list(set(pdf_files)))
 
+    file_hashes = {get_doc_id_from_path(x): utils.get_file_hash(x) for x in html_files + pdf_files}
+
+    # Convert pdfs in isolated processes up front and skip the ones that fail.
+    # This happens before deleting anything, so a changed pdf that fails keeps
+    # its old points until a later run converts it. Every pdf is passed since
+    # converted ones are cached, and OCR can change the text of an unchanged pdf.
+    failed = set()
+    if len(pdf_files) > 0:
+        pdf_hashes = {x: file_hashes[get_doc_id_from_path(x)] for x in pdf_files}
+        failed = set(pdf_extraction.extract_pdfs(
+            pdf_files,
+            pdf_hashes,
+            max_workers=pdf_workers,
+            timeout=pdf_timeout,
+            ocr=not no_ocr,
+            ocr_dpi=ocr_dpi
+        ))
+        pdf_files = [x for x in pdf_files if x not in failed]
+        content_hashes = pdf_extraction.get_content_hashes(pdf_files, pdf_hashes)
+        file_hashes.update({get_doc_id_from_path(x): content_hashes[x] for x in pdf_files})
+        file_hashes.update({get_doc_id_from_path(x): None for x in failed})
+
+    # Only the directories and file types listed for the university are pruned,
+    # and never a directory that isn't there, e.g. on an unmounted drive
+    prune_scopes = None
+    if prune:
+        prune_scopes = [
+            (get_doc_id_from_path(x).rstrip(os.sep) + os.sep, extension)
+            for directories, extension in ((html_directories, '.html'), (pdf_directories, '.pdf'))
+            for x in directories if os.path.isdir(x)
+        ]
+        prune_scopes += [(get_doc_id_from_path(x), '.pdf') for x in listed_pdf_files]
+    existing_doc_ids = delete_stale_documents(db, university_name, file_hashes, prune_scopes)
+
     if len(pdf_files) > 0:
         print('Inserting', len(pdf_files), 'pdf files...')
-        insert_pdf_files(db, university_name, pdf_files, embedding_model)
+        insert_pdf_files(
+            db,
+            university_name,
+            pdf_files,
+            embedding_model,
+            existing_doc_ids,
+            batch_size=upload_batch_size,
+            max_in_flight=upload_workers
+        )
     if len(html_files) > 0:
+        # Resolve URLs before embedding so the upload never waits on the network
+        urls = url_resolver.resolve_urls(
+            university_name,
+            [x for x in html_files if get_doc_id_from_path(x) not in existing_doc_ids],
+            cache=url_resolver.URLCache(),
+            local_only=url_mode == 'local',
+            max_workers=url_workers,
+            timeout=url_timeout
+        )
+
         print('Inserting', len(html_files), 'html files...')
-        insert_html_files(db, university_name, html_files, embedding_model)
+        insert_html_files(
+            db,
+            university_name,
+            html_files,
+            embedding_model,
+            existing_doc_ids,
+            batch_size=upload_batch_size,
+            max_in_flight=upload_workers,
+            urls=urls
+        )
+
+    # Drop cached answers about this university
+    db.record_ingest(university_name)
 
 
 if __name__ == '__main__':
@@ -4,18 +4,33 @@ File containing the Agent class and functionality for the Agent
 
 # Cameron Fabbri
 import json
+import time
+import asyncio
 
 from typing import Any, Dict, List
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 
 import tiktoken
 
+from openai.types.chat import ChatCompletion, ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_message_tool_call import Function
+
 from src import utils
 from src.tools import function_map
-from src.utils import RESET, get_color, get_openai_client
+from src.utils import RESET, get_async_openai_client, get_color, get_openai_client
 
 MAX_INPUT_TOKENS = 32000
 
+# Tool calls from one response run concurrently, bounded by this pool
+MAX_TOOL_WORKERS = 4
+TOOL_CALL_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_TOOL_WORKERS, thread_name_prefix='tool_call')
+
+# Number of recent tool call timings kept per agent
+MAX_TOOL_TIMINGS = 100
+
 
 def format_content(content):
     try:
@@ -62,6 +77,79 @@ class Message:
     message: str
     chat_id: int
     tool_call: List[dict] | None = None
+    # Token count of the message content, keyed by tiktoken encoding name
+    token_counts: Dict[str, int] = field(default_factory=dict, repr=False, compare=False)
+
+
+class StreamedCompletion:
+    """
+    Wraps a streamed chat completion. Iterating yields the content deltas as
+    they arrive. Once the stream is consumed, `choices` holds the full
+    completion, including any tool calls, like a non-streamed response.
+    """
+    def __init__(self, stream):
+        self.stream = iter(stream)
+        self.completion = None
+        self._content = []
+        self._tool_calls = {}
+        self._finish_reason = None
+        self._last_chunk = None
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self._last_chunk = chunk
+            if not chunk.choices:
+                continue
+
+            choice = chunk.choices[0]
+            if choice.finish_reason is not None:
+                self._finish_reason = choice.finish_reason
+
+            # Tool calls arrive in pieces, keyed by their index in the response
+            for tool_call in choice.delta.tool_calls or []:
+                call = self._tool_calls.setdefault(tool_call.index, {'id': None, 'name': '', 'arguments': ''})
+                if tool_call.id:
+                    call['id'] = tool_call.id
+                if tool_call.function is not None:
+                    call['name'] += tool_call.function.name or ''
+                    call['arguments'] += tool_call.function.arguments or ''
+
+            if choice.delta.content:
+                self._content.append(choice.delta.content)
+                yield choice.delta.content
+
+        if self.completion is None:
+            self.completion = self._build_completion()
+
+    def _build_completion(self) -> ChatCompletion:
+        tool_calls = [
+            ChatCompletionMessageToolCall(
+                id=call['id'],
+                type='function',
+                function=Function(name=call['name'], arguments=call['arguments'])
+            )
+            for _, call in sorted(self._tool_calls.items())
+        ]
+        message = ChatCompletionMessage(
+            role='assistant',
+            content=''.join(self._content) if self._content else None,
+            tool_calls=tool_calls or None
+        )
+        return ChatCompletion(
+            id=self._last_chunk.id if self._last_chunk else '',
+            created=self._last_chunk.created if self._last_chunk else 0,
+            model=self._last_chunk.model if self._last_chunk else '',
+            object='chat.completion',
+            choices=[Choice(index=0, finish_reason=self._finish_reason or 'stop', message=message)]
+        )
+
+    @property
+    def choices(self) -> list[Choice]:
+        # Consume whatever is left of the stream if the caller didn't
+        if self.completion is None:
+            for _ in self:
+                pass
+        return self.completion.choices
 
 
 class Agent:
@@ -73,12 +161,14 @@ class Agent:
             system_prompt: str,
             model: str,
             json_mode: bool = False,
-            temperature: float = 0.0) -> None:
+            temperature: float = 0.0,
+            async_client=None) -> None:
         """
 
         """
 
         self.client = client
+        self.async_client = async_client
         self.name = name
         self.tools = tools
         self.system_prompt = system_prompt
@@ -87,6 +177,9 @@ class Agent:
         self.temperature = temperature
         self.messages = []
         self.color = get_color(self.name)
+        self.system_message = None
+        # Name and duration in seconds of the most recent tool calls this agent has run
+        self.tool_timings = deque(maxlen=MAX_TOOL_TIMINGS)
 
     def update_system_prompt(self, new_prompt: str) -> None:
         """
@@ -100,22 +193,42 @@ class Agent:
         self.system_prompt = new_prompt
 
     def add_message(self, message: Message):
+        self.count_message_tokens(message, utils.get_encoding_for_model(self.model))
         self.messages.append(message)
 
     def delete_last_message(self) -> None:
         if len(self.messages) > 1:
             self.messages.pop()
 
+    def message_content(self, msg: Message) -> str:
+        """
+        Get the content of the message as it is sent to the model.
+        """
+        if msg.sender == 'counselor' and msg.recipient == 'suny':
+            return utils.extract_content_from_message(msg.message)
+        return msg.message
+
+    def count_message_tokens(self, msg: Message, encoding: tiktoken.Encoding) -> int:
+        """
+        Get the number of tokens in the message content, tokenizing it only the
+        first time it is counted with the given encoding.
+
+        Args:
+            msg (Message): The message to count tokens for.
+            encoding (tiktoken.Encoding): The encoding to count with.
+        Returns:
+            int: The number of tokens in the message content.
+        """
+        if encoding.name not in msg.token_counts:
+            msg.token_counts[encoding.name] = utils.count_tokens(self.message_content(msg) or '', encoding)
+        return msg.token_counts[encoding.name]
+
     def messages_to_llm_messages(self, messages: list[Message]) -> list[dict]:
         result = []
         for msg in messages:
-            if msg.sender == 'counselor' and msg.recipient == 'suny':
-                content = utils.extract_content_from_message(msg.message)
-            else:
-                content = msg.message
             message_dict = {
                 "role": msg.role,
-                "content": content
+                "content": self.message_content(msg)
             }
             # Only the role assisstant can have the tool calling stuff in it,
             # but when the role is tool, it needs the tool call id
@@ -126,20 +239,25 @@ class Agent:
             result.append(message_dict)
         return result
 
-    def invoke(self) -> str:
-        """ Call the model and return the response. """
+    def request_kwargs(self) -> dict:
+        """
+        Build the arguments of the chat completion request for the current messages.
+        """
+
+        # The system prompt can be reassigned directly, so rebuild its message when it changes
+        if self.system_message is None or self.system_message.message != self.system_prompt:
+            self.system_message = Message(role="system", sender="", recipient="", message=self.system_prompt, chat_id=-1)
 
-        messages = []
-        messages.append(Message(role="system", sender="", recipient="", message=self.system_prompt, chat_id=-1))
-        messages.extend(self.messages)
+        messages = [self.system_message] + self.messages
 
         # Make sure messages don't exceed context length
         # TODO: we could choose max_tokens based on the model
-        encoding = tiktoken.encoding_for_model(self.model)
+        encoding = utils.get_encoding_for_model(self.model)
+        token_counts = [self.count_message_tokens(msg, encoding) for msg in messages]
         messages = self.messages_to_llm_messages(messages)
-        messages = filter_messages_token_count(messages, MAX_INPUT_TOKENS, encoding)
+        messages = filter_messages_token_count(messages, MAX_INPUT_TOKENS, encoding, token_counts)
 
-        return self.client.chat.completions.create(
+        return dict(
             model=self.model,
             messages=messages,
             tools=self.tools,
@@ -147,6 +265,30 @@ class Agent:
             temperature=self.temperature
         )
 
+    def invoke(self, stream: bool = False):
+        """
+        Call the model and return the response.
+
+        Args:
+            stream (bool): Return a StreamedCompletion that yields content deltas
+            as they arrive instead of waiting for the full completion.
+        Returns:
+            ChatCompletion | StreamedCompletion: The model's response.
+        """
+        response = self.client.chat.completions.create(**self.request_kwargs(), stream=stream)
+
+        if stream:
+            return StreamedCompletion(response)
+        return response
+
+    async def ainvoke(self) -> ChatCompletion:
+        """
+        Call the model with the async client and return the response.
+        """
+        if self.async_client is None:
+            self.async_client = get_async_openai_client()
+        return await self.async_client.chat.completions.create(**self.request_kwargs())
+
     def print_messages(self, verbose: bool = False) -> None:
         print('\n', 100 * '=', '\n')
         print(f'Agent {self.color}{self.name}{RESET} Messages:')
@@ -167,77 +309,155 @@ class Agent:
                 print('-' * 40)
         print('\n', 100 * '=', '\n')
 
-    def handle_tool_call(self, response, chat_id: int):
+    def run_tool_call(self, tool_call) -> tuple[dict, Any]:
         """
+        Run the function requested by a tool call and record how long it took.
+
+        Args:
+            tool_call (ChatCompletionMessageToolCall): The tool call to run.
+        Returns:
+            tuple[dict, Any]: The arguments of the call and the function result.
         """
+        print(f"{self.color}{self.name}{RESET}: Handling tool call: {tool_call.function.name}")
+        arguments = json.loads(tool_call.function.arguments)
+        print(f"{self.color}{self.name}{RESET}: Arguments: {arguments}")
 
-        tc_messages = []
-        for tool_call in response.choices[0].message.tool_calls:
-            print(f"{self.color}{self.name}{RESET}: Handling tool call: {tool_call.function.name}")
-            arguments = json.loads(tool_call.function.arguments)
-            print(f"{self.color}{self.name}{RESET}: Arguments: {arguments}")
+        start = time.perf_counter()
+        function_result = function_map[tool_call.function.name](**arguments)
+        seconds = time.perf_counter() - start
 
-            function_result = function_map[tool_call.function.name](**arguments)
+        self.tool_timings.append({'name': tool_call.function.name, 'seconds': seconds})
+        print(f"{self.color}{self.name}{RESET}: {tool_call.function.name} took {seconds:.2f}s")
 
-            args_and_result = {
-                **arguments,
-                "result": function_result
-            }
+        return arguments, function_result
+
+    def add_tool_call_messages(self, tool_call, arguments: dict, function_result, chat_id: int) -> list[Message]:
+        """
+        Add the messages recording a tool call and its result.
+
+        Args:
+            tool_call (ChatCompletionMessageToolCall): The tool call that was run.
+            arguments (dict): The arguments of the call.
+            function_result (Any): The result of the call.
+            chat_id (int): The chat the messages belong to.
+        Returns:
+            list[Message]: The tool call message and the function result message.
+        """
+
+        args_and_result = {
+            **arguments,
+            "result": function_result
+        }
 
-            # Message containing the arguments and result of the tool call
-            function_call_result_message = {
-                "role": "tool",
-                "content": json.dumps(args_and_result),
-                "tool_call_id": tool_call.id
+        # Message containing the arguments and result of the tool call
+        function_call_result_message = {
+            "role": "tool",
+            "content": json.dumps(args_and_result),
+            "tool_call_id": tool_call.id
+        }
+
+        tool_call_message = [
+            {
+                "function": {
+                    "arguments": json.dumps(arguments),
+                    "name": tool_call.function.name
+                },
+                "id": tool_call.id,
+                "type": "function"
             }
+        ]
+
+        tc_message = Message(
+            sender="",
+            recipient="",
+            role="assistant",
+            message="",
+            tool_call=tool_call_message,
+            chat_id=chat_id
+        )
 
-            tool_call_message = [
-                {
-                    "function": {
-                        "arguments": json.dumps(arguments),
-                        "name": tool_call.function.name
-                    },
-                    "id": tool_call.id,
-                    "type": "function"
-                }
-            ]
-
-            tc_message = Message(
-                sender="",
-                recipient="",
-                role="assistant",
-                message="",
-                tool_call=tool_call_message,
-                chat_id=chat_id
-            )
+        fc_message = Message(
+            sender="",
+            recipient="",
+            role="tool",
+            message=function_call_result_message['content'],
+            tool_call=tool_call_message,
+            chat_id=chat_id
+        )
 
-            fc_message = Message(
-                sender="",
-                recipient="",
-                role="tool",
-                message=function_call_result_message['content'],
-                tool_call=tool_call_message,
-                chat_id=chat_id
-            )
+        self.add_message(tc_message)
+        self.add_message(fc_message)
 
-            self.add_message(tc_message)
-            self.add_message(fc_message)
+        return [tc_message, fc_message]
 
-            tc_messages.append(tc_message)
-            tc_messages.append(fc_message)
+    def handle_tool_call(self, response, chat_id: int, stream: bool = False):
+        """
+        Run the tool calls in the response concurrently and call the model
+        again with the results.
 
-        return function_result, self.invoke(), tc_messages
+        Args:
+            response (ChatCompletion | StreamedCompletion): The response containing tool calls.
+            chat_id (int): The chat the tool call messages belong to.
+            stream (bool): Stream the follow-up response.
+        Returns:
+            tuple: The function results in the order of the tool calls, the
+            follow-up response and the tool call messages.
+        """
+        tool_calls = response.choices[0].message.tool_calls
+
+        # map keeps the results in the order of the tool calls
+        results = list(TOOL_CALL_EXECUTOR.map(self.run_tool_call, tool_calls))
+
+        function_results = []
+        tc_messages = []
+        for tool_call, (arguments, function_result) in zip(tool_calls, results):
+            function_results.append(function_result)
+            tc_messages.extend(self.add_tool_call_messages(tool_call, arguments, function_result, chat_id))
+
+        return function_results, self.invoke(stream=stream), tc_messages
+
+    async def ahandle_tool_call(self, response, chat_id: int):
+        """
+        Async version of handle_tool_call. The tools block on retrieval, so they
+        run concurrently in the tool call executor.
+
+        Args:
+            response (ChatCompletion): The response containing tool calls.
+            chat_id (int): The chat the tool call messages belong to.
+        Returns:
+            tuple: The function results in the order of the tool calls, the
+            follow-up response and the tool call messages.
+        """
+        loop = asyncio.get_running_loop()
+        tool_calls = response.choices[0].message.tool_calls
+
+        results = await asyncio.gather(*[
+            loop.run_in_executor(TOOL_CALL_EXECUTOR, self.run_tool_call, tool_call)
+            for tool_call in tool_calls
+        ])
+
+        function_results = []
+        tc_messages = []
+        for tool_call, (arguments, function_result) in zip(tool_calls, results):
+            function_results.append(function_result)
+            tc_messages.extend(self.add_tool_call_messages(tool_call, arguments, function_result, chat_id))
+
+        return function_results, await self.ainvoke(), tc_messages
 
 
 def filter_messages_token_count(
         messages: List[Dict[str, str]],
         max_tokens: int,
-        encoding: tiktoken.Encoding) -> List[Dict[str, Any]]:
+        encoding: tiktoken.Encoding,
+        token_counts: List[int] | None = None) -> List[Dict[str, Any]]:
 
     """
     Filter messages to fit within a certain token count.
     Keeps the system message and messages from the end backward
     until the limit is reached.
+
+    If token_counts is given it holds the token count of each message and
+    nothing is re-tokenized.
     """
 
     assert len(messages) > 0
@@ -245,20 +465,19 @@ def filter_messages_token_count(
     print('other messages:', len(other_messages))
     assert system_message['role'] == 'system', 'expected first message role=system'
 
-    tokens_org = sum([
-        utils.count_tokens(x['content'], encoding)
-        for x in messages
-    ])
+    if token_counts is None:
+        token_counts = [utils.count_tokens(x['content'], encoding) for x in messages]
+
+    tokens_org = sum(token_counts)
 
-    total_tokens = utils.count_tokens(system_message['content'], encoding)
+    total_tokens = token_counts[0]
 
     res = [system_message]
     if total_tokens > max_tokens:
         raise Exception(f'System mesage length > {max_tokens}')
 
     messages_keep = []
-    for msg in reversed(other_messages):
-        tokens = utils.count_tokens(msg['content'], encoding)
+    for msg, tokens in zip(reversed(other_messages), reversed(token_counts[1:])):
         if total_tokens + tokens > max_tokens:
             break
         messages_keep.append(msg)
@@ -0,0 +1,162 @@
+"""
+Semantic cache of formatted RAG context, keyed on the query embedding and school.
+"""
+import time
+import threading
+
+from typing import Callable
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Cache of RAG results that also serves questions worded slightly differently.
+
+    A lookup returns the most similar cached entry for the same school when its
+    cosine similarity with the query embedding is at least `threshold`. Entries
+    expire after `ttl` seconds, the least recently used entry is evicted past
+    `maxsize`, and entries are dropped when their university is re-ingested.
+
+    Ingests are seen through the markers QdrantDB.record_ingest stores next to the
+    collection, so an app on another host than the ingest job drops its answers
+    too. Markers are compared for changes rather than by time, so clock skew
+    between hosts doesn't matter.
+    """
+    def __init__(
+            self,
+            maxsize: int = 1024,
+            ttl: float = 24 * 60 * 60,
+            threshold: float = 0.95,
+            ingest_markers: Callable[[], dict] | None = None,
+            check_interval: float = 30.0):
+        """
+        Args:
+            maxsize (int): Maximum number of cached answers.
+            ttl (float): Seconds an answer stays valid.
+            threshold (float): Minimum cosine similarity to serve a cached answer.
+            ingest_markers (Callable[[], dict] | None): Returns each university's
+            latest ingest marker, e.g. QdrantDB.get_ingest_markers. Pass None to only
+            invalidate through invalidate().
+            check_interval (float): Seconds between checks of the ingest markers.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.ingest_markers = ingest_markers
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._markers = None
+        self._last_check = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _check_ingests(self) -> None:
+        """
+        Drop the entries of universities whose ingest marker changed since the last
+        check. Markers are loaded at most every check_interval seconds.
+        """
+        if self.ingest_markers is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._last_check is not None and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+
+        try:
+            markers = self.ingest_markers()
+        except Exception as e:
+            print('WARNING: Could not load the ingest markers')
+            print('Exception:', e)
+            return
+
+        with self._lock:
+            previous = self._markers
+            self._markers = markers
+            if previous is None:
+                return
+            changed = {x for x in markers.keys() | previous.keys() if markers.get(x) != previous.get(x)}
+            if not changed:
+                return
+            for key, (school_name, _, _, _) in list(self._entries.items()):
+                # Answers without a school can contain any university
+                if school_name is None or school_name in changed:
+                    del self._entries[key]
+
+    def get(self, query_vector: np.ndarray, school_name: str | None) -> str | None:
+        """
+        Get the cached answer for the closest matching question.
+
+        Args:
+            query_vector (np.ndarray): The query embedding.
+            school_name (str | None): The school the question is about.
+        Returns:
+            str | None: The cached answer, or None on a miss.
+        """
+        self._check_ingests()
+
+        query_vector = _normalize(query_vector)
+        now = time.time()
+        with self._lock:
+            best_key = None
+            best_score = self.threshold
+            for key, (name, vector, _, created) in list(self._entries.items()):
+                if now - created > self.ttl:
+                    del self._entries[key]
+                    continue
+                if name != school_name:
+                    continue
+                score = float(np.dot(vector, query_vector))
+                if score >= best_score:
+                    best_key = key
+                    best_score = score
+
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key][2]
+
+    def put(self, query_vector: np.ndarray, school_name: str | None, value: str) -> None:
+        """
+        Cache the answer for a question.
+
+        Args:
+            query_vector (np.ndarray): The query embedding.
+            school_name (str | None): The school the question is about.
+            value (str): The answer to cache.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries[self._next_key] = (school_name, _normalize(query_vector), value, time.time())
+            self._next_key += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, university: str | None = None) -> None:
+        """
+        Drop the cached answers about a university, or every answer if None.
+        """
+        with self._lock:
+            if university is None:
+                self._entries.clear()
+                return
+            for key, (school_name, _, _, _) in list(self._entries.items()):
+                if school_name is None or school_name == university:
+                    del self._entries[key]
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+# Shared between RAG instances, which tools.retrieve_content_from_question builds on every call
+ANSWER_CACHE = SemanticCache()
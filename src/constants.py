@@ -16,6 +16,12 @@ SUNY_AGENT_MODEL = 'gpt-4o'
 QDRANT_URL = str(os.getenv('QDRANT_URL'))
 QDRANT_API_KEY = str(os.getenv('QDRANT_API_KEY'))
 
+# Which Qdrant to use: 'remote' (Qdrant Cloud at QDRANT_URL), 'server' (a
+# Qdrant server at QDRANT_HOST), 'embedded' (in-process, stored at
+# QDRANT_DB_PATH) or 'memory' (in-process, nothing stored)
+QDRANT_MODE = os.getenv('QDRANT_MODE', 'remote')
+QDRANT_HOST = os.getenv('QDRANT_HOST', 'localhost')
+
 # https://www.dicebear.com/playground/
 STUDENT_AVATAR_STYLE = 'identicon'
 COUNSELOR_AVATAR_STYLE = 'bottts'
@@ -34,6 +40,12 @@ UNIVERSITY_DATA_DIR = opj(SYSTEM_DATA_DIR, 'suny')
 
 METADATA_PATH = opj('data', 'metadata.json')
 
+# Resolved web URL of each crawled HTML file
+URL_CACHE_PATH = opj('data', 'url_cache.json')
+
+# Text of each converted pdf page, keyed by file hash and page number
+PDF_CACHE_PATH = opj('data', 'pdf_cache.db')
+
 EXCLUDE = ['meeting', 'blog', 'news', 'events', 'calendar', 'faculty', '\\uf03f', '?', '_archive', 'alumni']
 
 SIGNUP_CODES = os.getenv('SIGNUP_CODES').split(',')
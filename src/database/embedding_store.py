@@ -0,0 +1,228 @@
+"""
+Append-only on-disk store for computed embeddings.
+
+Vectors are written to float32 .npy shards that are memory-mapped when read
+back, and payloads are appended to a JSONL index with one line per document.
+A document only counts as stored once its index line is fully written, so a
+crash loses at most the documents buffered since the last flush.
+
+Re-adding a document appends a record that supersedes the earlier one, and
+removing it appends a tombstone. Superseded vectors stay in their shards until
+the store is rebuilt.
+"""
+import os
+import json
+
+from typing import Iterator
+
+import numpy as np
+
+opj = os.path.join
+
+INDEX_FILE = 'index.jsonl'
+
+
+class EmbeddingStore:
+    """
+    Directory of vector shards plus a JSONL index of document payloads.
+
+    Each index line holds a document's doc_id, its content hash, the shard and
+    row of its parent vector, the parent payload and its chunk payloads. Chunk
+    vectors follow the parent vector in the shard, in order. A tombstone line
+    only holds the doc_id and 'deleted'. The last line for a doc_id wins.
+    """
+    def __init__(self, path: str, flush_size: int = 100):
+        """
+        Open the store. The directory is created on the first flush.
+
+        Args:
+            path (str): Directory holding the shards and index.
+            flush_size (int): Number of documents to buffer before writing a shard.
+        """
+        self.path = path
+        self.flush_size = flush_size
+        self.index_path = opj(path, INDEX_FILE)
+
+        self._truncate_partial_line()
+
+        self.doc_ids = set()
+        self.content_hashes = {}
+        self.num_shards = 0
+        self._num_lines = 0
+        self._latest_line = {}
+        for record in self._read_index():
+            self._apply_record(record)
+
+        self._records = []
+        self._vectors = []
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.doc_ids
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.flush()
+
+    def _shard_path(self, shard: int) -> str:
+        return opj(self.path, f'vectors_{shard:05d}.npy')
+
+    def _truncate_partial_line(self) -> None:
+        """
+        Drop a partially written last line left behind by a crash.
+        """
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, 'rb+') as f:
+            position = f.seek(0, os.SEEK_END)
+            while position > 0:
+                block_start = max(0, position - 65536)
+                f.seek(block_start)
+                block = f.read(position - block_start)
+                newline = block.rfind(b'\n')
+                if newline != -1:
+                    if block_start + newline + 1 != position:
+                        f.truncate(block_start + newline + 1)
+                    return
+                position = block_start
+            f.truncate(0)
+
+    def _apply_record(self, record: dict) -> None:
+        """
+        Make an index record the latest one for its doc_id.
+        """
+        doc_id = record['doc_id']
+        self._latest_line[doc_id] = self._num_lines
+        self._num_lines += 1
+
+        if record.get('deleted'):
+            self.doc_ids.discard(doc_id)
+            self.content_hashes.pop(doc_id, None)
+            return
+
+        self.doc_ids.add(doc_id)
+        self.content_hashes[doc_id] = record.get('content_hash')
+        self.num_shards = max(self.num_shards, record['shard'] + 1)
+
+    def _read_index(self) -> Iterator[dict]:
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def add_document(self, document: dict) -> None:
+        """
+        Buffer a document, writing a new shard once flush_size documents are buffered.
+        A document that is already stored is replaced.
+
+        Args:
+            document (dict): Dictionary with 'doc_id', 'parent' and 'chunks', where
+            the parent and each chunk have a 'vector' and a 'payload', and an
+            optional 'content_hash'.
+        Returns:
+            None
+        """
+        self._records.append({
+            'doc_id': document['doc_id'],
+            'content_hash': document.get('content_hash'),
+            'shard': self.num_shards,
+            'row': len(self._vectors),
+            'parent': document['parent']['payload'],
+            'chunks': [chunk['payload'] for chunk in document['chunks']]
+        })
+        self._vectors.append(document['parent']['vector'])
+        self._vectors.extend(chunk['vector'] for chunk in document['chunks'])
+        self.doc_ids.add(document['doc_id'])
+        self.content_hashes[document['doc_id']] = document.get('content_hash')
+
+        if len(self._records) >= self.flush_size:
+            self.flush()
+
+    def remove_document(self, doc_id: str) -> None:
+        """
+        Buffer a tombstone so the document is no longer returned by iter_documents.
+
+        Args:
+            doc_id (str): The document to remove.
+        Returns:
+            None
+        """
+        self._records.append({'doc_id': doc_id, 'deleted': True})
+        self.doc_ids.discard(doc_id)
+        self.content_hashes.pop(doc_id, None)
+
+        if len(self._records) >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write buffered vectors to a new shard and append their payloads to the index.
+        """
+        if not self._records:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Write the shard under a temporary name so a crash never leaves a
+        # truncated shard that the index points to. Tombstones have no vectors.
+        if self._vectors:
+            shard_path = self._shard_path(self.num_shards)
+            with open(shard_path + '.tmp', 'wb') as f:
+                np.save(f, np.asarray(self._vectors, dtype=np.float32))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(shard_path + '.tmp', shard_path)
+            self.num_shards += 1
+
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            for record in self._records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        for record in self._records:
+            self._apply_record(record)
+        self._records = []
+        self._vectors = []
+
+    def iter_documents(self) -> Iterator[dict]:
+        """
+        Stream the latest version of every stored document without loading every
+        vector into memory. Buffered documents are not included until flushed.
+
+        Yields:
+            dict: Dictionary with 'doc_id', 'content_hash', 'parent' and 'chunks' in
+            the same form passed to add_document. Vectors are memory-mapped views
+            into the shards.
+        """
+        shard = None
+        vectors = None
+        for line, record in enumerate(self._read_index()):
+            if record.get('deleted') or self._latest_line.get(record['doc_id']) != line:
+                continue
+
+            if record['shard'] != shard:
+                shard = record['shard']
+                vectors = np.load(self._shard_path(shard), mmap_mode='r')
+
+            row = record['row']
+            yield {
+                'doc_id': record['doc_id'],
+                'content_hash': record.get('content_hash'),
+                'parent': {'vector': vectors[row], 'payload': record['parent']},
+                'chunks': [
+                    {'vector': vectors[row + i + 1], 'payload': payload}
+                    for i, payload in enumerate(record['chunks'])
+                ]
+            }
+
+
+def get_embedding_store(data_dir: str, file_type: str, flush_size: int = 100) -> EmbeddingStore:
+    return EmbeddingStore(opj(data_dir, f'{file_type}_embeddings'), flush_size)
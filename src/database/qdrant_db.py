@@ -2,43 +2,246 @@
 """
 # Cameron Fabbri
 import os
+import re
 import json
+import time
+import uuid
+import zlib
 import pickle
+import threading
+import contextlib
 
-from typing import List
+from typing import Iterable, List, Tuple
+from itertools import islice
+from collections import Counter
 from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import numpy as np
 
 from fastembed import TextEmbedding
+from tokenizers import Tokenizer
 from FlagEmbedding import FlagReranker
 
 from qdrant_client import QdrantClient, models
-from qdrant_client.models import Distance, VectorParams
-from qdrant_client.http.models import (FieldCondition, Filter, MatchValue,
-                                       PointStruct)
+from qdrant_client.local.qdrant_local import QdrantLocal
+from qdrant_client.models import (Distance, Modifier, PayloadSchemaType, SparseVector,
+                                  SparseVectorParams, VectorParams)
+from qdrant_client.http.models import (FieldCondition, Filter, FilterSelector, MatchAny,
+                                       MatchValue, PointStruct)
 
 from src import utils
-from src.constants import FASTEMBED_CACHE_DIR, QDRANT_URL, QDRANT_API_KEY
+from src.constants import (FASTEMBED_CACHE_DIR, QDRANT_API_KEY, QDRANT_DB_PATH, QDRANT_HOST,
+                           QDRANT_MODE, QDRANT_URL)
 
 opj = os.path.join
 
 
+# Name of the sparse vector used for keyword matching in hybrid collections.
+# The dense vector keeps the default unnamed slot.
+SPARSE_VECTOR_NAME = 'bm25'
+
+# Candidates fetched per result with quantized vectors before rescoring them
+# with the original vectors. Binary quantization loses more, so it fetches more.
+RESCORE_OVERSAMPLING = {'scalar': 1.5, 'binary': 3.0}
+
+# Payload fields that are filtered on, indexed when the collection is opened
+INDEXED_PAYLOAD_FIELDS = ['university', 'doc_id', 'type', 'parent_point_id']
+
+# Payload fields RAG needs from search results
+SEARCH_PAYLOAD_FIELDS = ['content', 'parent_point_id', 'chunk_id', 'university', 'url', 'content_hash']
+
+# Suffix of the vectorless collection holding each university's latest ingest marker
+INGEST_COLLECTION_SUFFIX = '_ingests'
+
+
+# Embedded Qdrant isn't thread-safe, so every call to an embedded client holds this lock
+_LOCAL_CLIENT_LOCK = threading.RLock()
+
+# Namespace for deterministic point IDs, so re-ingesting a document overwrites
+# its points instead of duplicating them
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'pathfinder/suny')
+
+
+def get_point_id(doc_id: str, chunk_id: int | None = None) -> str:
+    """
+    Get the deterministic point ID of a document's parent or one of its chunks.
+
+    Args:
+        doc_id (str): The document id.
+        chunk_id (int | None): The chunk index, or None for the parent point.
+    Returns:
+        str: A UUIDv5 derived from the doc_id and chunk_id.
+    """
+    name = doc_id if chunk_id is None else f'{doc_id}#{chunk_id}'
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, name))
+
+class BM25Encoder:
+    """
+    Encodes text as a sparse vector of BM25 term weights.
+
+    Terms are hashed to stable indices, so no vocabulary needs to be stored.
+    Only the term frequency part of BM25 is computed here, the collection's
+    IDF modifier makes Qdrant apply the inverse document frequency at query time.
+    """
+    token_re = re.compile(r'\$?[a-z0-9]+(?:[.,][0-9]+)*')
+
+    def __init__(self, k: float = 1.2, b: float = 0.75, avg_len: float = 256.0):
+        self.k = k
+        self.b = b
+        self.avg_len = avg_len
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.token_re.findall(text.lower())
+
+    def term_index(self, term: str) -> int:
+        return zlib.crc32(term.encode('utf-8')) & 0x7fffffff
+
+    def _to_sparse(self, weights: dict) -> SparseVector:
+        indices = sorted(weights)
+        return SparseVector(indices=indices, values=[float(weights[i]) for i in indices])
+
+    def encode_document(self, text: str) -> SparseVector:
+        tokens = self.tokenize(text)
+        length_norm = 1 - self.b + self.b * len(tokens) / self.avg_len
+
+        weights = {}
+        for term, tf in Counter(tokens).items():
+            index = self.term_index(term)
+            weights[index] = weights.get(index, 0) + tf * (self.k + 1) / (tf + self.k * length_norm)
+        return self._to_sparse(weights)
+
+    def encode_query(self, text: str) -> SparseVector:
+        return self._to_sparse({self.term_index(term): 1.0 for term in set(self.tokenize(text))})
+
+
+def get_quantization_config(quantization: str):
+    """
+    Get the Qdrant quantization config.
+
+    Args:
+        quantization (str): 'scalar' for int8, 'binary' for 1 bit per dimension,
+        or 'none' for full float32 vectors only.
+    Returns:
+        The quantization config, or Disabled for 'none'.
+    """
+    if quantization == 'scalar':
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+        )
+    if quantization == 'binary':
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    if quantization == 'none':
+        return models.Disabled.DISABLED
+    raise ValueError(f'Unknown quantization {quantization}')
+
+
 class QdrantDB:
     """
     Vector database that uses Qdrant for storing and querying vectors.
     """
-    def __init__(self, client, collection_name: str, emb_dim: int):
+    def __init__(
+            self,
+            client,
+            collection_name: str,
+            emb_dim: int,
+            hybrid: bool = False,
+            quantization: str | None = None,
+            on_disk: bool | None = None):
+        """
+        Open the collection, creating it if it doesn't exist.
+
+        Args:
+            client (QdrantClient): The Qdrant client.
+            collection_name (str): The name of the collection.
+            emb_dim (int): The dimension of the dense vectors.
+            hybrid (bool): Create the collection with a BM25 sparse vector next to
+            the dense vector. An existing collection keeps its configuration.
+            quantization (str | None): 'scalar', 'binary' or 'none'. An existing
+            collection is migrated to it. None keeps the current setting.
+            on_disk (bool | None): Keep the original vectors on disk, with only the
+            quantized vectors in RAM. An existing collection is migrated to it.
+            None keeps the current setting.
+        """
         self.client = client
         self.collection_name = collection_name
         self.emb_dim = emb_dim
+        self.sparse_encoder = BM25Encoder()
 
         if not self.client.collection_exists(self.collection_name):
             self.client.create_collection(
                 collection_name=self.collection_name,
-                vectors_config=VectorParams(size=emb_dim, distance=Distance.COSINE),
+                vectors_config=VectorParams(size=emb_dim, distance=Distance.COSINE, on_disk=on_disk),
+                sparse_vectors_config={
+                    SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)
+                } if hybrid else None,
+                quantization_config=get_quantization_config(quantization) if quantization not in (None, 'none') else None
+            )
+        elif quantization is not None or on_disk is not None:
+            self.configure_storage(quantization, on_disk)
+
+        config = self.client.get_collection(self.collection_name).config
+        sparse_vectors = config.params.sparse_vectors
+        self.hybrid = bool(sparse_vectors) and SPARSE_VECTOR_NAME in sparse_vectors
+
+        if hybrid and not self.hybrid:
+            print(f'WARNING: Collection {self.collection_name} has no sparse vectors, recreate it to use hybrid search')
+
+        # Quantized searches are rescored with the original vectors
+        self.search_params = None
+        if isinstance(config.quantization_config, (models.ScalarQuantization, models.BinaryQuantization)):
+            oversampling = RESCORE_OVERSAMPLING[
+                'binary' if isinstance(config.quantization_config, models.BinaryQuantization) else 'scalar'
+            ]
+            self.search_params = models.SearchParams(
+                quantization=models.QuantizationSearchParams(rescore=True, oversampling=oversampling)
             )
 
+        self.create_payload_indexes()
+
+    def configure_storage(self, quantization: str | None = None, on_disk: bool | None = None) -> None:
+        """
+        Change the quantization and on-disk storage of an existing collection.
+        Qdrant rebuilds the quantized vectors in the background.
+
+        Args:
+            quantization (str | None): 'scalar', 'binary' or 'none'. None keeps the current setting.
+            on_disk (bool | None): Keep the original vectors on disk. None keeps the current setting.
+        Returns:
+            None
+        """
+        self.client.update_collection(
+            collection_name=self.collection_name,
+            vectors_config={'': models.VectorParamsDiff(on_disk=on_disk)} if on_disk is not None else None,
+            quantization_config=get_quantization_config(quantization) if quantization is not None else None
+        )
+
+    @property
+    def is_local(self) -> bool:
+        """ Whether the client is an embedded, in-process Qdrant. """
+        return isinstance(getattr(self.client, '_client', None), QdrantLocal)
+
+    def client_lock(self):
+        """ Lock to hold around client calls. Only embedded Qdrant needs one. """
+        return _LOCAL_CLIENT_LOCK if self.is_local else contextlib.nullcontext()
+
+    def create_payload_indexes(self) -> None:
+        """
+        Create keyword indexes on the filtered payload fields that don't have one yet.
+        Embedded Qdrant has no payload indexes, so nothing is done there.
+        """
+        if self.is_local:
+            return
+
+        payload_schema = self.client.get_collection(self.collection_name).payload_schema
+        for field_name in INDEXED_PAYLOAD_FIELDS:
+            if field_name not in payload_schema:
+                self.client.create_payload_index(
+                    collection_name=self.collection_name,
+                    field_name=field_name,
+                    field_schema=PayloadSchemaType.KEYWORD
+                )
+
     def add_batch(
             self,
             collection_name: str,
@@ -47,14 +250,78 @@ class QdrantDB:
             vectors: List[np.ndarray]) -> None:
         """ """
 
-        self.client.upsert(
-            collection_name=collection_name,
-            points=models.Batch(
-                ids=point_ids,
-                payloads=payloads,
-                vectors=vectors,
-            ),
-        )
+        # Hybrid collections also get a sparse vector computed from the content
+        if self.hybrid:
+            vectors = {
+                '': vectors,
+                SPARSE_VECTOR_NAME: [
+                    self.sparse_encoder.encode_document(payload.get('content') or '') for payload in payloads
+                ]
+            }
+
+        with self.client_lock():
+            self.client.upsert(
+                collection_name=collection_name,
+                points=models.Batch(
+                    ids=point_ids,
+                    payloads=payloads,
+                    vectors=vectors,
+                ),
+            )
+
+    def upload_points(
+            self,
+            points: Iterable[Tuple[str, np.ndarray, dict]],
+            batch_size: int = 256,
+            max_in_flight: int = 4,
+            max_retries: int = 3) -> int:
+        """
+        Upload points in large batches with several upserts in flight at once.
+
+        `points` is only read while fewer than max_in_flight batches are waiting
+        on the server, so a lazy iterator is never consumed far ahead of the upload.
+        Embedded Qdrant isn't thread-safe, so it only ever gets one batch at a time.
+
+        Args:
+            points (Iterable[Tuple[str, np.ndarray, dict]]): (point_id, vector, payload) tuples.
+            batch_size (int): The number of points per upsert request.
+            max_in_flight (int): The maximum number of upsert requests running at once.
+            max_retries (int): The number of times a failed batch is retried before giving up.
+        Returns:
+            int: The number of points uploaded.
+        """
+        def upsert(batch):
+            point_ids, vectors, payloads = zip(*batch)
+            for attempt in range(max_retries + 1):
+                try:
+                    self.add_batch(self.collection_name, list(point_ids), list(payloads), list(vectors))
+                    return len(batch)
+                except Exception as e:
+                    if attempt == max_retries:
+                        raise
+                    print(f'WARNING: Upsert of {len(batch)} points failed, retrying ({attempt + 1}/{max_retries})')
+                    print('Exception:', e)
+                    time.sleep(2 ** attempt)
+
+        if self.is_local:
+            max_in_flight = 1
+
+        num_uploaded = 0
+        points = iter(points)
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            while batch := list(islice(points, batch_size)):
+
+                # Wait for a slot before reading any further ahead
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    num_uploaded += sum(future.result() for future in done)
+
+                in_flight.add(executor.submit(upsert, batch))
+
+            num_uploaded += sum(future.result() for future in in_flight)
+
+        return num_uploaded
 
     def add_document(
             self,
@@ -73,59 +340,228 @@ class QdrantDB:
             metadata (dict): The metadata of the document.
         """
 
-        self.client.upsert(
-            collection_name=collection_name,
-            wait=True,
-            points=[
-                PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload=payload
-                )
-            ],
-        )
+        vector = embedding
+        if self.hybrid:
+            vector = {
+                '': embedding,
+                SPARSE_VECTOR_NAME: self.sparse_encoder.encode_document((payload or {}).get('content') or '')
+            }
+
+        with self.client_lock():
+            self.client.upsert(
+                collection_name=collection_name,
+                wait=True,
+                points=[
+                    PointStruct(
+                        id=point_id,
+                        vector=vector,
+                        payload=payload
+                    )
+                ],
+            )
 
     def point_exists(self, doc_id: str) -> bool:
         """
         Check if a point with the given doc_id exists in the collection.
         """
-        existing_points = self.client.scroll(
-            collection_name=self.collection_name,
-            scroll_filter=Filter(
-                must=[
-                    FieldCondition(key="doc_id", match=MatchValue(value=doc_id))
-                ]
-            ),
-            limit=1
-        )[0]
+        with self.client_lock():
+            existing_points = self.client.scroll(
+                collection_name=self.collection_name,
+                scroll_filter=Filter(
+                    must=[
+                        FieldCondition(key="doc_id", match=MatchValue(value=doc_id))
+                    ]
+                ),
+                limit=1
+            )[0]
         if existing_points:
             return True
         return False
 
+    def get_existing_doc_ids(self, university: str | None = None, page_size: int = 10000) -> set[str]:
+        """
+        Get the doc_ids of every point in the collection in a few large scroll requests.
+
+        Args:
+            university (str | None): Only include points from this university. Defaults to None.
+            page_size (int): The number of points fetched per request.
+        Returns:
+            set[str]: The doc_ids already in the collection.
+        """
+        return set(self.get_existing_doc_hashes(university, page_size))
+
+    def get_existing_doc_hashes(self, university: str | None = None, page_size: int = 10000) -> dict:
+        """
+        Get the content hash of every document in the collection in a few large scroll requests.
+
+        Args:
+            university (str | None): Only include points from this university. Defaults to None.
+            page_size (int): The number of points fetched per request.
+        Returns:
+            dict: Mapping of doc_id to its content hash. Documents inserted before
+            hashes were stored, or whose points disagree on the hash, map to None.
+        """
+        scroll_filter = None
+        if university is not None:
+            scroll_filter = Filter(
+                must=[
+                    FieldCondition(key="university", match=MatchValue(value=university))
+                ]
+            )
+
+        doc_hashes = {}
+        offset = None
+        while True:
+            with self.client_lock():
+                points, offset = self.client.scroll(
+                    collection_name=self.collection_name,
+                    scroll_filter=scroll_filter,
+                    limit=page_size,
+                    offset=offset,
+                    with_payload=['doc_id', 'content_hash'],
+                    with_vectors=False
+                )
+            for point in points:
+                if 'doc_id' not in point.payload:
+                    continue
+                doc_id = point.payload['doc_id']
+                content_hash = point.payload.get('content_hash')
+                # A partially replaced document counts as changed
+                if doc_hashes.setdefault(doc_id, content_hash) != content_hash:
+                    doc_hashes[doc_id] = None
+            if offset is None:
+                break
+        return doc_hashes
+
+    def delete_documents(self, doc_ids: Iterable[str], batch_size: int = 256) -> None:
+        """
+        Delete every point of the given documents.
+
+        Args:
+            doc_ids (Iterable[str]): The doc_ids to delete.
+            batch_size (int): The number of doc_ids matched per delete request.
+        """
+        doc_ids = iter(doc_ids)
+        while batch := list(islice(doc_ids, batch_size)):
+            with self.client_lock():
+                self.client.delete(
+                    collection_name=self.collection_name,
+                    points_selector=FilterSelector(
+                        filter=Filter(
+                            must=[
+                                FieldCondition(key="doc_id", match=MatchAny(any=batch))
+                            ]
+                        )
+                    ),
+                    wait=True
+                )
+
+    @property
+    def ingest_collection_name(self) -> str:
+        return self.collection_name + INGEST_COLLECTION_SUFFIX
+
+    def record_ingest(self, university: str) -> None:
+        """
+        Record that a university was just (re)inserted. The marker lives next to the
+        collection, so every host serving it sees the ingest and drops cached answers.
+
+        Args:
+            university (str): The university that was inserted.
+        """
+        with self.client_lock():
+            if not self.client.collection_exists(self.ingest_collection_name):
+                self.client.create_collection(collection_name=self.ingest_collection_name, vectors_config={})
+            self.client.upsert(
+                collection_name=self.ingest_collection_name,
+                points=[PointStruct(
+                    id=get_point_id(university),
+                    vector={},
+                    payload={'university': university, 'ingest_id': uuid.uuid4().hex, 'ingested_at': time.time()}
+                )],
+                wait=True
+            )
+
+    def get_ingest_markers(self, page_size: int = 10000) -> dict[str, str]:
+        """
+        Get the marker of every university's latest ingest. A university's marker
+        changes with every record_ingest.
+
+        Args:
+            page_size (int): The number of markers fetched per request.
+        Returns:
+            dict[str, str]: Mapping of university to its ingest marker.
+        """
+        markers = {}
+        offset = None
+        while True:
+            with self.client_lock():
+                if not self.client.collection_exists(self.ingest_collection_name):
+                    return {}
+                points, offset = self.client.scroll(
+                    collection_name=self.ingest_collection_name,
+                    limit=page_size,
+                    offset=offset,
+                    with_payload=['university', 'ingest_id'],
+                    with_vectors=False
+                )
+            markers.update({x.payload['university']: x.payload['ingest_id'] for x in points})
+            if offset is None:
+                break
+        return markers
+
     def get_document_by_id(self, point_id: str):
         """
         Get a document by its ID.
         """
-        result = self.client.retrieve(
-            collection_name=self.collection_name,
-            ids=[point_id]
-        )
+        with self.client_lock():
+            result = self.client.retrieve(
+                collection_name=self.collection_name,
+                ids=[point_id]
+            )
         return result[0]
 
+    def get_documents_by_ids(self, point_ids: List[str]) -> dict:
+        """
+        Get several documents in a single request.
+
+        Args:
+            point_ids (List[str]): The IDs of the documents.
+        Returns:
+            dict: Mapping of point ID (as a string) to its record. IDs that don't
+            exist are left out.
+        """
+        if not point_ids:
+            return {}
+        with self.client_lock():
+            result = self.client.retrieve(
+                collection_name=self.collection_name,
+                ids=list(point_ids),
+                with_payload=True,
+                with_vectors=False
+            )
+        return {str(record.id): record for record in result}
+
     def query(
             self,
             collection_name: str,
             query_vector: np.ndarray,
             university: str | None = None,
-            limit: int = 1):
+            limit: int = 1,
+            query_text: str | None = None):
         """
         Query the database for the given query vector and optional university filter.
+        Only the payload fields in SEARCH_PAYLOAD_FIELDS are returned.
+
+        In a hybrid collection, when the query text is given, the dense and BM25
+        candidates are fetched together and merged server-side with reciprocal
+        rank fusion.
 
         Args:
             collection_name (str): The name of the collection.
             query_vector (np.ndarray): The query vector.
             university (str | None): The name of the university. Defaults to None.
             limit (int): The number of results to return. Defaults to 1.
+            query_text (str | None): The query text used for keyword matching. Defaults to None.
         Returns:
             List[Dict[str, Any]]: A list of relevant documents with metadata.
         """
@@ -140,12 +576,32 @@ class QdrantDB:
                 ]
             )
 
-        return self.client.search(
-            collection_name=collection_name,
-            query_vector=query_vector,
-            query_filter=filter,
-            limit=limit
-        )
+        with self.client_lock():
+            if self.hybrid and query_text:
+                return self.client.query_points(
+                    collection_name=collection_name,
+                    prefetch=[
+                        models.Prefetch(query=query_vector, filter=filter, limit=limit, params=self.search_params),
+                        models.Prefetch(
+                            query=self.sparse_encoder.encode_query(query_text),
+                            using=SPARSE_VECTOR_NAME,
+                            filter=filter,
+                            limit=limit
+                        )
+                    ],
+                    query=models.FusionQuery(fusion=models.Fusion.RRF),
+                    limit=limit,
+                    with_payload=SEARCH_PAYLOAD_FIELDS
+                ).points
+
+            return self.client.search(
+                collection_name=collection_name,
+                query_vector=query_vector,
+                query_filter=filter,
+                limit=limit,
+                with_payload=SEARCH_PAYLOAD_FIELDS,
+                search_params=self.search_params
+            )
 
 
 class EmbeddingModel:
@@ -164,28 +620,87 @@ class EmbeddingModel:
             self.emb_dim = 768
             self.max_tokens = 8192
 
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self) -> Tokenizer:
+        """
+        The model's own tokenizer. fastembed's copy truncates and pads its input,
+        so this one has both turned off to count and split full documents.
+        """
+        if self._tokenizer is None:
+            tokenizer = Tokenizer.from_str(self.embedding_model.model.tokenizer.to_str())
+            tokenizer.no_truncation()
+            tokenizer.no_padding()
+            self._tokenizer = tokenizer
+        return self._tokenizer
+
+    @property
+    def max_content_tokens(self) -> int:
+        """ The number of tokens of text that fit in the model next to its special tokens. """
+        return self.max_tokens - self.tokenizer.num_special_tokens_to_add(is_pair=False)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def split_text(self, text: str) -> List[str]:
+        """
+        Split text into windows that fit within the model's max tokens.
+
+        Args:
+            text (str): The text to split.
+        Returns:
+            List[str]: The text itself if it is short enough, otherwise
+            overlapping windows of the text.
+        """
+        if self.count_tokens(text) <= self.max_content_tokens:
+            return [text]
+
+        # Window the text with an overlap of 20 tokens
+        return utils.chunk_text_by_tokens(
+            text,
+            self.tokenizer,
+            chunk_size=self.max_content_tokens,
+            overlap_size=20,
+            split_on_boundaries=False
+        )
+
     def embed(self, text: str) -> np.ndarray:
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: List[str], batch_size: int = 64) -> List[np.ndarray]:
+        """
+        Embed a list of texts in as few fastembed calls as possible.
 
-        num_tokens = utils.count_tokens(text)
+        Texts longer than the model's max tokens are split into windows, every
+        window of every text is embedded together, and the window embeddings
+        are averaged back into one vector per input text.
 
-        if num_tokens > self.max_tokens:
+        Args:
+            texts (List[str]): The texts to embed.
+            batch_size (int): The number of texts fastembed runs through the model at once.
+        Returns:
+            List[np.ndarray]: One embedding per input text, in the same order.
+        """
+        windows = []
+        owners = []
+        for idx, text in enumerate(texts):
+            for window in self.split_text(text):
+                windows.append(window)
+                owners.append(idx)
 
-            # Chunk the text with an overlap of 20 words
-            words = text.split()
-            chunks = []
-            for i in range(0, len(words), self.max_tokens - 20):
-                chunk = ' '.join(words[max(0, i-20):i+self.max_tokens])
-                chunks.append(chunk)
+        if not windows:
+            return []
 
-            # Get embeddings for each chunk
-            chunk_embeddings = [list(self.embedding_model.embed(chunk))[0] for chunk in chunks]
+        window_embeddings = list(self.embedding_model.embed(windows, batch_size=batch_size))
 
-            # Average the embeddings
-            avg_embedding = np.mean(chunk_embeddings, axis=0)
+        # Scatter the window embeddings back to their texts
+        grouped = [[] for _ in texts]
+        for owner, embedding in zip(owners, window_embeddings):
+            grouped[owner].append(embedding)
 
-            return list(avg_embedding)
+        return [x[0] if len(x) == 1 else np.mean(x, axis=0) for x in grouped]
 
-        return list(self.embedding_model.embed(text))[0]
 
 def get_openai_embedding(
         client, text, model="text-embedding-3-small"):
@@ -201,7 +716,7 @@ def get_embedding_model(model: str) -> EmbeddingModel:
     return EmbeddingModel(model)
 
 
-def get_local_qdrant_client(host: str = "localhost", port: int = 6333) -> QdrantClient:
+def get_local_qdrant_client(host: str = QDRANT_HOST, port: int = 6333) -> QdrantClient:
     return QdrantClient(host=host, port=port)
 
 
@@ -209,8 +724,51 @@ def get_remote_qdrant_client() -> QdrantClient:
     return QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
 
 
-def get_qdrant_db(client: QdrantClient, collection_name: str, emb_dim: int) -> QdrantDB:
-    return QdrantDB(client, collection_name, emb_dim)
+def get_embedded_qdrant_client(path: str = QDRANT_DB_PATH) -> QdrantClient:
+    """
+    Get an in-process Qdrant that needs no server.
+
+    Args:
+        path (str): Directory the collections are stored in, or ':memory:' to
+        keep everything in memory. Only one process can open a directory at a time.
+    Returns:
+        QdrantClient: The client.
+    """
+    if path == ':memory:':
+        return QdrantClient(location=':memory:')
+    return QdrantClient(path=path)
+
+
+def get_qdrant_client(mode: str = QDRANT_MODE, **kwargs) -> QdrantClient:
+    """
+    Get the Qdrant client for the configured backend.
+
+    Args:
+        mode (str): 'remote', 'server', 'embedded' or 'memory'. Defaults to the
+        QDRANT_MODE environment variable, or 'remote' if it isn't set.
+        **kwargs: Passed to get_local_qdrant_client or get_embedded_qdrant_client.
+    Returns:
+        QdrantClient: The client.
+    """
+    if mode == 'remote':
+        return get_remote_qdrant_client()
+    if mode == 'server':
+        return get_local_qdrant_client(**kwargs)
+    if mode == 'embedded':
+        return get_embedded_qdrant_client(**kwargs)
+    if mode == 'memory':
+        return get_embedded_qdrant_client(':memory:')
+    raise ValueError(f'Unknown Qdrant mode {mode}')
+
+
+def get_qdrant_db(
+        client: QdrantClient,
+        collection_name: str,
+        emb_dim: int,
+        hybrid: bool = False,
+        quantization: str | None = None,
+        on_disk: bool | None = None) -> QdrantDB:
+    return QdrantDB(client, collection_name, emb_dim, hybrid, quantization, on_disk)
 
 
 def get_reranker(model: str='BAAI/bge-reranker-v2-m3') -> FlagReranker:
@@ -0,0 +1,244 @@
+"""
+Near-duplicate page and boilerplate detection for crawled sites.
+
+Each page is fingerprinted with the hashes of its lines. Lines found on a
+large share of a site's pages are boilerplate (menus, banners, contact blocks)
+and are stripped before chunking. Pages are then compared by a SimHash of the
+word shingles of their text without boilerplate, and pages within a few bits
+of an earlier page are dropped as near-duplicates. Hashing the text with its
+boilerplate would make distinct pages built on the same template look alike.
+"""
+import re
+import hashlib
+
+import numpy as np
+
+# Words per shingle when computing a page's SimHash
+SHINGLE_SIZE = 5
+
+# Pages whose SimHashes differ in at most this many of the 64 bits are near-duplicates
+MAX_HAMMING_DISTANCE = 3
+
+# A line is boilerplate once it appears on this share of pages, and on at least BOILERPLATE_MIN_PAGES
+BOILERPLATE_FRACTION = 0.3
+BOILERPLATE_MIN_PAGES = 5
+
+_BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def normalize_line(line: str) -> str:
+    return ' '.join(line.lower().split())
+
+
+def get_line_hashes(text: str) -> list[tuple[int, int]]:
+    """
+    Get the hash and length of every non-empty line of a page.
+
+    Args:
+        text (str): The page text.
+    Returns:
+        list[tuple[int, int]]: (hash of the normalized line, length of the line) pairs.
+    """
+    line_hashes = []
+    for line in text.split('\n'):
+        normalized = normalize_line(line)
+        if normalized:
+            line_hashes.append((_hash64(normalized), len(line)))
+    return line_hashes
+
+
+def simhash(text: str, shingle_size: int = SHINGLE_SIZE) -> int:
+    """
+    Get the 64-bit SimHash of a text's word shingles.
+
+    Args:
+        text (str): The text to hash.
+        shingle_size (int): Number of words per shingle.
+    Returns:
+        int: The SimHash. Similar texts differ in few bits.
+    """
+    words = text.lower().split()
+    if not words:
+        return 0
+
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    hashes = np.array([_hash64(x) for x in shingles], dtype=np.uint64)
+
+    # Each bit is set when most shingle hashes have it set
+    bit_counts = ((hashes[:, None] >> _BIT_SHIFTS) & np.uint64(1)).sum(axis=0)
+    bits = bit_counts * 2 > len(hashes)
+    return int(np.sum(np.left_shift(np.uint64(1), _BIT_SHIFTS[bits]), dtype=np.uint64))
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def fingerprint_page(text: str) -> dict:
+    """
+    Get what find_boilerplate_lines and deduplicate_pages need about a page.
+
+    Args:
+        text (str): The page text.
+    Returns:
+        dict: The page's 'lines' as get_line_hashes pairs and its number of 'chars'.
+    """
+    return {'lines': get_line_hashes(text), 'chars': len(text)}
+
+
+def page_simhash(text: str, boilerplate: set[int]) -> int:
+    """
+    Get the SimHash of a page without its boilerplate lines.
+    """
+    return simhash(strip_boilerplate(text, boilerplate))
+
+
+def get_content_hash(file_hash: str, lines: list, boilerplate: set[int]) -> str:
+    """
+    Get the hash of the text a page is embedded with. It's the file hash unless
+    boilerplate lines are stripped from the page, and changes with the lines that are.
+
+    Args:
+        file_hash (str): Hash of the file's contents.
+        lines (list): The page's get_line_hashes pairs, e.g. its fingerprint's 'lines'.
+        boilerplate (set[int]): The site's boilerplate lines from find_boilerplate_lines.
+    Returns:
+        str: The content hash.
+    """
+    stripped = sorted({x[0] for x in lines} & boilerplate)
+    if not stripped:
+        return file_hash
+    return hashlib.sha256(f'{file_hash}:boilerplate:{stripped}'.encode('utf-8')).hexdigest()
+
+
+def find_boilerplate_lines(
+        fingerprints: list[dict],
+        fraction: float = BOILERPLATE_FRACTION,
+        min_pages: int = BOILERPLATE_MIN_PAGES) -> set[int]:
+    """
+    Find the lines repeated across a site's pages.
+
+    Exact copies of a page are counted once, so a page saved under many URLs
+    isn't mistaken for boilerplate.
+
+    Args:
+        fingerprints (list[dict]): Fingerprints of every page of the site.
+        fraction (float): Share of pages a line must appear on.
+        min_pages (int): Minimum number of pages a line must appear on.
+    Returns:
+        set[int]: Hashes of the boilerplate lines.
+    """
+    distinct_pages = {tuple(x[0] for x in fingerprint['lines']) for fingerprint in fingerprints}
+
+    page_counts = {}
+    for lines in distinct_pages:
+        for line_hash in set(lines):
+            page_counts[line_hash] = page_counts.get(line_hash, 0) + 1
+
+    threshold = max(min_pages, fraction * len(distinct_pages))
+    return {line_hash for line_hash, count in page_counts.items() if count >= threshold}
+
+
+def find_near_duplicates(simhashes: list[int], max_distance: int = MAX_HAMMING_DISTANCE) -> dict[int, int]:
+    """
+    Find pages whose SimHash is within max_distance bits of an earlier page.
+
+    The 64 bits are split into max_distance + 1 bands, so two near-duplicates
+    always share at least one band exactly and only pages sharing a band are compared.
+
+    Args:
+        simhashes (list[int]): SimHash of each page, in order of preference.
+        max_distance (int): Maximum number of differing bits.
+    Returns:
+        dict[int, int]: Mapping of each duplicate page's index to the index of the page it duplicates.
+    """
+    num_bands = max_distance + 1
+    band_bits = 64 // num_bands
+    band_mask = (1 << band_bits) - 1
+
+    buckets = {}
+    duplicates = {}
+    for i, value in enumerate(simhashes):
+        bands = [(band, (value >> (band * band_bits)) & band_mask) for band in range(num_bands)]
+
+        original = None
+        for key in bands:
+            for j in buckets.get(key, []):
+                if hamming_distance(value, simhashes[j]) <= max_distance:
+                    original = j
+                    break
+            if original is not None:
+                break
+
+        if original is not None:
+            duplicates[i] = original
+            continue
+
+        # Only pages that are kept are compared against
+        for key in bands:
+            buckets.setdefault(key, []).append(i)
+
+    return duplicates
+
+
+def deduplicate_pages(
+        fingerprints: dict,
+        simhashes: dict,
+        boilerplate: set[int],
+        max_distance: int = MAX_HAMMING_DISTANCE) -> tuple[list, dict]:
+    """
+    Find the near-duplicate pages of a site.
+
+    Args:
+        fingerprints (dict): Mapping of page (e.g. a file path) to its
+        fingerprint_page result, in order of preference.
+        simhashes (dict): Mapping of page to its page_simhash with `boilerplate`.
+        boilerplate (set[int]): The site's boilerplate lines from find_boilerplate_lines.
+        max_distance (int): Maximum number of differing SimHash bits for near-duplicates.
+    Returns:
+        tuple[list, dict]: The pages to keep and a report of what was removed.
+    """
+    pages = list(fingerprints)
+    values = list(fingerprints.values())
+
+    duplicates = find_near_duplicates([simhashes[x] for x in pages], max_distance)
+
+    total_chars = sum(x['chars'] for x in values)
+    duplicate_chars = sum(values[i]['chars'] for i in duplicates)
+    boilerplate_chars = sum(
+        length
+        for i, fingerprint in enumerate(values) if i not in duplicates
+        for line_hash, length in fingerprint['lines'] if line_hash in boilerplate
+    )
+
+    report = {
+        'pages': len(pages),
+        'duplicate_pages': len(duplicates),
+        'boilerplate_lines': len(boilerplate),
+        'total_chars': total_chars,
+        'duplicate_chars': duplicate_chars,
+        'boilerplate_chars': boilerplate_chars,
+        'removed_fraction': (duplicate_chars + boilerplate_chars) / total_chars if total_chars else 0.0,
+        'duplicates': {pages[i]: pages[j] for i, j in duplicates.items()}
+    }
+    return [page for i, page in enumerate(pages) if i not in duplicates], report
+
+
+def strip_boilerplate(text: str, boilerplate: set[int]) -> str:
+    """
+    Remove boilerplate lines from a page.
+
+    Args:
+        text (str): The page text.
+        boilerplate (set[int]): Line hashes from find_boilerplate_lines.
+    Returns:
+        str: The text without its boilerplate lines.
+    """
+    if not boilerplate:
+        return text
+    lines = [x for x in text.split('\n') if _hash64(normalize_line(x)) not in boilerplate]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
@@ -5,6 +5,7 @@ General functions for use in evaluation.
 from typing import Any, List, Tuple, Callable, Dict, Optional
 import json
 import pickle
+import asyncio
 
 import xlsxwriter
 from openai import OpenAI
@@ -23,6 +24,9 @@ ASSISTANT = 'assistant'
 
 
 MODEL_DEFAULT = 'gpt-4o-mini'
+
+# Maximum number of counselor sessions in flight at once in run_counselor_sessions
+MAX_SESSIONS = 8
 OPENAI_API_KEY_ENV = 'PATHFINDER_OPENAI_API_KEY'
 
 
@@ -71,6 +75,62 @@ def run_counselor(
     return counselor_agent.messages[-2:]
 
 
+async def arun_counselor(
+        question: str,
+        prev_messages: List[Message],
+        client: OpenAI,
+        student_md_profile: str,
+        temperature: float
+        ) -> Optional[List[Message]]:
+    """
+    Async version of run_counselor, using run_tools.aprocess_user_input
+    """
+
+    counselor_agent = run.initialize_counselor_agent(client, student_md_profile)
+    suny_agent = run.initialize_suny_agent(client)
+
+    counselor_agent.temperature = temperature
+    suny_agent.temperature = temperature
+
+    counselor_agent.messages = list(prev_messages)
+
+    try:
+        await run_tools.aprocess_user_input(counselor_agent, suny_agent, None, question, None)
+    except Exception as e:
+        print(e)
+        return None
+
+    assert len(counselor_agent.messages) == len(prev_messages) + 2
+
+    return counselor_agent.messages[-2:]
+
+
+def run_counselor_sessions(
+        questions: List[str],
+        prev_messages: List[Message],
+        client: OpenAI,
+        student_md_profile: str,
+        temperature: float,
+        max_sessions: int = MAX_SESSIONS
+        ) -> List[Optional[List[Message]]]:
+    """
+    Run an independent counselor session for each question concurrently on one
+    event loop, so the model calls of all sessions overlap.
+    Returns the new messages of each session in the order of the questions.
+    """
+
+    async def _run():
+        semaphore = asyncio.Semaphore(max_sessions)
+
+        async def _session(question):
+            async with semaphore:
+                return await arun_counselor(question, prev_messages, client, student_md_profile, temperature)
+
+        return await asyncio.gather(*[_session(question) for question in questions])
+
+    return asyncio.run(_run())
+
+
 def run_suny(question: str, client: OpenAI, temperature: float) -> List[Message]:
     """
     Functionally run SUNY agent,
@@ -156,7 +156,7 @@ def main_chat_interface() -> None:
         )
 
         # Process user input and get response
-        rt.process_user_input(st.session_state.counselor_agent, st.session_state.suny_agent, st.session_state.user, st.chat_message, prompt, st.session_state.chat_id)
+        rt.process_user_input(st.session_state.counselor_agent, st.session_state.suny_agent, st.session_state.user, st.chat_message, prompt, st.session_state.chat_id, stream=True)
         st.session_state.messages_since_update += 1
 
         # Rerun to display the new messages
@@ -0,0 +1,431 @@
+"""
+Convert PDFs to markdown in isolated worker processes with an on-disk page cache.
+
+Each file is converted in its own child process, so a PDF that hangs is killed
+after a timeout and one that crashes the parser only loses that file. Pages are
+cached by file hash and page number as they are converted, so re-runs, model
+swaps and retries after a timeout never convert a page twice.
+
+Pages without a text layer (scanned pages) are then rasterized and OCRed with
+tesseract in a worker pool, and their OCR text replaces the empty markdown.
+Pages whose OCR failed are retried on the next run, and the content hash of a
+file changes as its pages get OCR text, so it is embedded again.
+"""
+import os
+import sqlite3
+import hashlib
+import multiprocessing
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pymupdf
+import pymupdf4llm
+
+from tqdm import tqdm
+
+from src import pdf_tools, utils
+from src.constants import PDF_CACHE_PATH
+
+# Seconds a single file may take before its process is killed
+PDF_TIMEOUT = 600
+
+# Pages converted per pymupdf4llm call. The cache is written after each batch.
+PAGE_BATCH_SIZE = 16
+
+# Resolution scanned pages are rasterized at for OCR
+OCR_DPI = 300
+
+# Seconds tesseract may take on a single page
+OCR_TIMEOUT = 120
+
+
+class PDFPageCache:
+    """
+    SQLite cache of the text of each PDF page, keyed by file hash, page number and
+    extraction method. A file is complete once its page count is recorded.
+    """
+    def __init__(self, path: str = PDF_CACHE_PATH):
+        """
+        Args:
+            path (str): The database file. Created if it doesn't exist.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files (file_hash TEXT PRIMARY KEY, page_count INTEGER NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'file_hash TEXT NOT NULL, page INTEGER NOT NULL, method TEXT NOT NULL, text TEXT NOT NULL, '
+            'PRIMARY KEY (file_hash, page, method))'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS scanned_pages ('
+            'file_hash TEXT NOT NULL, page INTEGER NOT NULL, PRIMARY KEY (file_hash, page))'
+        )
+        # Files whose scanned pages were recorded, including ones without any
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scan_checked (file_hash TEXT PRIMARY KEY)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def get_page_count(self, file_hash: str) -> int | None:
+        """
+        Get the number of pages of a completely converted file, or None if it isn't.
+        """
+        row = self.conn.execute('SELECT page_count FROM files WHERE file_hash = ?', (file_hash,)).fetchone()
+        return row[0] if row else None
+
+    def set_page_count(self, file_hash: str, page_count: int) -> None:
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (file_hash, page_count))
+
+    def get_pages(self, file_hash: str, method: str = 'markdown') -> dict[int, str]:
+        """
+        Get the cached text of a file's pages.
+
+        Args:
+            file_hash (str): Hash of the file's contents.
+            method (str): How the text was extracted.
+        Returns:
+            dict[int, str]: Mapping of page number to its text.
+        """
+        rows = self.conn.execute(
+            'SELECT page, text FROM pages WHERE file_hash = ? AND method = ?', (file_hash, method)
+        )
+        return dict(rows.fetchall())
+
+    def put_pages(self, file_hash: str, pages: dict[int, str], method: str = 'markdown') -> None:
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                [(file_hash, page, method, text) for page, text in pages.items()]
+            )
+
+    def put_scanned_pages(self, file_hash: str, pages: list[int]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO scanned_pages VALUES (?, ?)', [(file_hash, page) for page in pages]
+            )
+            self.conn.execute('INSERT OR REPLACE INTO scan_checked VALUES (?)', (file_hash,))
+
+    def is_scan_checked(self, file_hash: str) -> bool:
+        row = self.conn.execute('SELECT 1 FROM scan_checked WHERE file_hash = ?', (file_hash,)).fetchone()
+        return row is not None
+
+    def get_pages_to_ocr(self, file_hash: str) -> list[int]:
+        """
+        Get the scanned pages of a file that haven't been OCRed yet.
+        """
+        rows = self.conn.execute(
+            'SELECT page FROM scanned_pages WHERE file_hash = ? AND page NOT IN '
+            '(SELECT page FROM pages WHERE file_hash = ? AND method = ?) ORDER BY page',
+            (file_hash, file_hash, 'ocr')
+        )
+        return [row[0] for row in rows.fetchall()]
+
+    def get_content_hash(self, file_hash: str) -> str:
+        """
+        Get the hash of the text a converted file is embedded with. It's the file
+        hash until scanned pages get OCR text, and changes with every page that does.
+        """
+        rows = self.conn.execute(
+            'SELECT page FROM pages WHERE file_hash = ? AND method = ? ORDER BY page', (file_hash, 'ocr')
+        )
+        ocr_pages = [row[0] for row in rows.fetchall()]
+        if not ocr_pages:
+            return file_hash
+        return hashlib.sha256(f'{file_hash}:ocr:{ocr_pages}'.encode('utf-8')).hexdigest()
+
+
+def _find_scanned_pages(doc: pymupdf.Document) -> list[int]:
+    return [page.number for page in doc if not pdf_tools.is_page_searchable(page)]
+
+
+def find_scanned_pages(pdf_file: str) -> list[int]:
+    """
+    Find the pages of a PDF without a text layer. Runs in a worker process.
+
+    Args:
+        pdf_file (str): Path to the PDF.
+    Returns:
+        list[int]: The scanned page numbers, starting at 0.
+    """
+    with pymupdf.open(pdf_file) as doc:
+        return _find_scanned_pages(doc)
+
+
+def extract_to_cache(
+        pdf_file: str,
+        file_hash: str,
+        cache_path: str = PDF_CACHE_PATH,
+        batch_size: int = PAGE_BATCH_SIZE) -> None:
+    """
+    Convert the pages of a PDF that aren't cached yet to markdown and cache them.
+
+    Args:
+        pdf_file (str): Path to the PDF.
+        file_hash (str): Hash of the file's contents.
+        cache_path (str): The page cache.
+        batch_size (int): Pages converted per call, and written to the cache together.
+    """
+    with PDFPageCache(cache_path) as cache:
+        if cache.get_page_count(file_hash) is not None:
+            return
+
+        doc = pymupdf.open(pdf_file)
+        try:
+            done = cache.get_pages(file_hash)
+            todo = [x for x in range(doc.page_count) if x not in done]
+
+            # Headers are identified from the whole document, as in a single to_markdown call
+            hdr_info = pymupdf4llm.IdentifyHeaders(doc) if todo else None
+            for i in range(0, len(todo), batch_size):
+                batch = todo[i:i + batch_size]
+                pages = pymupdf4llm.to_markdown(
+                    doc, pages=batch, hdr_info=hdr_info, page_chunks=True, show_progress=False
+                )
+                cache.put_pages(file_hash, {x: page['text'] for x, page in zip(batch, pages)})
+
+            # Recorded before the file is marked complete so no scanned page is missed
+            cache.put_scanned_pages(file_hash, _find_scanned_pages(doc))
+            cache.set_page_count(file_hash, doc.page_count)
+        finally:
+            doc.close()
+
+
+def _get_context():
+    # Forking a process that has threads running can deadlock, so children are
+    # started from a clean forkserver where available
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def extract_isolated(
+        pdf_file: str,
+        file_hash: str,
+        cache_path: str = PDF_CACHE_PATH,
+        timeout: float = PDF_TIMEOUT) -> bool:
+    """
+    Run extract_to_cache in a child process, killing it after `timeout` seconds.
+
+    Args:
+        pdf_file (str): Path to the PDF.
+        file_hash (str): Hash of the file's contents.
+        cache_path (str): The page cache.
+        timeout (float): Seconds before the process is killed.
+    Returns:
+        bool: Whether every page was converted.
+    """
+    process = _get_context().Process(target=extract_to_cache, args=(pdf_file, file_hash, cache_path))
+    process.start()
+    process.join(timeout)
+
+    if process.is_alive():
+        process.kill()
+        process.join()
+        print(f'WARNING: Timed out extracting {pdf_file} after {timeout} seconds')
+        return False
+
+    if process.exitcode != 0:
+        print(f'WARNING: Could not extract {pdf_file} (exit code {process.exitcode})')
+        return False
+
+    return True
+
+
+def extract_pdfs(
+        pdf_files: list[str],
+        file_hashes: dict | None = None,
+        cache_path: str = PDF_CACHE_PATH,
+        max_workers: int | None = None,
+        timeout: float = PDF_TIMEOUT,
+        ocr: bool = True,
+        ocr_dpi: int = OCR_DPI) -> list[str]:
+    """
+    Convert every PDF that isn't cached yet, each in its own process, then OCR
+    their scanned pages.
+
+    Args:
+        pdf_files (list[str]): Paths to the PDFs.
+        file_hashes (dict | None): Hash of each file's contents. Computed if None.
+        cache_path (str): The page cache.
+        max_workers (int | None): Maximum number of files converted, or pages
+        OCRed, at once. Defaults to the number of CPUs.
+        timeout (float): Seconds a single file may take.
+        ocr (bool): OCR scanned pages. Skipped with a warning if tesseract isn't installed.
+        ocr_dpi (int): Resolution scanned pages are rasterized at.
+    Returns:
+        list[str]: The files that couldn't be converted.
+    """
+    if file_hashes is None:
+        file_hashes = {x: utils.get_file_hash(x) for x in pdf_files}
+
+    with PDFPageCache(cache_path) as cache:
+        todo = [x for x in pdf_files if cache.get_page_count(file_hashes[x]) is None]
+
+    def extract(path):
+        return extract_isolated(path, file_hashes[path], cache_path, timeout)
+
+    failed = []
+    if todo:
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            results = zip(todo, executor.map(extract, todo))
+            for path, success in tqdm(results, total=len(todo), desc='Extracting pdfs'):
+                if not success:
+                    failed.append(path)
+
+    if ocr:
+        if pdf_tools.is_tesseract_available():
+            ocr_pdfs(
+                [x for x in pdf_files if x not in failed],
+                file_hashes,
+                cache_path,
+                dpi=ocr_dpi,
+                max_workers=max_workers
+            )
+        else:
+            print('WARNING: tesseract is not installed, scanned pdf pages are left empty')
+
+    return failed
+
+
+def ocr_page(pdf_file: str, page_number: int, dpi: int = OCR_DPI, timeout: float = OCR_TIMEOUT) -> str:
+    """
+    Rasterize a page and OCR it. Runs in a worker process.
+
+    Args:
+        pdf_file (str): Path to the PDF.
+        page_number (int): The page to OCR, starting at 0.
+        dpi (int): Resolution to rasterize the page at.
+        timeout (float): Seconds before tesseract is stopped.
+    Returns:
+        str: The text on the page.
+    """
+    image = pdf_tools.render_pdf_page(pdf_file, page_number, dpi)
+    try:
+        return pdf_tools.parse_text_from_image(image, timeout=timeout)
+    except Exception as e:
+        # pytesseract's exceptions can't be unpickled and would break the whole pool
+        raise RuntimeError(f'{type(e).__name__}: {e}') from None
+
+
+def _init_ocr_worker() -> None:
+    # The pool already keeps every core busy, so each tesseract runs single-threaded
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+
+def ocr_pdfs(
+        pdf_files: list[str],
+        file_hashes: dict,
+        cache_path: str = PDF_CACHE_PATH,
+        dpi: int = OCR_DPI,
+        max_workers: int | None = None,
+        timeout: float = OCR_TIMEOUT,
+        executor: Executor | None = None) -> int:
+    """
+    OCR the scanned pages of converted PDFs that aren't OCRed yet and cache the text.
+    Files converted before scanned pages were recorded are checked for them first.
+
+    Args:
+        pdf_files (list[str]): Paths to the converted PDFs.
+        file_hashes (dict): Hash of each file's contents.
+        cache_path (str): The page cache.
+        dpi (int): Resolution to rasterize pages at.
+        max_workers (int | None): Maximum number of pages OCRed at once. Defaults to the number of CPUs.
+        timeout (float): Seconds tesseract may take on a single page.
+        executor (Executor | None): Pool to run find_scanned_pages and ocr_page in.
+        A process pool is created if None.
+    Returns:
+        int: The number of pages OCRed.
+    """
+    with PDFPageCache(cache_path) as cache:
+        unchecked = [x for x in pdf_files if not cache.is_scan_checked(file_hashes[x])]
+        if not unchecked and not any(cache.get_pages_to_ocr(file_hashes[x]) for x in pdf_files):
+            return 0
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers or os.cpu_count(),
+                mp_context=_get_context(),
+                initializer=_init_ocr_worker
+            )
+
+        num_pages = 0
+        try:
+            futures = {executor.submit(find_scanned_pages, path): path for path in unchecked}
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Finding scanned pages'):
+                path = futures[future]
+                try:
+                    cache.put_scanned_pages(file_hashes[path], future.result())
+                except Exception as e:
+                    print('WARNING: Could not find the scanned pages of', path)
+                    print('Exception:', e)
+
+            tasks = [(path, page) for path in pdf_files for page in cache.get_pages_to_ocr(file_hashes[path])]
+            futures = {executor.submit(ocr_page, path, page, dpi, timeout): (path, page) for path, page in tasks}
+            for future in tqdm(as_completed(futures), total=len(futures), desc='OCR'):
+                path, page = futures[future]
+                try:
+                    text = future.result()
+                except Exception as e:
+                    print(f'WARNING: Could not OCR page {page + 1} of {path}')
+                    print('Exception:', e)
+                    continue
+                cache.put_pages(file_hashes[path], {page: text}, method='ocr')
+                num_pages += 1
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    return num_pages
+
+
+def get_content_hashes(pdf_files: list[str], file_hashes: dict, cache_path: str = PDF_CACHE_PATH) -> dict:
+    """
+    Get the hash of the text each PDF is embedded with, see PDFPageCache.get_content_hash.
+
+    Args:
+        pdf_files (list[str]): Paths to the PDFs.
+        file_hashes (dict): Hash of each file's contents.
+        cache_path (str): The page cache.
+    Returns:
+        dict: Mapping of file path to its content hash.
+    """
+    with PDFPageCache(cache_path) as cache:
+        return {x: cache.get_content_hash(file_hashes[x]) for x in pdf_files}
+
+
+def get_content_hash(file_hash: str, cache_path: str = PDF_CACHE_PATH) -> str:
+    with PDFPageCache(cache_path) as cache:
+        return cache.get_content_hash(file_hash)
+
+
+def load_pdf_pages(file_hash: str, cache_path: str = PDF_CACHE_PATH) -> list[str] | None:
+    """
+    Get the text of each page of a converted PDF.
+
+    Args:
+        file_hash (str): Hash of the file's contents.
+        cache_path (str): The page cache.
+    Returns:
+        list[str] | None: The markdown of each page, with the OCR text of scanned
+        pages, or None if the file wasn't completely converted.
+    """
+    with PDFPageCache(cache_path) as cache:
+        page_count = cache.get_page_count(file_hash)
+        if page_count is None:
+            return None
+        pages = cache.get_pages(file_hash)
+        pages.update(cache.get_pages(file_hash, method='ocr'))
+    return [pages.get(x, '') for x in range(page_count)]
@@ -6,13 +6,14 @@ import os
 import fitz
 import PyPDF2
 import pytesseract
-import nest_asyncio
 
 from PIL import Image
 from openai import OpenAI
-from llama_parse import LlamaParse
 from PyPDF2 import PdfReader, PdfWriter
 
+# Pages with less text than this are checked for being a scanned image
+MIN_SEARCHABLE_CHARS = 20
+
 
 def is_pdf_searchable(pdf_path):
     """
@@ -50,11 +51,58 @@ def is_pdf_searchable(pdf_path):
     return True
 
 
-def parse_text_from_image(image_path: str) -> str:
+def is_page_searchable(page: fitz.Page, min_chars: int = MIN_SEARCHABLE_CHARS) -> bool:
+    """
+    Check if a single PDF page has a text layer or is likely a scanned image.
+
+    Args:
+        page (fitz.Page): The page to check.
+        min_chars (int): Minimum number of characters of text for the page to count as searchable.
+
+    Returns:
+        bool: False if the page has little or no text but does have images.
+    """
+    if len(page.get_text().strip()) >= min_chars:
+        return True
+    return not page.get_images()
+
+
+def render_pdf_page(pdf_file: str, page_number: int, dpi: int = 300) -> Image.Image:
+    """
+    Rasterize a single page of a PDF file.
+
+    Args:
+        pdf_file (str): The path to the PDF file.
+        page_number (int): The page to render, starting at 0.
+        dpi (int): The resolution to render at.
+
+    Returns:
+        Image.Image: The rendered page.
+    """
+    with fitz.open(pdf_file) as doc:
+        pix = doc[page_number].get_pixmap(dpi=dpi)
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+
+def is_tesseract_available() -> bool:
+    try:
+        pytesseract.get_tesseract_version()
+        return True
+    except pytesseract.TesseractNotFoundError:
+        return False
+
+
+def parse_text_from_image(image: str | Image.Image, timeout: float = 0) -> str:
     """
     Parse text from an image using OCR.
+
+    Args:
+        image (str | Image.Image): The image or the path to it.
+        timeout (float): Seconds before tesseract is stopped. 0 waits indefinitely.
     """
-    return pytesseract.image_to_string(Image.open(image_path))
+    if isinstance(image, str):
+        image = Image.open(image)
+    return pytesseract.image_to_string(image, timeout=timeout)
 
 
 def load_pdf_text(file_path: str, page_start: int = 0, page_end: int = None) -> list[str]:
@@ -92,6 +140,10 @@ def parse_pdf_with_llama(pdf_file: str) -> str:
         str: The text from the PDF file.
     """
 
+    # Imported here since llama_parse takes a second to import and is rarely used
+    import nest_asyncio
+    from llama_parse import LlamaParse
+
     nest_asyncio.apply()
     parser = LlamaParse(
         api_key=os.getenv("LLAMA_CLOUD_API_KEY"),  # can also be set in your env as LLAMA_CLOUD_API_KEY
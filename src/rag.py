@@ -1,11 +1,30 @@
 """
 RAG (Retrieval Augmented Generation) class for retrieving and formatting documents from a QdrantDB instance.
 """
+import hashlib
+import threading
+
+import numpy as np
+import tiktoken
+
 from FlagEmbedding import FlagReranker
 from typing import Any, Dict, List, Tuple
 
 from src.database import qdrant_db
-from src.utils import count_tokens
+from src.answer_cache import SemanticCache
+from src.utils import LRUCache
+
+# Reranker scores keyed on (query hash, point id, content hash). Shared between RAG
+# instances because tools.retrieve_content_from_question builds a new RAG on every call.
+# Point ids survive re-ingesting a document, so the content hash keeps stale scores out.
+RERANK_SCORE_CACHE = LRUCache(maxsize=8192)
+
+# Parent documents keyed on (point id, content hash). Catalogue and tuition pages
+# are the parents of many chunks, so the same few come up for most questions.
+PARENT_DOC_CACHE = LRUCache(maxsize=512)
+
+# Tool calls run RAG on several threads, and the reranker's tokenizer isn't thread-safe
+_RERANK_LOCK = threading.Lock()
 
 class RAG:
     def __init__(
@@ -14,7 +33,12 @@ class RAG:
             embedding_model: qdrant_db.EmbeddingModel,
             reranker: FlagReranker = None,
             top_n: int = 20,
-            top_k: int = 5
+            top_k: int = 5,
+            rerank_batch_size: int = 32,
+            score_cache: LRUCache | None = RERANK_SCORE_CACHE,
+            answer_cache: SemanticCache | None = None,
+            parent_cache: LRUCache | None = PARENT_DOC_CACHE,
+            max_context_tokens: int = 10000
         ):
         """
         Initialize the RAG (Retrieval Augmented Generation) class.
@@ -25,14 +49,28 @@ class RAG:
             top_n (int): The number of top documents to retrieve to pass to the reranker.
             top_k (int): The number of top documents to return after reranking for context.
             reranker (FlagReranker): An instance of the FlagReranker class.
+            rerank_batch_size (int): The number of (query, passage) pairs scored per reranker forward pass.
+            score_cache (LRUCache | None): Cache of reranker scores. Pass None to disable caching.
+            answer_cache (SemanticCache | None): Cache of formatted results for similar questions.
+            parent_cache (LRUCache | None): Cache of parent documents. Pass None to disable caching.
+            max_context_tokens (int): Token budget of the formatted documents.
         """
         self.db = db
         self.top_k = top_k
         self.top_n = top_n
         self.embedding_model = embedding_model
         self.reranker = reranker
+        self.rerank_batch_size = rerank_batch_size
+        self.score_cache = score_cache
+        self.answer_cache = answer_cache
+        self.parent_cache = parent_cache
+        self.max_context_tokens = max_context_tokens
 
-    def retrieve(self, query_text: str, school_name: str = None) -> List[Dict[str, Any]]:
+    def retrieve(
+            self,
+            query_text: str,
+            school_name: str = None,
+            query_vector: np.ndarray | None = None) -> List[Dict[str, Any]]:
         """
         Retrieve relevant documents from the database using the query.
 
@@ -41,41 +79,111 @@ class RAG:
             school_name (str | None): The name of the school to retrieve documents for.
             doc_type (str | None): The type of document to retrieve. Only include this if the user's question is about a specific type of document.
             Valid values are 'html' or 'pdf'
+            query_vector (np.ndarray | None): The query embedding, if already computed.
         Returns:
             List[Dict[str, Any]]: A list of relevant documents with metadata.
         """
-        query_vector = self.embedding_model.embed(query_text)
+        if query_vector is None:
+            query_vector = self.embedding_model.embed(query_text)
 
         return self.db.query(
             collection_name='suny',
             query_vector=query_vector,
             university=school_name,
             limit=self.top_n,
+            query_text=query_text
         )
 
     def rerank(self, query_text, search_results):
         """
-        Rerank the search results using the given query text and query vector.
+        Rerank the search results using the given query text.
+
+        All uncached (query, passage) pairs are scored in a single batched
+        reranker call. Scores are cached on (query hash, point id, content hash)
+        so repeated questions skip the model entirely.
         """
+        query_hash = hashlib.sha256(query_text.encode('utf-8')).hexdigest()
 
-        # Compute scores for all results
-        scored_results = []
+        scores = {}
+        uncached_results = []
         for result in search_results:
-            score = self.reranker.compute_score([query_text, result.payload.get('content')], normalize=True)
-            scored_results.append((result, score))
-        
+            key = (query_hash, result.id, result.payload.get('content_hash'))
+            score = self.score_cache.get(key) if self.score_cache is not None else None
+            if score is None:
+                uncached_results.append(result)
+            else:
+                scores[result.id] = score
+
+        if uncached_results:
+            sentence_pairs = [[query_text, result.payload.get('content')] for result in uncached_results]
+            with _RERANK_LOCK:
+                new_scores = self.reranker.compute_score(
+                    sentence_pairs,
+                    batch_size=self.rerank_batch_size,
+                    normalize=True
+                )
+
+            # compute_score returns a bare float when given a single pair
+            new_scores = np.atleast_1d(new_scores)
+
+            for result, score in zip(uncached_results, new_scores):
+                scores[result.id] = float(score)
+                if self.score_cache is not None:
+                    self.score_cache.put((query_hash, result.id, result.payload.get('content_hash')), float(score))
+
         # Sort results by score in descending order
-        sorted_results = [y[0] for y in sorted(scored_results, key=lambda x: x[1], reverse=True)]
+        sorted_results = sorted(search_results, key=lambda x: scores[x.id], reverse=True)
 
         return sorted_results[:self.top_k]
 
     def run(self, query_text: str, school_name: str = None) -> str:
         """
-        Run the RAG pipeline.
+        Run the RAG pipeline, serving the answer from the answer cache when a
+        similar enough question about the same school was asked before.
         """
-        search_results = self.retrieve(query_text, school_name)
+        query_vector = self.embedding_model.embed(query_text)
+
+        if self.answer_cache is not None:
+            cached = self.answer_cache.get(query_vector, school_name)
+            if cached is not None:
+                return cached
+
+        search_results = self.retrieve(query_text, school_name, query_vector)
         reranked_results = self.rerank(query_text, search_results)
-        return self.format_documents(reranked_results)
+        formatted_documents = self.format_documents(reranked_results)
+
+        if self.answer_cache is not None:
+            self.answer_cache.put(query_vector, school_name, formatted_documents)
+
+        return formatted_documents
+
+    def get_parent_documents(self, parent_hashes: Dict[str, str | None]) -> Dict[str, Dict[str, Any]]:
+        """
+        Get parent documents, fetching every uncached one in a single request.
+
+        Args:
+            parent_hashes (Dict[str, str | None]): Mapping of the point IDs of the
+            parent documents to the content hash of the chunk that matched, so a
+            re-ingested document isn't served from the cache.
+        Returns:
+            Dict[str, Dict[str, Any]]: Mapping of point ID to the parent document.
+        """
+        parents = {}
+        missing_ids = []
+        for parent_id, content_hash in parent_hashes.items():
+            parent = self.parent_cache.get((parent_id, content_hash)) if self.parent_cache is not None else None
+            if parent is None:
+                missing_ids.append(parent_id)
+            else:
+                parents[parent_id] = parent
+
+        for parent_id, record in self.db.get_documents_by_ids(missing_ids).items():
+            parent = record.dict()
+            parents[parent_id] = parent
+            if self.parent_cache is not None:
+                self.parent_cache.put((parent_id, parent['payload'].get('content_hash')), parent)
+
+        return parents
 
     def format_documents(self, documents) -> str:
         """
@@ -90,27 +198,43 @@ class RAG:
                 doc_ids.append(doc['payload']['parent_point_id'])
                 filtered_docs.append(doc)
 
+        # Matches that were chunks are replaced by their full parent document.
+        # In the case of HTML, the parent document is the whole webpage.
+        # In the case of PDF, the parent document is the page the chunk was taken from.
+        parents = self.get_parent_documents({
+            str(doc['payload']['parent_point_id']): doc['payload'].get('content_hash')
+            for doc in filtered_docs if 'chunk_id' in doc['payload']
+        })
+
+        encoding = tiktoken.get_encoding('o200k_base')
+
         full_content = ''
+        num_tokens = 0
         print('Doc IDs:', doc_ids)
         for doc in filtered_docs:
 
-            # Match was a chunk, get the full parent document
-            # In the case of HTML, the parent document is the whole webpage.
-            # In the case of PDF, the parent document is the page the chunk was taken from.
             if 'chunk_id' in doc['payload']:
-                doc = self.db.get_document_by_id(doc['payload']['parent_point_id']).dict()
+                parent_id = str(doc['payload']['parent_point_id'])
+                if parent_id not in parents:
+                    print('WARNING: Parent document', parent_id, 'not found')
+                    continue
+                doc = parents[parent_id]
 
             content = 'University: ' + doc['payload']['university'] + '\n'
             content += 'URL: ' + str(doc['payload']['url']) + '\n'
             content += 'Content: ' + doc['payload']['content'] + '\n\n'
 
-            temp_full_content = full_content + content
-
-            num_tokens = count_tokens(temp_full_content)
+            # Each document is tokenized once and the counts are summed
+            tokens = encoding.encode(content)
 
-            if num_tokens > 10000:
+            if num_tokens + len(tokens) > self.max_context_tokens:
+                # Keep as much of the document as fits, cut at a token boundary
+                remaining = self.max_context_tokens - num_tokens
+                if remaining > 0:
+                    full_content += encoding.decode(tokens[:remaining]).rstrip('\ufffd')
                 break
 
-            full_content = temp_full_content
+            full_content += content
+            num_tokens += len(tokens)
 
         return full_content
@@ -9,7 +9,9 @@ import json
 import time
 import logging
 
-from typing import Callable
+from typing import Callable, Iterable
+from itertools import chain
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import streamlit as st
 
@@ -26,6 +28,10 @@ opj = os.path.join
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# Conversation rows are written by a single background thread so they stay in
+# order without the async engine waiting on SQLite
+LOG_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log_message')
+
 
 def type_text(text, char_speed=0.03, sentence_pause=0.5):
     placeholder = st.empty()
@@ -114,13 +120,58 @@ def log_message(user_id: int, session_id: int, chat_id: int, message: Message, a
     conn.commit()
 
 
+def _check_log_result(future: Future) -> None:
+    if future.exception() is not None:
+        print('Exception:', future.exception())
+
+
+def submit_log_message(user: User | None, chat_id: int, message: Message, agent_name: str) -> Future | None:
+    """
+    Log a message to the database in the background.
+
+    Args:
+        user (User): The user, or None to skip logging.
+        chat_id (int): The ID of the chat.
+        message (Message): The message to log.
+        agent_name (str): The name of the agent that sent the message.
+    Returns:
+        Future | None: The pending write, or None if there is no user.
+    """
+    if user is None:
+        return None
+    future = LOG_EXECUTOR.submit(log_message, user.user_id, user.session_id, chat_id, message, agent_name)
+    future.add_done_callback(_check_log_result)
+    return future
+
+
+def write_stream(chat_fn: Callable, deltas: Iterable[str]) -> None:
+    """
+    Write streamed text to a new assistant chat message.
+
+    The message is only created once the first piece of text arrives, so a
+    response made up only of tool calls doesn't leave an empty message behind.
+
+    Args:
+        chat_fn (Callable): The chat function
+        deltas (Iterable[str]): The streamed text
+    Returns:
+        None
+    """
+    deltas = iter(deltas)
+    first = next(deltas, None)
+    if first is None:
+        return
+    chat_fn('assistant').write_stream(chain([first], deltas))
+
+
 def process_user_input(
         counselor_agent: Agent,
         suny_agent: Agent,
         user: User | None,
         chat_fn: Callable | None,
         prompt: str,
-        chat_id: int | None
+        chat_id: int | None,
+        stream: bool = False
 ) -> None:
     """
     Process the user input and send it to the counselor agent
@@ -131,6 +182,8 @@ def process_user_input(
         user (User): The user
         chat_fn (Callable): The chat function
         prompt (str): The prompt from the user
+        chat_id (int): The ID of the chat
+        stream (bool): Stream responses to chat_fn as they are generated
     Returns:
         None
     """
@@ -153,7 +206,11 @@ def process_user_input(
             agent_name='counselor'
         )
     counselor_agent.add_message(message)
-    counselor_response = counselor_agent.invoke()
+    counselor_response = counselor_agent.invoke(stream=stream)
+
+    if stream and chat_fn is not None:
+        # Only shows anything when the counselor is replying to the student
+        write_stream(chat_fn, utils.stream_json_message(counselor_response))
 
     counselor_response_str = counselor_response.choices[0].message.content
     counselor_response_json = utils.parse_json(counselor_response_str)
@@ -185,14 +242,21 @@ def process_user_input(
             chat_fn('assistant').write('Contacting SUNY Agent...')
 
         suny_agent.add_message(message)
-        suny_response = suny_agent.invoke()
+        suny_response = suny_agent.invoke(stream=stream)
+
+        if stream and chat_fn is not None:
+            write_stream(chat_fn, suny_response)
 
         if suny_response.choices[0].message.tool_calls:
             _, suny_response, tc_messages = suny_agent.handle_tool_call(
                 suny_response,
-                chat_id=chat_id
+                chat_id=chat_id,
+                stream=stream
             )
 
+            if stream and chat_fn is not None:
+                write_stream(chat_fn, suny_response)
+
             if user is not None:
                 for tcm in tc_messages:
                     log_message(
@@ -247,6 +311,97 @@ def process_user_input(
         )
 
 
+async def aprocess_user_input(
+        counselor_agent: Agent,
+        suny_agent: Agent,
+        user: User | None,
+        prompt: str,
+        chat_id: int | None
+) -> str:
+    """
+    Async version of process_user_input. Model calls use the async OpenAI
+    client, tools run in an executor and messages are logged in the background,
+    so one event loop can serve many sessions at once.
+
+    Args:
+        counselor_agent (Agent): The counselor agent
+        suny_agent (Agent): The suny agent
+        user (User): The user
+        prompt (str): The prompt from the user
+        chat_id (int): The ID of the chat
+    Returns:
+        str: The counselor's response to the student
+    """
+
+    message = Message(
+        sender="student",
+        recipient="counselor",
+        role="user",
+        message=prompt,
+        chat_id=chat_id
+    )
+    submit_log_message(user, chat_id, message, 'counselor')
+    counselor_agent.add_message(message)
+
+    counselor_response = await counselor_agent.ainvoke()
+
+    counselor_response_str = counselor_response.choices[0].message.content
+    counselor_response_json = utils.parse_json(counselor_response_str)
+
+    recipient = counselor_response_json.get("recipient")
+    phase = counselor_response_json.get("phase")
+
+    if recipient.lower() == "suny":
+
+        message = Message(
+            sender="counselor",
+            recipient="suny",
+            role="user",
+            message=counselor_response_str,
+            chat_id=chat_id
+        )
+        submit_log_message(user, chat_id, message, 'suny')
+        suny_agent.add_message(message)
+
+        suny_response = await suny_agent.ainvoke()
+
+        if suny_response.choices[0].message.tool_calls:
+            _, suny_response, tc_messages = await suny_agent.ahandle_tool_call(
+                suny_response,
+                chat_id=chat_id
+            )
+            for tcm in tc_messages:
+                submit_log_message(user, chat_id, tcm, 'suny')
+
+        message = Message(
+            sender="suny",
+            recipient="counselor",
+            role="assistant",
+            message=suny_response.choices[0].message.content,
+            chat_id=chat_id
+        )
+        suny_agent.add_message(message)
+        submit_log_message(user, chat_id, message, 'suny')
+
+        counselor_response_str = json.dumps({
+            'phase': phase,
+            'recipient': 'student',
+            'message': suny_response.choices[0].message.content
+        })
+
+    message = Message(
+        sender="counselor",
+        recipient="student",
+        role="assistant",
+        message=counselor_response_str,
+        chat_id=chat_id
+    )
+    counselor_agent.add_message(message)
+    submit_log_message(user, chat_id, message, 'counselor')
+
+    return utils.extract_content_from_message(counselor_response_str)
+
+
 def summarize_chat():
     """
     Summarize the chat and add it to the database
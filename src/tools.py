@@ -1,14 +1,19 @@
 """
 """
 import os
+import threading
 
 from functools import lru_cache
 
 from src.rag import RAG
+from src.answer_cache import ANSWER_CACHE
 from src.database import qdrant_db
 
 opj = os.path.join
 
+# Tool calls can run concurrently, so make sure the models are only loaded once
+_LOAD_LOCK = threading.Lock()
+
 suny_tools = [
     {
         "type": "function",
@@ -39,9 +44,12 @@ suny_tools = [
 def get_db_and_reranker():
     model = 'jina'
     embedding_model = qdrant_db.get_embedding_model(model)
-    client_qdrant = qdrant_db.get_remote_qdrant_client()
+    client_qdrant = qdrant_db.get_qdrant_client()
     db = qdrant_db.get_qdrant_db(client_qdrant, 'suny', embedding_model.emb_dim)
     reranker = qdrant_db.get_reranker()
+
+    # Cached answers are dropped when the ingest job re-inserts a university
+    ANSWER_CACHE.ingest_markers = db.get_ingest_markers
     return db, embedding_model, reranker
 
 
@@ -59,10 +67,19 @@ def retrieve_content_from_question(
         str: The formatted documents.
     """
 
-    db, embedding_model, reranker = get_db_and_reranker()
+    with _LOAD_LOCK:
+        db, embedding_model, reranker = get_db_and_reranker()
 
     # Initialize the RAG instance
-    rag = RAG(db=db, top_n=30, top_k=5, embedding_model=embedding_model, reranker=reranker)
+    # Hybrid search finds exact matches like course codes in far fewer candidates
+    rag = RAG(
+        db=db,
+        top_n=15 if db.hybrid else 30,
+        top_k=5,
+        embedding_model=embedding_model,
+        reranker=reranker,
+        answer_cache=ANSWER_CACHE
+    )
 
     return rag.run(question, school_name)
 
@@ -0,0 +1,287 @@
+"""
+Resolve the web URL of crawled HTML files.
+
+Files come from `wget --adjust-extension`, so the original URL of a file is
+ambiguous (page.html may have been /page or /page.html). Every plausible
+variant is probed concurrently over a pooled session, and the answers are
+recorded in an on-disk cache so later runs don't touch the network again.
+"""
+import os
+import json
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+
+from src.constants import URL_CACHE_PATH
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+
+# Status codes servers return when they don't support HEAD, retried with GET
+HEAD_NOT_ALLOWED = {403, 405, 501}
+
+# Rate limited requests are retried this many times, waiting Retry-After seconds
+# or an exponential backoff, but never longer than MAX_RETRY_DELAY
+MAX_RATE_LIMIT_RETRIES = 3
+MAX_RETRY_DELAY = 60.0
+
+
+class URLCache:
+    """
+    JSON file mapping the base URL of a file to its resolved URL, or None when
+    no variant exists.
+    """
+    def __init__(self, path: str = URL_CACHE_PATH):
+        """
+        Args:
+            path (str): The cache file. Created on the first save.
+        """
+        self.path = path
+        self._urls = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._urls = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self._urls)
+
+    def __contains__(self, base_url: str) -> bool:
+        return base_url in self._urls
+
+    def get(self, base_url: str) -> str | None:
+        return self._urls.get(base_url)
+
+    def put(self, base_url: str, url: str | None) -> None:
+        with self._lock:
+            self._urls[base_url] = url
+
+    def save(self) -> None:
+        """
+        Write the cache, replacing the file in one step so a crash can't leave it truncated.
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self._urls, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+def _get_relative_path(university_name: str, file_path: str) -> str:
+    """
+    Get the crawled host and path of a file, e.g. 'www.alfredstate.edu/admissions/index.html'.
+    """
+    relative_path = file_path.split(university_name)[1].replace('\\', '/')
+    return relative_path.lstrip('/')
+
+
+def get_base_url(university_name: str, file_path: str) -> str:
+    """
+    Get the URL of an HTML file with the .html added by wget removed.
+
+    Args:
+        university_name (str): Name of the university.
+        file_path (str): The local path to the HTML file.
+    Returns:
+        str: The base URL.
+    """
+    return 'https://' + _get_relative_path(university_name, file_path).replace('.html', '')
+
+
+def get_url_variants(base_url: str) -> list[str]:
+    """
+    Get the URLs a file may have been downloaded from, most likely first.
+
+    Args:
+        base_url (str): The URL returned by get_base_url.
+    Returns:
+        list[str]: The distinct URL variants.
+    """
+    variants = [
+        base_url.removesuffix('/index') + '/',
+        base_url,
+        base_url + '.html',
+        base_url + '/index.html',
+        base_url + '/index.php',
+        base_url + '/index.php.html',
+        base_url.removesuffix('/index'),
+        base_url + '.cfm'
+    ]
+    return list(dict.fromkeys(variants))
+
+
+def get_local_url(university_name: str, file_path: str) -> str:
+    """
+    Derive the URL of an HTML file from the wget crawl layout without any requests.
+
+    index.html files map to their directory, and the .html that wget appended
+    to pages (including ones with another extension such as .php) is removed.
+
+    Args:
+        university_name (str): Name of the university.
+        file_path (str): The local path to the HTML file.
+    Returns:
+        str: The most likely URL.
+    """
+    relative_path = _get_relative_path(university_name, file_path)
+
+    if relative_path == 'index.html' or relative_path.endswith('/index.html'):
+        relative_path = relative_path.removesuffix('index.html')
+    elif relative_path.endswith('.html'):
+        relative_path = relative_path.removesuffix('.html')
+
+    return 'https://' + relative_path
+
+
+def get_session(max_connections: int = 16) -> requests.Session:
+    """
+    Get a session that keeps up to `max_connections` connections open per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(HEADERS)
+    return session
+
+
+def get_retry_delay(response, attempt: int) -> float:
+    """
+    Get how long to wait before retrying a rate limited request, from its
+    Retry-After header if it gives a number of seconds.
+    """
+    retry_after = (getattr(response, 'headers', None) or {}).get('Retry-After')
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 2.0 ** attempt
+    return min(max(delay, 0.0), MAX_RETRY_DELAY)
+
+
+def check_url(
+        session: requests.Session,
+        url: str,
+        headers: dict,
+        timeout: float = 10.0,
+        max_retries: int = MAX_RATE_LIMIT_RETRIES) -> int:
+    """
+    Get the status code of a URL with HEAD, falling back to GET, and backing off while rate limited.
+
+    Args:
+        session (requests.Session): Session to send the requests with.
+        url (str): The URL to check.
+        headers (dict): Extra request headers.
+        timeout (float): Seconds to wait for each request.
+        max_retries (int): Number of retries after a 429 response.
+    Returns:
+        int: The final status code.
+    """
+    for attempt in range(max_retries + 1):
+        response = session.head(url, headers=headers, timeout=timeout, allow_redirects=True)
+        if response.status_code in HEAD_NOT_ALLOWED:
+            response = session.get(url, headers=headers, timeout=timeout, stream=True)
+            response.close()
+        if response.status_code != 429 or attempt == max_retries:
+            return response.status_code
+        time.sleep(get_retry_delay(response, attempt))
+
+
+def resolve_url(session: requests.Session, base_url: str, timeout: float = 10.0) -> tuple[str | None, bool]:
+    """
+    Find the first URL variant that exists, checking each with HEAD before falling back to GET.
+
+    Args:
+        session (requests.Session): Session to send the requests with.
+        base_url (str): The URL returned by get_base_url.
+        timeout (float): Seconds to wait for each request.
+    Returns:
+        tuple[str | None, bool]: The URL or None, and whether the answer can be
+        cached. It can't when a request failed or the server was rate limiting
+        or erroring (429 or 5xx), since the URL may exist.
+    """
+    headers = {'Referer': base_url}
+    failed = False
+    for variant in get_url_variants(base_url):
+        try:
+            status_code = check_url(session, variant, headers, timeout)
+        except requests.RequestException as e:
+            print('WARNING: Failed to get variant', variant)
+            print('Exception:', e)
+            failed = True
+            continue
+        if status_code == 200:
+            return variant, True
+        if status_code == 429 or status_code >= 500:
+            print(f'WARNING: Got status {status_code} for variant', variant)
+            failed = True
+    return None, not failed
+
+
+def resolve_urls(
+        university_name: str,
+        file_paths: list[str],
+        cache: URLCache | None = None,
+        local_only: bool = False,
+        max_workers: int = 16,
+        timeout: float = 10.0,
+        save_every: int = 500) -> dict:
+    """
+    Resolve the URL of several HTML files, probing uncached files concurrently.
+
+    Args:
+        university_name (str): Name of the university.
+        file_paths (list[str]): The local paths to the HTML files.
+        cache (URLCache | None): Cache of earlier answers, updated and saved. Pass
+        None to always probe.
+        local_only (bool): Derive URLs with get_local_url instead of probing.
+        max_workers (int): Maximum number of requests in flight.
+        timeout (float): Seconds to wait for each request.
+        save_every (int): Save the cache after this many resolved URLs.
+    Returns:
+        dict: Mapping of file path to its URL, or None when no variant exists.
+    """
+    if local_only:
+        return {path: get_local_url(university_name, path) for path in file_paths}
+
+    urls = {}
+    pending = {}
+    for path in file_paths:
+        base_url = get_base_url(university_name, path)
+        if cache is not None and base_url in cache:
+            urls[path] = cache.get(base_url)
+        else:
+            pending.setdefault(base_url, []).append(path)
+
+    if not pending:
+        return urls
+
+    session = get_session(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(resolve_url, session, base_url, timeout): base_url
+            for base_url in pending
+        }
+        for i, future in enumerate(tqdm(as_completed(futures), total=len(futures), desc='Resolving URLs')):
+            base_url = futures[future]
+            url, cacheable = future.result()
+            for path in pending[base_url]:
+                urls[path] = url
+
+            if cache is not None and cacheable:
+                cache.put(base_url, url)
+                if (i + 1) % save_every == 0:
+                    cache.save()
+    session.close()
+
+    if cache is not None:
+        cache.save()
+
+    return urls
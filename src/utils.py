@@ -3,16 +3,20 @@
 import os
 import re
 import json
-import tempfile
+import hashlib
+import threading
 import subprocess
 
+from bisect import bisect_right
+from itertools import accumulate
+from collections import Counter, OrderedDict
 from functools import lru_cache
 
 import requests
 import tiktoken
 
-from bs4 import BeautifulSoup
-from openai import OpenAI
+from lxml import etree
+from openai import AsyncOpenAI, OpenAI
 
 opj = os.path.join
 
@@ -63,6 +67,14 @@ def count_tokens(
     return len(encoding.encode(text))
 
 
+@lru_cache(maxsize=None)
+def get_encoding_for_model(model: str) -> tiktoken.Encoding:
+    """
+    Get the tiktoken encoding for the model, loading it only once per model.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
 def get_cost(input_text: str, output_text: str, model: str) -> float:
     """
     Get the cost of the input and output text.
@@ -100,11 +112,72 @@ def get_embedding_cost(num_tokens: int, model: str) -> float:
     return (num_tokens / 1_000_000) * cost_per_million_tokens
 
 
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a fixed maximum size.
+
+    Used where functools.lru_cache doesn't fit, e.g. when values are filled
+    in batches or the same cache is shared between objects.
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Get the value for the key and mark it as recently used.
+
+        Args:
+            key (Hashable): The key to look up.
+            default (Any): The value to return if the key is missing.
+        Returns:
+            Any: The cached value or default.
+        """
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value) -> None:
+        """
+        Add a value to the cache, evicting the least recently used entry if full.
+
+        Args:
+            key (Hashable): The key to store.
+            value (Any): The value to store.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
 @lru_cache(maxsize=None)
 def get_openai_client():
     return OpenAI(api_key=os.getenv("PATHFINDER_OPENAI_API_KEY"))
 
 
+@lru_cache(maxsize=None)
+def get_async_openai_client():
+    # Shared so every session reuses the same connection pool
+    return AsyncOpenAI(api_key=os.getenv("PATHFINDER_OPENAI_API_KEY"))
+
+
 def get_color(name: str):
     if name.lower() == "user":
         return BLUE
@@ -115,34 +188,215 @@ def get_color(name: str):
     return ""
 
 
-def get_text_from_html(path_or_url: str) -> str:
+# Elements whose text is never part of the page content
+HTML_SKIP_TAGS = {'script', 'style', 'noscript', 'template', 'nav', 'footer'}
+HTML_SKIP_ROLES = {'navigation': 'nav', 'contentinfo': 'footer'}
+
+# Elements never allowed inside a nav or footer, so one arriving while skipping
+# means the nav or footer was left open
+HTML_SKIP_ENDED_BY = {'main'}
+
+# Where the page content most likely starts inside a nav or footer that was left
+# open. libxml2 doesn't close unknown HTML5 elements, so one left open runs to the
+# end of the page, and the text from here on is kept when its end tag is missing.
+HTML_SKIP_RESUME_AT = {
+    'nav': {'main', 'article', 'h1', 'p'},
+    'footer': {'main', 'article', 'h1'}
+}
+
+# End tags in the HTML source, counted to tell closed elements from ones left open
+HTML_END_TAG_PATTERN = re.compile(r'</([a-zA-Z][a-zA-Z0-9]*)')
+
+# Elements that end a line of text
+HTML_BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt',
+    'figcaption', 'figure', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header',
+    'hr', 'li', 'main', 'ol', 'p', 'pre', 'section', 'table', 'td', 'th', 'title',
+    'tr', 'ul'
+}
+
+HTML_HEADER_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+
+class _HTMLCollector:
     """
-    Get the text from the HTML file or URL.
+    Parser target that collects the text and metadata of a page as it is parsed,
+    without building a tree.
     """
+    def __init__(self):
+        self.parts = []
+        self.skip_depth = 0
+        self.skip_tag = None
+        self.skip_element = None
+        self.skipped = []  # Events inside the skipped element, replayed if it was left open
+        self.resume_at = None
+        self.pending = False  # The skipped element just ended, maybe because the page did
+        self.opened = Counter()
+        self.closed_in_source = Counter()
+        self.title = []
+        self.in_title = False
+        self.header_tag = None
+        self.header_parts = []
+        self.metadata = {'title': '', 'description': '', 'keywords': '', 'headers': {}, 'language': ''}
+
+    def _settle(self, page_ended: bool):
+        """
+        Drop the events of the element that was just skipped, or replay them from
+        resume_at if it only ended because the page did and its end tag is missing.
+        """
+        self.pending = False
+        left_open = self.closed_in_source[self.skip_element] < self.opened[self.skip_element]
+        if page_ended and left_open and self.resume_at is not None:
+            self._resume()
+        else:
+            self.skipped = []
+            self.resume_at = None
+
+    def _resume(self):
+        events = self.skipped[self.resume_at:]
+        self.skip_depth = 0
+        self.skipped = []
+        self.resume_at = None
+        for name, *args in events:
+            getattr(self, name)(*args)
+
+    def start(self, tag, attrib):
+        self.opened[tag] += 1
+        self._start(tag, attrib)
+
+    def _start(self, tag, attrib):
+        if self.pending:
+            self._settle(page_ended=False)
+
+        if self.skip_depth:
+            if self.skip_tag not in HTML_SKIP_RESUME_AT:
+                self.skip_depth += 1
+                return
+            self.skipped.append(('_start', tag, dict(attrib)))
+            if self.resume_at is None and tag in HTML_SKIP_RESUME_AT[self.skip_tag]:
+                self.resume_at = len(self.skipped) - 1
+            if tag in HTML_SKIP_ENDED_BY:
+                self._resume()
+            else:
+                self.skip_depth += 1
+            return
+
+        if tag in HTML_SKIP_TAGS or attrib.get('role') in HTML_SKIP_ROLES:
+            self.skip_depth = 1
+            self.skip_tag = HTML_SKIP_ROLES.get(attrib.get('role'), tag)
+            self.skip_element = tag
+            return
+
+        if tag == 'html':
+            self.metadata['language'] = attrib.get('lang', '')
+        elif tag == 'title':
+            self.in_title = True
+        elif tag == 'meta' and attrib.get('name', '').lower() in ('description', 'keywords'):
+            self.metadata[attrib['name'].lower()] = attrib.get('content', '').strip()
+        elif tag in HTML_HEADER_TAGS and self.header_tag is None:
+            self.header_tag = tag
+            self.header_parts = []
+
+    def end(self, tag):
+        if self.pending:
+            self._settle(page_ended=tag in ('body', 'html'))
+
+        if self.skip_depth:
+            self.skip_depth -= 1
+            if self.skip_tag not in HTML_SKIP_RESUME_AT:
+                return
+            if self.skip_depth:
+                self.skipped.append(('end', tag))
+            else:
+                self.pending = True
+            return
+
+        if tag == 'title':
+            self.in_title = False
+        elif tag == self.header_tag:
+            header = ' '.join(''.join(self.header_parts).split())
+            if header:
+                self.metadata['headers'].setdefault(tag, []).append(header)
+            self.header_tag = None
+
+        if tag in HTML_BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def data(self, data):
+        if self.pending:
+            self._settle(page_ended=False)
+
+        if self.skip_depth:
+            if self.skip_tag in HTML_SKIP_RESUME_AT:
+                self.skipped.append(('data', data))
+            return
+        self.parts.append(data)
+        if self.in_title:
+            self.title.append(data)
+        if self.header_tag is not None:
+            self.header_parts.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        if self.pending:
+            self._settle(page_ended=True)
+        text = re.sub(r'[^\S\n]+\n', '\n', ''.join(self.parts))
+        self.metadata['title'] = ''.join(self.title).strip().replace('\xa0', ' ')
+        return {'text': re.sub(r'\n{3,}', '\n\n', text).strip(), **self.metadata}
+
+
+def extract_html(path_or_url: str, block_size: int = 1 << 16) -> dict:
+    """
+    Extract the text and metadata of an HTML file or URL in a single streaming pass.
 
-    if path_or_url.startswith('http'):
+    Scripts, styles, navigation and footers are left out of the text. A nav or
+    footer whose end tag is missing is cut short where the page content most
+    likely starts, instead of hiding the rest of the page.
 
-        # It's a URL, download it to a temp file
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.html') as temp_file:
-            response = requests.get(path_or_url)
-            temp_file.write(response.text)
-            temp_path = temp_file.name
+    Args:
+        path_or_url (str): Path to the HTML file, or a URL to download.
+        block_size (int): Number of characters fed to the parser at a time.
+    Returns:
+        dict: The 'text' of the page, its 'title', 'description', 'keywords',
+        'headers' (mapping 'h1' to 'h6' to their text) and 'language'.
+    """
+    collector = _HTMLCollector()
+    parser = etree.HTMLParser(target=collector, remove_comments=True)
 
-        with open(temp_path, 'r') as f:
-            soup = BeautifulSoup(f, 'lxml')
+    def feed(text):
+        collector.closed_in_source.update(x.lower() for x in HTML_END_TAG_PATTERN.findall(text))
+        parser.feed(text)
 
-        # Clean up the temp file
-        os.unlink(temp_path)
+    if path_or_url.startswith('http'):
+        feed(requests.get(path_or_url).text)
     else:
-        # It's a local file path
-        with open(path_or_url, 'r') as f:
-            soup = BeautifulSoup(f, 'lxml')
+        with open(path_or_url, 'r', encoding='utf-8', errors='replace') as f:
+            # Blocks are cut after the last '<' so no end tag is split between two
+            rest = ''
+            for block in iter(lambda: f.read(block_size), ''):
+                block = rest + block
+                cut = block.rfind('<')
+                if cut == -1 or '>' in block[cut:]:
+                    cut = len(block)
+                feed(block[:cut])
+                rest = block[cut:]
+            if rest:
+                feed(rest)
+
+    try:
+        return parser.close()
+    except etree.XMLSyntaxError:
+        # Empty documents have no root element
+        return collector.close()
 
-    # Remove all <script> tags
-    for script in soup(["script"]):
-        script.extract()
 
-    return re.sub(r'\n{3,}', '\n\n', soup.get_text()).strip()
+def get_text_from_html(path_or_url: str) -> str:
+    """
+    Get the text from the HTML file or URL.
+    """
+    return extract_html(path_or_url)['text']
 
 
 def chunk_pages(
@@ -153,6 +407,10 @@ def chunk_pages(
     Split pages into chunks with a specified overlap size, including across pages,
     while preserving formatting.
 
+    The text is split into word and whitespace tokens once, and prefix sums of
+    word counts let each chunk boundary, word offset and page number be found
+    directly, so large documents are chunked in a single linear pass.
+
     Args:
         pages (list[str]): A list of strings, each containing text from a page.
         chunk_size (int): The target size of each chunk in words. Defaults to 500.
@@ -161,46 +419,73 @@ def chunk_pages(
     Returns:
         list[dict]: A list of dictionaries, each containing the chunk text and metadata.
     """
-    chunks = []
-    all_tokens = []
+    # Character offset of every token, whether it is a word, and the number of
+    # words before it. Tokens never span pages.
+    token_starts = []
+    is_word = []
     page_boundaries = [0]
-
+    offset = 0
     for page in pages:
-        tokens = re.findall(r'\S+|\s+', page)
-        all_tokens.extend(tokens)
-        page_boundaries.append(page_boundaries[-1] + len(tokens))
+        for match in re.finditer(r'\S+|\s+', page):
+            token_starts.append(offset + match.start())
+            is_word.append(not match.group(0).isspace())
+        offset += len(page)
+        page_boundaries.append(len(token_starts))
 
-    word_count = 0
-    chunk_start = 0
+    num_tokens = len(token_starts)
+    if num_tokens == 0:
+        return []
 
-    for i, token in enumerate(all_tokens):
-        if not token.isspace():
-            word_count += 1
-
-        if word_count == chunk_size or i == len(all_tokens) - 1:
-            chunk_text = ''.join(all_tokens[chunk_start:i+1])
-
-            start_page = next(idx for idx, boundary in enumerate(page_boundaries) if boundary > chunk_start) - 1
-            end_page = next(idx for idx, boundary in enumerate(page_boundaries) if boundary > i) - 1
-
-            chunk_info = {
-                "text": chunk_text,
-                "metadata": {
-                    "chunk_id": len(chunks),
-                    "start_word": sum(1 for t in all_tokens[:chunk_start] if not t.isspace()),
-                    "end_word": sum(1 for t in all_tokens[:i+1] if not t.isspace()) - 1,
-                    "word_count": sum(1 for t in all_tokens[chunk_start:i+1] if not t.isspace()),
-                    "start_page": start_page + 1,
-                    "end_page": end_page + 1
-                }
-            }
-            chunks.append(chunk_info)
+    text = ''.join(pages)
+    token_starts.append(len(text))
 
-            # Move back by overlap_size words for the next chunk
-            while word_count > overlap_size and chunk_start < i:
-                if not all_tokens[chunk_start].isspace():
-                    word_count -= 1
-                chunk_start += 1
+    words_before = list(accumulate(is_word, initial=0))
+    word_tokens = [idx for idx, word in enumerate(is_word) if word]
+    last = num_tokens - 1
+
+    chunks = []
+    chunk_start = 0
+    word_count = 0
+    i = 0  # Next token to read
+    while i <= last:
+
+        # Find the token that completes the chunk, or the last token
+        needed = chunk_size - word_count
+        if needed > 0:
+            target = words_before[i] + needed - 1
+            end = word_tokens[target] if target < len(word_tokens) else last
+        elif needed == 0 and not is_word[i]:
+            end = i
+        else:
+            end = last
+        word_count += words_before[end + 1] - words_before[i]
+
+        start_word = words_before[chunk_start]
+        chunks.append({
+            "text": text[token_starts[chunk_start]:token_starts[end + 1]],
+            "metadata": {
+                "chunk_id": len(chunks),
+                "start_word": start_word,
+                "end_word": words_before[end + 1] - 1,
+                "word_count": words_before[end + 1] - start_word,
+                "start_page": bisect_right(page_boundaries, chunk_start),
+                "end_page": bisect_right(page_boundaries, end)
+            }
+        })
+
+        # Move forward so only overlap_size words are kept for the next chunk,
+        # without moving past the end of this chunk
+        to_drop = word_count - overlap_size
+        if to_drop > 0:
+            drop_word = start_word + to_drop - 1
+            if drop_word < words_before[end + 1] and word_tokens[drop_word] < end:
+                chunk_start = word_tokens[drop_word] + 1
+                word_count = overlap_size
+            elif chunk_start < end:
+                chunk_start = end
+                word_count = int(is_word[end])
+
+        i = end + 1
 
     # If the last chunk is too small, merge it with the previous one
     if len(chunks) > 1 and chunks[-1]["metadata"]["word_count"] < chunk_size // 2:
@@ -217,6 +502,9 @@ def chunk_text(text, chunk_size=512, overlap_size=128):
     """
     Split text into chunks with a specified overlap size while preserving formatting.
 
+    Chunk boundaries are found from the character offsets of the words, so the
+    text is only scanned once.
+
     Args:
         text (str): The input text to be chunked.
         chunk_size (int): The target size of each chunk in words.
@@ -225,50 +513,162 @@ def chunk_text(text, chunk_size=512, overlap_size=128):
     Returns:
         list[str]: A list of chunked text strings.
     """
-    # Use regex to split text into words and whitespace, keeping track of their types
-    pattern = re.compile(r'(\S+|\s+)')  # Matches words and whitespace separately
-    tokens = []
-    for match in pattern.finditer(text):
-        token = match.group(0)
-        if token.strip():
-            token_type = 'word'
-        else:
-            token_type = 'whitespace'
-        tokens.append({'text': token, 'type': token_type})
+    if chunk_size < 1 or overlap_size >= chunk_size:
+        raise ValueError('chunk_size must be positive and larger than overlap_size')
+
+    if not text:
+        return []
+
+    word_starts = []
+    word_ends = []
+    for match in re.finditer(r'\S+', text):
+        word_starts.append(match.start())
+        word_ends.append(match.end())
+    num_words = len(word_starts)
 
     chunks = []
-    total_tokens = len(tokens)
-    i = 0  # Start index for each chunk
-
-    while i < total_tokens:
-        chunk_tokens = []
-        word_count = 0
-        j = i  # Current index within the tokens
-
-        # Build the chunk until we reach the desired word count
-        while j < total_tokens and word_count < chunk_size:
-            chunk_tokens.append(tokens[j]['text'])
-            if tokens[j]['type'] == 'word':
-                word_count += 1
-            j += 1
-
-        # Combine the tokens to form the chunk text
-        chunk_text_str = ''.join(chunk_tokens)
-        chunks.append(chunk_text_str)
-
-        if j >= total_tokens:
-            break  # Reached the end of the tokens
-
-        # Calculate the start index for the next chunk with overlap
-        # We need to start overlap_size words back from the end of the current chunk
-        words_to_rewind = overlap_size
-        k = j - 1  # Last token index in the current chunk
-        while k >= i and words_to_rewind > 0:
-            if tokens[k]['type'] == 'word':
-                words_to_rewind -= 1
-            k -= 1
-        i = k + 1  # Start index for the next chunk
+    start = 0        # Character offset of the chunk
+    first_word = 0   # Index of the first word at or after start
+
+    while True:
+        last_word = first_word + chunk_size - 1
+        end = word_ends[last_word] if last_word < num_words else len(text)
+        chunks.append(text[start:end])
 
+        if end == len(text):
+            break  # Reached the end of the text
+
+        # Start overlap_size words back from the end of the current chunk
+        if overlap_size > 0:
+            first_word = last_word - overlap_size + 1
+            start = word_starts[first_word]
+        else:
+            first_word = last_word + 1
+            start = end
+
+    return chunks
+
+
+def _token_chunk_spans(
+        text: str,
+        tokenizer,
+        chunk_size: int,
+        overlap_size: int,
+        split_on_boundaries: bool) -> list[tuple[int, int, int, int]]:
+    """
+    Find chunks of at most chunk_size tokens of the text, tokenized once.
+
+    Chunks end at a word start so no word is split across chunks. With
+    split_on_boundaries, a chunk ends at the last sentence end, line break or
+    heading in the second half of its window if there is one.
+
+    Returns:
+        list[tuple[int, int, int, int]]: (start char, end char, start token, end token) of each chunk.
+    """
+    if chunk_size < 1 or overlap_size >= chunk_size:
+        raise ValueError('chunk_size must be positive and larger than overlap_size')
+
+    offsets = tokenizer.encode(text, add_special_tokens=False).offsets
+    num_tokens = len(offsets)
+    if num_tokens == 0:
+        return []
+
+    # Index of the last word start / boundary at or before each token
+    last_word_start = [0] * (num_tokens + 1)
+    last_boundary = [0] * (num_tokens + 1)
+    for i in range(1, num_tokens):
+        gap = text[offsets[i - 1][1]:offsets[i][0]]
+        word_start = len(gap) > 0
+        boundary = split_on_boundaries and word_start and (
+            '\n' in gap or text[offsets[i - 1][1] - 1] in '.!?'
+        )
+        last_word_start[i] = i if word_start else last_word_start[i - 1]
+        last_boundary[i] = i if boundary else last_boundary[i - 1]
+    last_word_start[num_tokens] = last_boundary[num_tokens] = num_tokens
+
+    spans = []
+    start = 0
+    while True:
+        end = min(start + chunk_size, num_tokens)
+        if end < num_tokens:
+            if last_boundary[end] > start + chunk_size // 2:
+                end = last_boundary[end]
+            elif last_word_start[end] > start:
+                end = last_word_start[end]
+
+        spans.append((offsets[start][0], offsets[end - 1][1], start, end))
+        if end == num_tokens:
+            break
+
+        # Start overlap_size tokens back, moved forward to the next word start
+        next_start = max(end - overlap_size, start + 1)
+        while next_start < end and last_word_start[next_start] != next_start:
+            next_start += 1
+        start = next_start
+
+    return spans
+
+
+def chunk_text_by_tokens(
+        text: str,
+        tokenizer,
+        chunk_size: int = 256,
+        overlap_size: int = 32,
+        split_on_boundaries: bool = True) -> list[str]:
+    """
+    Split text into chunks of at most chunk_size tokens of the given tokenizer.
+
+    Args:
+        text (str): The input text to be chunked.
+        tokenizer (tokenizers.Tokenizer): The tokenizer of the embedding model.
+        chunk_size (int): The maximum size of each chunk in tokens, not counting special tokens.
+        overlap_size (int): The number of tokens to overlap between chunks.
+        split_on_boundaries (bool): End chunks at sentence ends, line breaks or headings when possible.
+
+    Returns:
+        list[str]: A list of chunked text strings.
+    """
+    spans = _token_chunk_spans(text, tokenizer, chunk_size, overlap_size, split_on_boundaries)
+    return [text[start:end] for start, end, _, _ in spans]
+
+
+def chunk_pages_by_tokens(
+        pages: list[str],
+        tokenizer,
+        chunk_size: int = 256,
+        overlap_size: int = 32,
+        split_on_boundaries: bool = True) -> list[dict]:
+    """
+    Split pages into chunks of at most chunk_size tokens of the given tokenizer,
+    including across pages.
+
+    Args:
+        pages (list[str]): A list of strings, each containing text from a page.
+        tokenizer (tokenizers.Tokenizer): The tokenizer of the embedding model.
+        chunk_size (int): The maximum size of each chunk in tokens, not counting special tokens.
+        overlap_size (int): The number of tokens to overlap between chunks.
+        split_on_boundaries (bool): End chunks at sentence ends, line breaks or headings when possible.
+
+    Returns:
+        list[dict]: A list of dictionaries, each containing the chunk text and metadata.
+    """
+    text = ''.join(pages)
+    page_starts = list(accumulate((len(page) for page in pages), initial=0))[:-1]
+
+    chunks = []
+    for start, end, start_token, end_token in _token_chunk_spans(
+            text, tokenizer, chunk_size, overlap_size, split_on_boundaries):
+        chunks.append({
+            "text": text[start:end],
+            "metadata": {
+                "chunk_id": len(chunks),
+                "start_token": start_token,
+                "end_token": end_token - 1,
+                "token_count": end_token - start_token,
+                "start_page": bisect_right(page_starts, start),
+                "end_page": bisect_right(page_starts, end - 1)
+            }
+        })
     return chunks
 
 
@@ -284,6 +684,23 @@ def find_all_pdfs(directory: str) -> list[str]:
     return pdf_files
 
 
+def get_file_hash(file_path: str, block_size: int = 1 << 20) -> str:
+    """
+    Get the sha256 hash of a file's contents, reading it in blocks.
+
+    Args:
+        file_path (str): Path to the file.
+        block_size (int): Number of bytes read at a time.
+    Returns:
+        str: The hex digest of the file's contents.
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
 def is_file_pdf(file_path: str) -> bool:
     try:
         # Note: We're not using text=True here anymore because it can fail
@@ -376,6 +793,70 @@ def parse_json(message: str):
         return message
 
 
+def _decode_partial_json_string(raw: str) -> tuple[str, bool]:
+    """
+    Decode the body of a JSON string that may still be arriving.
+
+    Args:
+        raw (str): Text following the opening quote of a JSON string.
+    Returns:
+        tuple[str, bool]: The decoded text so far, and whether the closing quote was seen.
+    """
+    i = 0
+    while i < len(raw):
+        c = raw[i]
+        if c == '"':
+            return json.loads('"' + raw[:i] + '"'), True
+        if c == '\\':
+            # Stop before an escape sequence that hasn't fully arrived
+            length = 6 if raw[i + 1:i + 2] == 'u' else 2
+            if i + length > len(raw):
+                break
+            i += length
+            continue
+        i += 1
+    return json.loads('"' + raw[:i] + '"'), False
+
+
+def stream_json_message(deltas, recipient: str = 'student'):
+    """
+    Stream the "message" field out of a JSON response as it is generated.
+
+    Text is only yielded once the response's "recipient" field is known to
+    match `recipient`, so messages meant for another agent are never shown.
+
+    Args:
+        deltas (Iterable[str]): The streamed pieces of the JSON response.
+        recipient (str): The recipient whose messages should be streamed.
+    Yields:
+        str: New text of the "message" field.
+    """
+    buffer = ''
+    sent = 0
+    recipient_re = re.compile(r'"recipient"\s*:\s*"([^"]*)"')
+    message_re = re.compile(r'"message"\s*:\s*"')
+
+    for delta in deltas:
+        buffer += delta
+
+        match = recipient_re.search(buffer)
+        if match is None:
+            continue
+        if match.group(1).lower() != recipient:
+            return
+
+        match = message_re.search(buffer)
+        if match is None:
+            continue
+
+        text, done = _decode_partial_json_string(buffer[match.end():])
+        if len(text) > sent:
+            yield text[sent:]
+            sent = len(text)
+        if done:
+            return
+
+
 def extract_content_from_message(message: str):
     """
     Extract the content from a message.
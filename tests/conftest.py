@@ -0,0 +1,82 @@
+"""
+Shared fixtures for the unit tests.
+"""
+
+import os
+import re
+import json
+import uuid
+import zlib
+
+from typing import List
+
+import numpy as np
+import pytest
+
+from src import utils
+from src.database import qdrant_db
+
+SAMPLE_DOCS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'sample_docs.json')
+
+
+class HashingEmbeddingModel:
+    """
+    Deterministic bag-of-words embeddings, so the sample collection can be built
+    without downloading an embedding model.
+    """
+    emb_dim = 64
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.emb_dim, dtype=np.float32)
+        for word in re.findall(r'[a-z0-9]+', text.lower()):
+            vector[zlib.crc32(word.encode('utf-8')) % self.emb_dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def embed_batch(self, texts: List[str], batch_size: int = 64) -> List[np.ndarray]:
+        return [self.embed(text) for text in texts]
+
+
+@pytest.fixture
+def sample_embedding_model() -> HashingEmbeddingModel:
+    return HashingEmbeddingModel()
+
+
+@pytest.fixture
+def sample_db(sample_embedding_model) -> qdrant_db.QdrantDB:
+    """
+    A small SUNY collection in an in-memory Qdrant, built from tests/data/sample_docs.json
+    with the same parent and chunk payloads as ingestion. Point IDs are derived
+    from the URLs, so the collection is identical on every run.
+    """
+    with open(SAMPLE_DOCS_PATH, 'r') as f:
+        docs = json.load(f)
+
+    points = []
+    for doc in docs:
+        parent_point_id = str(uuid.uuid5(uuid.NAMESPACE_URL, doc['url']))
+        payload = {
+            'doc_id': doc['url'],
+            'university': doc['university'],
+            'type': doc['type'],
+            'url': doc['url'],
+            'point_id': parent_point_id,
+            'parent_point_id': parent_point_id
+        }
+        points.append((parent_point_id, {**payload, 'content': doc['content']}))
+
+        for chunk_id, chunk in enumerate(utils.chunk_text(doc['content'], chunk_size=16, overlap_size=4)):
+            chunk_point_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{doc['url']}#{chunk_id}"))
+            points.append((chunk_point_id, {
+                **payload,
+                'point_id': chunk_point_id,
+                'chunk_id': chunk_id,
+                'content': chunk
+            }))
+
+    client = qdrant_db.get_qdrant_client('memory')
+    db = qdrant_db.get_qdrant_db(client, 'suny', sample_embedding_model.emb_dim, hybrid=True)
+    db.upload_points(
+        (point_id, sample_embedding_model.embed(payload['content']), payload) for point_id, payload in points
+    )
+    return db
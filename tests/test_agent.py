@@ -2,10 +2,15 @@
 Unit tests for agent.
 """
 
+import json
+import threading
+
 import tiktoken
 
 from typing import Dict
 
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
 from src import agent
 from src import prompts
 
@@ -80,3 +85,120 @@ def test_filter_messages_token_count():
 def _blah_message(role: str, count: int) -> Dict[str, str]:
     """Create a message from repeated 'blah'. Each 'blah' uses 1 token."""
     return dict(role=role, content=' '.join(['blah'] * count))
+
+
+def test_invoke_counts_message_tokens_once(monkeypatch):
+    """
+    Test that each message is tokenized once, not on every invoke.
+    """
+
+    class _FakeCompletions:
+        def create(self, **kwargs):
+            return kwargs['messages']
+
+    class _FakeClient:
+        chat = type('chat', (), {'completions': _FakeCompletions()})()
+
+    counted = []
+    count_tokens = agent.utils.count_tokens
+
+    def _count_tokens(text, encoding):
+        counted.append(text)
+        return count_tokens(text, encoding)
+
+    monkeypatch.setattr(agent.utils, 'count_tokens', _count_tokens)
+
+    a = agent.Agent(_FakeClient(), 'counselor', None, 'You are a counselor.', 'gpt-4o')
+    a.add_message(agent.Message('student', 'counselor', 'user', 'hello', chat_id=0))
+    a.invoke()
+    a.add_message(agent.Message('counselor', 'student', 'assistant', 'hi there', chat_id=0))
+    messages = a.invoke()
+
+    assert [x['content'] for x in messages] == ['You are a counselor.', 'hello', 'hi there']
+    assert sorted(counted) == sorted(['You are a counselor.', 'hello', 'hi there'])
+
+
+def _chunk(content=None, tool_calls=None, finish_reason=None):
+    """Create a streamed chat completion chunk."""
+    return ChatCompletionChunk.model_validate({
+        'id': 'chunk',
+        'created': 0,
+        'model': 'gpt-4o',
+        'object': 'chat.completion.chunk',
+        'choices': [{
+            'index': 0,
+            'delta': {'content': content, 'tool_calls': tool_calls},
+            'finish_reason': finish_reason
+        }]
+    })
+
+
+def test_streamed_completion():
+    """
+    Test that StreamedCompletion yields content and rebuilds the full message.
+    """
+    response = agent.StreamedCompletion([_chunk('Hel'), _chunk('lo'), _chunk(finish_reason='stop')])
+    assert list(response) == ['Hel', 'lo']
+    assert response.choices[0].message.content == 'Hello'
+    assert response.choices[0].message.tool_calls is None
+
+    response = agent.StreamedCompletion([
+        _chunk(tool_calls=[{'index': 0, 'id': 'call_0', 'function': {'name': 'get_', 'arguments': '{"a"'}}]),
+        _chunk(tool_calls=[{'index': 0, 'function': {'name': 'info', 'arguments': ': 1}'}}]),
+        _chunk(tool_calls=[{'index': 1, 'id': 'call_1', 'function': {'name': 'other', 'arguments': '{}'}}]),
+        _chunk(finish_reason='tool_calls')
+    ])
+
+    # Accessing choices consumes the stream
+    tool_calls = response.choices[0].message.tool_calls
+    assert [(x.id, x.function.name, x.function.arguments) for x in tool_calls] == [
+        ('call_0', 'get_info', '{"a": 1}'),
+        ('call_1', 'other', '{}')
+    ]
+    assert response.choices[0].finish_reason == 'tool_calls'
+
+
+def test_handle_tool_call_runs_concurrently(monkeypatch):
+    """
+    Test that tool calls from one response run concurrently and keep their order.
+    """
+
+    # Neither call can finish unless both are running at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def _get_info(school):
+        barrier.wait()
+        return f'{school} info'
+
+    monkeypatch.setitem(agent.function_map, 'get_info', _get_info)
+
+    class _FakeCompletions:
+        def create(self, **kwargs):
+            return kwargs['messages']
+
+    class _FakeClient:
+        chat = type('chat', (), {'completions': _FakeCompletions()})()
+
+    response = ChatCompletion.model_validate({
+        'id': 'completion',
+        'created': 0,
+        'model': 'gpt-4o',
+        'object': 'chat.completion',
+        'choices': [{
+            'index': 0,
+            'finish_reason': 'tool_calls',
+            'message': {'role': 'assistant', 'content': None, 'tool_calls': [
+                {'id': f'call_{i}', 'type': 'function', 'function': {
+                    'name': 'get_info', 'arguments': json.dumps({'school': school})}}
+                for i, school in enumerate(['Albany', 'Buffalo'])
+            ]}
+        }]
+    })
+
+    a = agent.Agent(_FakeClient(), 'suny', None, 'You are a SUNY agent.', 'gpt-4o')
+    function_results, messages, tc_messages = a.handle_tool_call(response, chat_id=0)
+
+    assert function_results == ['Albany info', 'Buffalo info']
+    assert [x.role for x in tc_messages] == ['assistant', 'tool', 'assistant', 'tool']
+    assert [x['tool_call_id'] for x in messages if x['role'] == 'tool'] == ['call_0', 'call_1']
+    assert [x['name'] for x in a.tool_timings] == ['get_info', 'get_info']
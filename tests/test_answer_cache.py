@@ -0,0 +1,59 @@
+"""
+Unit tests for answer_cache.
+"""
+
+import time
+
+import numpy as np
+
+from src.answer_cache import SemanticCache
+
+
+def test_semantic_cache_lookup():
+    """
+    Test that similar questions about the same school hit and everything else misses.
+    """
+    cache = SemanticCache(maxsize=2, threshold=0.95)
+    cache.put(np.array([1.0, 0.0]), 'Buffalo State', 'tuition')
+
+    assert cache.get(np.array([0.99, 0.05]), 'Buffalo State') == 'tuition'
+    assert cache.get(np.array([0.0, 1.0]), 'Buffalo State') is None
+    assert cache.get(np.array([1.0, 0.0]), 'Binghamton') is None
+
+    # Least recently used entry is evicted
+    cache.put(np.array([0.0, 1.0]), 'Binghamton', 'accounting')
+    cache.get(np.array([1.0, 0.0]), 'Buffalo State')
+    cache.put(np.array([1.0, 1.0]), None, 'general')
+    assert cache.get(np.array([0.0, 1.0]), 'Binghamton') is None
+    assert cache.get(np.array([1.0, 0.0]), 'Buffalo State') == 'tuition'
+
+    cache.invalidate('Buffalo State')
+    assert len(cache) == 0
+
+    cache = SemanticCache(ttl=0.0)
+    cache.put(np.array([1.0, 0.0]), None, 'expired')
+    time.sleep(0.01)
+    assert cache.get(np.array([1.0, 0.0]), None) is None
+
+
+def test_semantic_cache_ingest_markers(sample_db):
+    """
+    Test that re-ingesting a university on another host drops the cached answers about it.
+    """
+    cache = SemanticCache(ingest_markers=sample_db.get_ingest_markers, check_interval=0.0)
+    cache.put(np.array([1.0, 0.0]), 'Buffalo State', 'tuition')
+    cache.put(np.array([0.0, 1.0]), 'Binghamton', 'accounting')
+    cache.put(np.array([1.0, 1.0]), None, 'general')
+    assert cache.get(np.array([1.0, 0.0]), 'Buffalo State') == 'tuition'
+
+    sample_db.record_ingest('Buffalo State')
+
+    assert cache.get(np.array([1.0, 0.0]), 'Buffalo State') is None
+    assert cache.get(np.array([1.0, 1.0]), None) is None
+    assert cache.get(np.array([0.0, 1.0]), 'Binghamton') == 'accounting'
+
+    # Markers are only loaded once per check_interval
+    cache.check_interval = 60.0
+    cache.put(np.array([1.0, 0.0]), 'Buffalo State', 'tuition')
+    sample_db.record_ingest('Buffalo State')
+    assert cache.get(np.array([1.0, 0.0]), 'Buffalo State') == 'tuition'
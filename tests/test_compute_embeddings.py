@@ -0,0 +1,131 @@
+"""
+Unit tests for the compute_embeddings script.
+"""
+
+import os
+import pickle
+
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts import compute_embeddings
+from src.database import embedding_store
+from tests.conftest import HashingEmbeddingModel
+from tests.test_embedding_store import _document
+
+
+class _FakeDB:
+    def __init__(self, doc_hashes: dict):
+        self.doc_hashes = doc_hashes
+        self.deleted = []
+
+    def get_existing_doc_hashes(self, university: str | None = None) -> dict:
+        return dict(self.doc_hashes)
+
+    def delete_documents(self, doc_ids: list[str]) -> None:
+        self.deleted.extend(doc_ids)
+
+
+class _FailingEmbeddingModel(HashingEmbeddingModel):
+    def embed_batch(self, texts, batch_size=64):
+        if any('bad embed' in x for x in texts):
+            raise RuntimeError('embedding server error')
+        return super().embed_batch(texts, batch_size)
+
+
+def _prepare_document(university_name: str, path: str) -> dict:
+    if 'bad_parse' in path:
+        raise ValueError('parser crashed')
+    words = path.replace('_', ' ')
+    payload = {'filepath': path, 'doc_id': path, 'university': university_name}
+    return {
+        'doc_id': path,
+        'content_hash': path,
+        'parent': {'payload': {**payload, 'content': f'{words} parent'}},
+        'chunks': [{'payload': {**payload, 'chunk_id': i, 'content': f'{words} chunk{i}'}} for i in range(3)]
+    }
+
+
+def test_run_pipeline(tmp_path):
+    """
+    Test that every file is written once with its vectors in chunk order, and that
+    files failing to parse, embed or write are reported without hanging the
+    pipeline or leaving partial documents in the store.
+    """
+    paths = [f'page{i}' for i in range(20)] + ['bad_parse', 'bad_embed', 'bad_write']
+    model = _FailingEmbeddingModel()
+    store = embedding_store.get_embedding_store(str(tmp_path), 'html', flush_size=4)
+
+    def write_fn(document):
+        if document['doc_id'] == 'bad_write':
+            raise OSError('disk full')
+        store.add_document(document)
+
+    with ThreadPoolExecutor(max_workers=4) as executor, ThreadPoolExecutor(max_workers=1) as runner:
+        with store:
+            future = runner.submit(
+                compute_embeddings.run_pipeline,
+                executor,
+                _prepare_document,
+                'albany',
+                paths,
+                model,
+                write_fn,
+                embed_workers=2,
+                embed_batch_size=1,
+                queue_size=2
+            )
+            failed = future.result(timeout=30)
+
+    assert sorted(failed) == ['bad_embed', 'bad_parse', 'bad_write']
+    assert not [x for x in os.listdir(store.path) if x.endswith('.tmp')]
+
+    store = embedding_store.get_embedding_store(str(tmp_path), 'html')
+    documents = {x['doc_id']: x for x in store.iter_documents()}
+    assert sorted(documents) == sorted(paths[:20])
+    for document in documents.values():
+        assert [x['payload']['chunk_id'] for x in document['chunks']] == [0, 1, 2]
+        for entry in [document['parent']] + document['chunks']:
+            assert (entry['vector'] == model.embed(entry['payload']['content'])).all()
+
+
+def test_delete_stale_documents():
+    """
+    Test that changed documents are deleted and that missing ones are only pruned
+    when asked to, and only inside the scanned scopes.
+    """
+    db = _FakeDB({
+        'albany/a.html': 'h1',
+        'albany/b.html': 'h2',
+        'albany/old.html': 'h3',
+        'albany/catalog.pdf': 'h4',
+        'buffalo/c.html': 'h5',
+        'albany/legacy.html': None
+    })
+    current = {'albany/a.html': 'h1', 'albany/b.html': 'new', 'albany/legacy.html': 'h6'}
+
+    existing = compute_embeddings.delete_stale_documents(db, 'albany', current)
+    assert db.deleted == ['albany/b.html', 'albany/legacy.html']
+    assert existing == {'albany/a.html', 'albany/old.html', 'albany/catalog.pdf', 'buffalo/c.html'}
+
+    db.deleted = []
+    existing = compute_embeddings.delete_stale_documents(db, 'albany', current, [('albany/', '.html')])
+    assert db.deleted == ['albany/b.html', 'albany/legacy.html', 'albany/old.html']
+    assert existing == {'albany/a.html', 'albany/catalog.pdf', 'buffalo/c.html'}
+
+
+def test_convert_legacy_embeddings(tmp_path):
+    """
+    Test that a legacy pickle is converted into an empty store once, as insert mode does before loading it.
+    """
+    data_dir = str(tmp_path)
+    documents = {x['doc_id']: x for x in (_document('a', 2, 0.0), _document('b', 1, 10.0))}
+    with open(tmp_path / 'pdf_embeddings.pkl', 'wb') as f:
+        pickle.dump({doc_id: {k: v for k, v in x.items() if k != 'doc_id'} for doc_id, x in documents.items()}, f)
+
+    store = embedding_store.get_embedding_store(data_dir, 'pdf')
+    compute_embeddings.convert_legacy_embeddings(store, data_dir, 'pdf')
+    compute_embeddings.convert_legacy_embeddings(store, data_dir, 'pdf')
+
+    store = embedding_store.get_embedding_store(data_dir, 'pdf')
+    assert [x['doc_id'] for x in store.iter_documents()] == ['a', 'b']
+    assert len(embedding_store.get_embedding_store(data_dir, 'html')) == 0
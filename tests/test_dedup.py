@@ -0,0 +1,98 @@
+"""
+Unit tests for dedup.
+"""
+
+import random
+
+from src import dedup
+
+MENU = 'Home\nAdmissions\nApply now'
+
+
+def _page(body: str) -> str:
+    return MENU + '\n' + body + '\nContact us: 607-587-4215'
+
+
+def _deduplicate(pages: dict, **kwargs) -> tuple[list, set[int], dict]:
+    fingerprints = {path: dedup.fingerprint_page(text) for path, text in pages.items()}
+    boilerplate = dedup.find_boilerplate_lines(list(fingerprints.values()), **kwargs)
+    simhashes = {path: dedup.page_simhash(text, boilerplate) for path, text in pages.items()}
+    kept, report = dedup.deduplicate_pages(fingerprints, simhashes, boilerplate)
+    return kept, boilerplate, report
+
+
+def test_simhash_near_duplicates():
+    """
+    Test that a small edit keeps SimHashes close while different text is far apart.
+    """
+    text = ' '.join(f'word{i}' for i in range(400))
+    edited = text.replace('word200', 'changed')
+    other = ' '.join(f'other{i}' for i in range(400))
+
+    assert dedup.hamming_distance(dedup.simhash(text), dedup.simhash(edited)) <= dedup.MAX_HAMMING_DISTANCE
+    assert dedup.hamming_distance(dedup.simhash(text), dedup.simhash(other)) > dedup.MAX_HAMMING_DISTANCE
+    assert dedup.find_near_duplicates([dedup.simhash(x) for x in [text, other, edited]]) == {2: 0}
+
+
+def test_deduplicate_pages():
+    """
+    Test that repeated lines are stripped, near-duplicate pages are dropped and both are reported.
+    """
+    pages = {
+        f'page{i}.html': _page(' '.join(f'topic{i} detail{j}' for j in range(100)))
+        for i in range(6)
+    }
+    # The same page without its contact block
+    pages['copy.html'] = pages['page3.html'].replace('\nContact us: 607-587-4215', '')
+
+    kept, boilerplate, report = _deduplicate(pages, min_pages=3)
+
+    assert kept == [f'page{i}.html' for i in range(6)]
+    assert report['duplicates'] == {'copy.html': 'page3.html'}
+    assert report['boilerplate_lines'] == 4
+    assert 0 < report['removed_fraction'] < 1
+
+    stripped = dedup.strip_boilerplate(pages['page0.html'], boilerplate)
+    assert stripped.startswith('topic0 detail0') and 'Apply now' not in stripped and 'Contact' not in stripped
+
+
+def test_deduplicate_template_pages():
+    """
+    Test that distinct pages sharing a large template aren't dropped as near-duplicates,
+    and that exact copies of a page don't turn its content into boilerplate.
+    """
+    rng = random.Random(0)
+    vocabulary = [f'word{i}' for i in range(2000)]
+    template = [' '.join(rng.sample(vocabulary, 20)) for _ in range(60)]
+
+    pages = {}
+    for i in range(40):
+        body = ' '.join(rng.sample(vocabulary, 20))
+        pages[f'page{i}.html'] = '\n'.join(template[:30] + [body] + template[30:])
+
+    kept, boilerplate, report = _deduplicate(pages)
+    assert kept == list(pages)
+    assert report['boilerplate_lines'] == 60
+
+    copies = {f'copy{i}.html': pages['page0.html'] for i in range(20)}
+    kept, copies_boilerplate, report = _deduplicate({**pages, **copies})
+    assert kept == list(pages)
+    assert copies_boilerplate == boilerplate
+
+
+def test_get_content_hash():
+    """
+    Test that a page's content hash only changes with the boilerplate lines stripped from it.
+    """
+    lines = dedup.get_line_hashes('Apply now\nCourse list\nContact us')
+    apply_now, course_list, _ = (x[0] for x in lines)
+    other_line = dedup.get_line_hashes('Visit campus')[0][0]
+
+    assert dedup.get_content_hash('abc', lines, set()) == 'abc'
+    assert dedup.get_content_hash('abc', lines, {other_line}) == 'abc'
+
+    content_hash = dedup.get_content_hash('abc', lines, {apply_now})
+    assert content_hash != 'abc'
+    assert dedup.get_content_hash('abc', lines, {apply_now, other_line}) == content_hash
+    assert dedup.get_content_hash('abc', lines, {apply_now, course_list}) != content_hash
+    assert dedup.get_content_hash('abd', lines, {apply_now}) != content_hash
@@ -0,0 +1,85 @@
+"""
+Unit tests for the embedding store.
+"""
+
+import numpy as np
+
+from src.database.embedding_store import EmbeddingStore
+
+
+def _document(doc_id: str, num_chunks: int, value: float) -> dict:
+    return {
+        'doc_id': doc_id,
+        'parent': {'vector': np.full(4, value), 'payload': {'doc_id': doc_id}},
+        'chunks': [
+            {'vector': np.full(4, value + i + 1), 'payload': {'doc_id': doc_id, 'chunk_id': i}}
+            for i in range(num_chunks)
+        ]
+    }
+
+
+def test_round_trip_and_resume(tmp_path):
+    """
+    Test that documents written across shards are read back in order after reopening.
+    """
+    path = str(tmp_path / 'html_embeddings')
+
+    with EmbeddingStore(path, flush_size=2) as store:
+        store.add_document(_document('a', 2, 0.0))
+        store.add_document(_document('b', 0, 10.0))
+        store.add_document(_document('c', 1, 20.0))
+
+    store = EmbeddingStore(path, flush_size=2)
+    assert len(store) == 3
+    assert 'c' in store
+    assert store.num_shards == 2
+
+    documents = list(store.iter_documents())
+    assert [x['doc_id'] for x in documents] == ['a', 'b', 'c']
+    assert documents[0]['chunks'][1]['payload']['chunk_id'] == 1
+    assert documents[0]['chunks'][1]['vector'].dtype == np.float32
+    assert np.allclose(documents[0]['chunks'][1]['vector'], 2.0)
+    assert np.allclose(documents[2]['parent']['vector'], 20.0)
+    assert np.allclose(documents[2]['chunks'][0]['vector'], 21.0)
+
+
+def test_partial_index_line_is_dropped(tmp_path):
+    """
+    Test that a document whose index line was cut off by a crash is not counted as stored.
+    """
+    path = str(tmp_path / 'pdf_embeddings')
+
+    with EmbeddingStore(path) as store:
+        store.add_document(_document('a', 1, 0.0))
+
+    with open(store.index_path, 'a') as f:
+        f.write('{"doc_id": "b", "sha')
+
+    store = EmbeddingStore(path)
+    assert len(store) == 1
+    assert 'b' not in store
+    assert [x['doc_id'] for x in store.iter_documents()] == ['a']
+
+
+def test_replace_and_remove_documents(tmp_path):
+    """
+    Test that the latest record for a doc_id wins and removed documents stay removed after reopening.
+    """
+    path = str(tmp_path / 'html_embeddings')
+
+    with EmbeddingStore(path, flush_size=2) as store:
+        store.add_document({**_document('a', 1, 0.0), 'content_hash': 'h1'})
+        store.add_document({**_document('b', 1, 10.0), 'content_hash': 'h2'})
+        store.add_document({**_document('a', 2, 30.0), 'content_hash': 'h3'})
+        store.remove_document('b')
+
+    store = EmbeddingStore(path)
+    assert len(store) == 1
+    assert 'b' not in store
+    assert store.content_hashes == {'a': 'h3'}
+    assert store.num_shards == 2
+
+    documents = list(store.iter_documents())
+    assert [(x['doc_id'], x['content_hash']) for x in documents] == [('a', 'h3')]
+    assert len(documents[0]['chunks']) == 2
+    assert np.allclose(documents[0]['parent']['vector'], 30.0)
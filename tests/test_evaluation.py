@@ -0,0 +1,44 @@
+"""
+Unit tests for evaluation.
+"""
+
+import json
+import asyncio
+
+from src import agent
+from src import evaluation as ev
+from src.agent import Message
+
+from scripts import run
+from tests.test_run_tools import _completion, _FakeAsyncClient
+
+
+def test_run_counselor_sessions(monkeypatch):
+    """
+    Test that counselor sessions run concurrently on one event loop and keep the order of the questions.
+    """
+    in_flight = []
+    max_in_flight = []
+
+    class _TrackingClient(_FakeAsyncClient):
+        async def create(self, **kwargs):
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.pop()
+            question = kwargs['messages'][-1]['content']
+            return _completion(json.dumps({'phase': 'discovery', 'recipient': 'student', 'message': f're: {question}'}))
+
+    monkeypatch.setattr(run, 'initialize_counselor_agent', lambda client, profile: agent.Agent(
+        None, 'counselor', None, 'counselor prompt', 'gpt-4o', async_client=_TrackingClient([])
+    ))
+    monkeypatch.setattr(run, 'initialize_suny_agent', lambda client: agent.Agent(
+        None, 'suny', None, 'suny prompt', 'gpt-4o', async_client=_TrackingClient([])
+    ))
+
+    prev_messages = [Message('counselor', 'student', 'assistant', 'Hi', chat_id=0)]
+    questions = [f'question {i}' for i in range(6)]
+    results = ev.run_counselor_sessions(questions, prev_messages, None, 'profile', 1.0, max_sessions=4)
+
+    assert [json.loads(x[-1].message)['message'] for x in results] == [f're: {q}' for q in questions]
+    assert max(max_in_flight) == 4
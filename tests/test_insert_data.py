@@ -0,0 +1,27 @@
+"""
+Unit tests for the insert_data script.
+"""
+
+from scripts import insert_data
+from tests.test_compute_embeddings import _FakeDB
+
+
+def test_delete_stale_documents_keeps_unreadable_files():
+    """
+    Test that documents whose files failed to convert are neither replaced nor pruned,
+    and that pruning stays inside the scanned directories and listed files.
+    """
+    db = _FakeDB({
+        'albany/pdfs/failed.pdf': 'h1',
+        'albany/pdfs/gone.pdf': 'h2',
+        'albany/pdfs/gone.html': 'h3',
+        'albany/catalog.pdf': 'h4',
+        'albany/other/gone.pdf': 'h5',
+        'albany/html/page.html': 'h6'
+    })
+    current = {'albany/pdfs/failed.pdf': None, 'albany/html/page.html': 'new'}
+    prune_scopes = [('albany/html/', '.html'), ('albany/pdfs/', '.pdf'), ('albany/catalog.pdf', '.pdf')]
+
+    existing = insert_data.delete_stale_documents(db, 'albany', current, prune_scopes)
+    assert db.deleted == ['albany/catalog.pdf', 'albany/html/page.html', 'albany/pdfs/gone.pdf']
+    assert existing == {'albany/pdfs/failed.pdf', 'albany/pdfs/gone.html', 'albany/other/gone.pdf'}
@@ -0,0 +1,137 @@
+"""
+Unit tests for pdf_extraction.
+"""
+
+import pymupdf
+
+from src import pdf_extraction, utils
+
+
+def _make_pdf(path: str, num_pages: int) -> str:
+    doc = pymupdf.open()
+    for i in range(num_pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f'Course catalogue page {i + 1}')
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def _make_scanned_pdf(path: str) -> str:
+    doc = pymupdf.open()
+    doc.new_page().insert_text((72, 72), 'Course catalogue page 1')
+    pixmap = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.IRect(0, 0, 64, 64), False)
+    pixmap.clear_with(200)
+    doc.new_page().insert_image(pymupdf.Rect(72, 72, 272, 272), pixmap=pixmap)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def test_extract_pdfs_caches_pages_and_isolates_failures(tmp_path):
+    """
+    Test that pages are cached by file hash and a file that can't be parsed only fails itself.
+    """
+    cache_path = str(tmp_path / 'pdf_cache.db')
+    good = _make_pdf(str(tmp_path / 'catalogue.pdf'), 20)
+    bad = str(tmp_path / 'broken.pdf')
+    with open(bad, 'w') as f:
+        f.write('not a pdf')
+
+    failed = pdf_extraction.extract_pdfs([good, bad], cache_path=cache_path, max_workers=2)
+    assert failed == [bad]
+
+    pages = pdf_extraction.load_pdf_pages(utils.get_file_hash(good), cache_path)
+    assert len(pages) == 20
+    assert pages[0].startswith('Course catalogue page 1\n')
+    assert pages[19].startswith('Course catalogue page 20\n')
+    assert pdf_extraction.load_pdf_pages(utils.get_file_hash(bad), cache_path) is None
+
+    # Cached files aren't converted again
+    assert pdf_extraction.extract_pdfs([good], cache_path=cache_path, timeout=0) == []
+
+
+def test_extract_isolated_timeout_keeps_partial_pages(tmp_path):
+    """
+    Test that a file over the timeout is killed and that cached pages are reused on the next run.
+    """
+    cache_path = str(tmp_path / 'pdf_cache.db')
+    path = _make_pdf(str(tmp_path / 'catalogue.pdf'), 3)
+    file_hash = utils.get_file_hash(path)
+
+    assert not pdf_extraction.extract_isolated(path, file_hash, cache_path, timeout=0)
+    assert pdf_extraction.load_pdf_pages(file_hash, cache_path) is None
+
+    with pdf_extraction.PDFPageCache(cache_path) as cache:
+        cache.put_pages(file_hash, {1: 'cached page'})
+
+    pdf_extraction.extract_to_cache(path, file_hash, cache_path, batch_size=1)
+    pages = pdf_extraction.load_pdf_pages(file_hash, cache_path)
+    assert pages[1] == 'cached page'
+    assert pages[2].startswith('Course catalogue page 3\n')
+
+
+def test_ocr_pdfs_fills_scanned_pages_once(tmp_path, monkeypatch):
+    """
+    Test that only pages without a text layer are OCRed, that the text is merged
+    into the page list and that OCRed pages aren't OCRed again.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache_path = str(tmp_path / 'pdf_cache.db')
+    path = _make_scanned_pdf(str(tmp_path / 'scanned.pdf'))
+    file_hash = utils.get_file_hash(path)
+
+    pdf_extraction.extract_to_cache(path, file_hash, cache_path)
+
+    ocr_calls = []
+    def parse_text_from_image(image, timeout=0):
+        ocr_calls.append(image.size)
+        return 'Scanned admissions page'
+    monkeypatch.setattr(pdf_extraction.pdf_tools, 'parse_text_from_image', parse_text_from_image)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        num_pages = pdf_extraction.ocr_pdfs([path], {path: file_hash}, cache_path, dpi=72, executor=executor)
+        assert num_pages == 1
+        assert pdf_extraction.ocr_pdfs([path], {path: file_hash}, cache_path, executor=executor) == 0
+
+    assert ocr_calls == [(595, 842)]
+    pages = pdf_extraction.load_pdf_pages(file_hash, cache_path)
+    assert pages[0].startswith('Course catalogue page 1\n')
+    assert pages[1] == 'Scanned admissions page'
+
+
+def test_ocr_pdfs_checks_old_files_and_retries_failed_pages(tmp_path, monkeypatch):
+    """
+    Test that a file converted before scanned pages were recorded is checked for
+    them, that a page whose OCR failed is retried and that the content hash only
+    changes once the page has OCR text.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache_path = str(tmp_path / 'pdf_cache.db')
+    path = _make_scanned_pdf(str(tmp_path / 'scanned.pdf'))
+    file_hash = utils.get_file_hash(path)
+
+    pdf_extraction.extract_to_cache(path, file_hash, cache_path)
+    with pdf_extraction.PDFPageCache(cache_path) as cache:
+        with cache.conn:
+            cache.conn.execute('DELETE FROM scanned_pages')
+            cache.conn.execute('DELETE FROM scan_checked')
+        assert cache.get_pages_to_ocr(file_hash) == []
+
+    def failing_ocr(image, timeout=0):
+        raise RuntimeError('tesseract timed out')
+    monkeypatch.setattr(pdf_extraction.pdf_tools, 'parse_text_from_image', failing_ocr)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert pdf_extraction.ocr_pdfs([path], {path: file_hash}, cache_path, dpi=72, executor=executor) == 0
+        assert pdf_extraction.get_content_hash(file_hash, cache_path) == file_hash
+
+        monkeypatch.setattr(pdf_extraction.pdf_tools, 'parse_text_from_image', lambda image, timeout=0: 'Scanned')
+        assert pdf_extraction.ocr_pdfs([path], {path: file_hash}, cache_path, dpi=72, executor=executor) == 1
+
+    content_hash = pdf_extraction.get_content_hash(file_hash, cache_path)
+    assert content_hash != file_hash
+    assert pdf_extraction.get_content_hashes([path], {path: file_hash}, cache_path) == {path: content_hash}
+    assert pdf_extraction.load_pdf_pages(file_hash, cache_path)[1] == 'Scanned'
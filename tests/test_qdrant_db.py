@@ -0,0 +1,132 @@
+"""
+Unit tests for qdrant_db using an in-memory Qdrant client.
+"""
+
+import numpy as np
+
+from qdrant_client import QdrantClient, models
+
+from src.database.qdrant_db import QdrantDB, get_point_id
+
+
+def _points(num_points: int, university: str):
+    for i in range(num_points):
+        yield i, np.random.rand(4), {'doc_id': f'doc_{i % 5}', 'university': university}
+
+
+def test_upload_points_and_existing_doc_ids():
+    """
+    Test that upload_points batches every point and get_existing_doc_ids pages through them.
+    """
+    db = QdrantDB(QdrantClient(':memory:'), 'suny', 4)
+
+    # The in-memory client isn't thread-safe, so only one request is kept in flight
+    num_uploaded = db.upload_points(_points(23, 'Alfred State College'), batch_size=5, max_in_flight=1)
+    assert num_uploaded == 23
+    assert db.client.count('suny').count == 23
+
+    doc_ids = db.get_existing_doc_ids('Alfred State College', page_size=4)
+    assert doc_ids == {f'doc_{i}' for i in range(5)}
+    assert db.get_existing_doc_ids('Binghamton University') == set()
+
+
+def test_upload_points_retries_failed_batch(monkeypatch):
+    """
+    Test that a batch that fails once is retried.
+    """
+    db = QdrantDB(QdrantClient(':memory:'), 'suny', 4)
+
+    add_batch = db.add_batch
+    failures = []
+
+    def flaky_add_batch(*args, **kwargs):
+        if not failures:
+            failures.append(1)
+            raise ConnectionError('dropped')
+        return add_batch(*args, **kwargs)
+
+    monkeypatch.setattr(db, 'add_batch', flaky_add_batch)
+    monkeypatch.setattr('src.database.qdrant_db.time.sleep', lambda x: None)
+
+    assert db.upload_points(_points(6, 'Alfred State College'), batch_size=3, max_in_flight=1) == 6
+    assert db.client.count('suny').count == 6
+
+
+def test_hybrid_query_finds_exact_terms():
+    """
+    Test that a hybrid query returns an exact course code match that dense
+    search alone misses.
+    """
+    db = QdrantDB(QdrantClient(':memory:'), 'suny', 2, hybrid=True)
+    assert db.hybrid
+
+    contents = ['Intro to programming is CSCI 140', 'Campus housing and dining', 'Tuition and fees']
+    vectors = [np.array([0.0, 1.0]), np.array([1.0, 0.0]), np.array([0.9, 0.1])]
+    db.upload_points(
+        ((i, vector, {'content': content}) for i, (vector, content) in enumerate(zip(vectors, contents))),
+        max_in_flight=1
+    )
+
+    query_vector = np.array([1.0, 0.0])
+    results = db.query('suny', query_vector, limit=2)
+    assert contents[0] not in [x.payload['content'] for x in results]
+
+    results = db.query('suny', query_vector, limit=2, query_text='What is CSCI 140?')
+    assert contents[0] in [x.payload['content'] for x in results]
+
+
+def test_query_returns_search_payload_fields():
+    """
+    Test that search results only carry the payload fields RAG uses.
+    """
+    db = QdrantDB(QdrantClient(':memory:'), 'suny', 2)
+    payload = {'content': 'Tuition', 'university': 'Buffalo State', 'url': None, 'doc_id': 'doc_0', 'type': 'html'}
+    db.upload_points([(0, np.array([1.0, 0.0]), payload)], max_in_flight=1)
+
+    result = db.query('suny', np.array([1.0, 0.0]))[0]
+    assert result.payload == {'content': 'Tuition', 'university': 'Buffalo State', 'url': None}
+
+
+def test_quantization_migrates_existing_collection(monkeypatch):
+    """
+    Test that asking for quantization on an existing collection updates it in place.
+    """
+    client = QdrantClient(':memory:')
+    db = QdrantDB(client, 'suny', 2)
+    assert db.search_params is None
+
+    updates = []
+    monkeypatch.setattr(client, 'update_collection', lambda **kwargs: updates.append(kwargs))
+
+    QdrantDB(client, 'suny', 2)
+    assert updates == []
+
+    QdrantDB(client, 'suny', 2, quantization='scalar', on_disk=True)
+    assert updates[0]['quantization_config'].scalar.type == models.ScalarType.INT8
+    assert updates[0]['vectors_config'][''].on_disk
+
+
+def test_doc_hashes_and_delete_documents():
+    """
+    Test that document hashes are read back and deleting a document removes all of its points.
+    """
+    db = QdrantDB(QdrantClient(':memory:'), 'suny', 4)
+
+    points = []
+    for doc_id, content_hash in [('a', 'h1'), ('b', 'h2'), ('c', None)]:
+        for chunk_id in [None, 0, 1]:
+            payload = {'doc_id': doc_id, 'university': 'Alfred State College'}
+            if content_hash is not None:
+                payload['content_hash'] = content_hash
+            points.append((get_point_id(doc_id, chunk_id), np.random.rand(4), payload))
+    db.upload_points(points, max_in_flight=1)
+
+    # Point IDs are stable across runs and unique per chunk
+    assert get_point_id('a', 0) == get_point_id('a', 0)
+    assert len({x[0] for x in points}) == 9
+
+    assert db.get_existing_doc_hashes('Alfred State College', page_size=2) == {'a': 'h1', 'b': 'h2', 'c': None}
+
+    db.delete_documents(['a', 'c'], batch_size=1)
+    assert db.get_existing_doc_ids() == {'b'}
+    assert db.client.count('suny').count == 3
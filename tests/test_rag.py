@@ -0,0 +1,231 @@
+"""
+Unit tests for rag.
+"""
+
+import time
+import threading
+
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+from src.rag import RAG
+from src.utils import LRUCache
+
+
+class _FakeReranker:
+    """Scores a pair by the length of the passage and records every call."""
+
+    def __init__(self):
+        self.calls = []
+
+    def compute_score(self, sentence_pairs, batch_size=256, normalize=False):
+        self.calls.append(list(sentence_pairs))
+        scores = [float(len(passage)) for _, passage in sentence_pairs]
+        return scores[0] if len(scores) == 1 else scores
+
+
+def _result(point_id: int, content: str):
+    return SimpleNamespace(id=point_id, payload={'content': content})
+
+
+def test_rerank_batched_and_cached():
+    """
+    Test that rerank scores all pairs in one call and reuses cached scores.
+    """
+    reranker = _FakeReranker()
+    rag = RAG(db=None, embedding_model=None, reranker=reranker, top_k=2, score_cache=LRUCache(16))
+
+    results = [_result(1, 'a'), _result(2, 'aaa'), _result(3, 'aa')]
+
+    reranked = rag.rerank('question', results)
+    assert [x.id for x in reranked] == [2, 3]
+    assert len(reranker.calls) == 1
+    assert len(reranker.calls[0]) == 3
+
+    # Same question again is served entirely from the cache
+    reranked = rag.rerank('question', results)
+    assert [x.id for x in reranked] == [2, 3]
+    assert len(reranker.calls) == 1
+
+    # Only the new candidate is scored for a repeated question
+    reranked = rag.rerank('question', results + [_result(4, 'aaaa')])
+    assert [x.id for x in reranked] == [4, 2]
+    assert reranker.calls[-1] == [['question', 'aaaa']]
+
+
+def test_lru_cache_eviction():
+    """
+    Test that the least recently used entry is evicted first.
+    """
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+class _FakeRecord(SimpleNamespace):
+    def dict(self):
+        return {'id': self.id, 'payload': self.payload}
+
+
+class _FakeDB:
+    """Serves parent documents and records every batch of requested IDs."""
+
+    def __init__(self, parents):
+        self.parents = parents
+        self.calls = []
+
+    def get_documents_by_ids(self, point_ids):
+        self.calls.append(list(point_ids))
+        return {x: self.parents[x] for x in point_ids if x in self.parents}
+
+
+def _chunk(point_id, parent_id, content_hash=None):
+    return _FakeRecord(id=point_id, payload={
+        'chunk_id': 0, 'parent_point_id': parent_id, 'content': 'chunk', 'content_hash': content_hash})
+
+
+def _parent(point_id, content, content_hash=None):
+    return _FakeRecord(id=point_id, payload={
+        'parent_point_id': point_id, 'university': 'Buffalo State', 'url': None, 'content': content,
+        'content_hash': content_hash})
+
+
+def test_format_documents_batches_parent_fetch():
+    """
+    Test that parents are fetched in one request and then served from the cache.
+    """
+    db = _FakeDB({'p1': _parent('p1', 'tuition'), 'p2': _parent('p2', 'housing')})
+    rag = RAG(db=db, embedding_model=None, parent_cache=LRUCache(16))
+
+    documents = [_chunk('c1', 'p1'), _chunk('c2', 'p2'), _chunk('c3', 'p1'), _parent('p3', 'dining')]
+    content = rag.format_documents(documents)
+    assert db.calls == [['p1', 'p2']]
+    assert [x.split('Content: ')[1] for x in content.strip().split('\n\n')] == ['tuition', 'housing', 'dining']
+
+    rag.format_documents(documents)
+    assert db.calls == [['p1', 'p2'], []]
+
+
+def test_format_documents_token_budget():
+    """
+    Test that the document overflowing the budget is truncated instead of dropped.
+    """
+    encoding = tiktoken.get_encoding('o200k_base')
+    documents = [_parent('p1', 'tuition ' * 50), _parent('p2', 'housing ' * 50), _parent('p3', 'dining')]
+
+    rag = RAG(db=_FakeDB({}), embedding_model=None, parent_cache=None, max_context_tokens=10000)
+    full_content = rag.format_documents(documents)
+    budget = len(encoding.encode(full_content)) - 40
+
+    rag.max_context_tokens = budget
+    content = rag.format_documents(documents)
+    assert len(encoding.encode(content)) <= budget
+    assert full_content.startswith(content)
+    assert 'housing' in content and 'dining' not in content
+
+
+def test_caches_miss_after_reingest():
+    """
+    Test that cached scores and parents aren't reused once a document's content hash changes.
+    """
+    reranker = _FakeReranker()
+    rag = RAG(db=None, embedding_model=None, reranker=reranker, top_k=1, score_cache=LRUCache(16))
+
+    old = SimpleNamespace(id=1, payload={'content': 'old tuition', 'content_hash': 'a'})
+    new = SimpleNamespace(id=1, payload={'content': 'new tuition', 'content_hash': 'b'})
+    rag.rerank('question', [old])
+    rag.rerank('question', [new])
+    assert reranker.calls == [[['question', 'old tuition']], [['question', 'new tuition']]]
+
+    db = _FakeDB({'p1': _parent('p1', 'old tuition', 'a')})
+    rag = RAG(db=db, embedding_model=None, parent_cache=LRUCache(16))
+    assert 'old tuition' in rag.format_documents([_chunk('c1', 'p1', 'a')])
+
+    db.parents['p1'] = _parent('p1', 'new tuition', 'b')
+    assert 'old tuition' in rag.format_documents([_chunk('c1', 'p1', 'a')])
+    assert 'new tuition' in rag.format_documents([_chunk('c1', 'p1', 'b')])
+    assert db.calls == [['p1'], [], ['p1']]
+
+
+class _OverlapReranker:
+    """Scores a pair by the number of query words in the passage."""
+
+    def compute_score(self, sentence_pairs, batch_size=256, normalize=False):
+        return [
+            float(len(set(query.lower().split()) & set(passage.lower().split())))
+            for query, passage in sentence_pairs
+        ]
+
+
+def test_run_on_sample_collection(sample_db, sample_embedding_model):
+    """
+    Test the whole pipeline against the embedded sample collection.
+    """
+    rag = RAG(
+        db=sample_db,
+        embedding_model=sample_embedding_model,
+        reranker=_OverlapReranker(),
+        top_n=10,
+        top_k=2,
+        score_cache=None,
+        parent_cache=None
+    )
+
+    content = rag.run('What is tuition per semester?', 'Buffalo State University')
+    assert content.startswith('University: Buffalo State University\nURL: https://suny.buffalostate.edu/tuition-and-fees')
+    assert 'Binghamton' not in content
+
+    # The course code is found by keyword even without a school filter
+    content = rag.run('CS 140', None)
+    assert 'CS 140 Programming with Objects' in content
+
+
+class _SingleThreadGuard:
+    """Fails when the wrapped function is entered by two threads at once."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        assert self.lock.acquire(blocking=False), 'called concurrently'
+        try:
+            time.sleep(0.005)
+            return self.fn(*args, **kwargs)
+        finally:
+            self.lock.release()
+
+
+def test_run_concurrently_on_sample_collection(sample_db, sample_embedding_model, monkeypatch):
+    """
+    Test that concurrent tool calls never use the reranker or the embedded client at the same time.
+    """
+    reranker = _OverlapReranker()
+    monkeypatch.setattr(reranker, 'compute_score', _SingleThreadGuard(reranker.compute_score))
+    local_client = sample_db.client._client
+    for name in ['query_points', 'search', 'retrieve']:
+        monkeypatch.setattr(local_client, name, _SingleThreadGuard(getattr(local_client, name)))
+
+    rag = RAG(
+        db=sample_db,
+        embedding_model=sample_embedding_model,
+        reranker=reranker,
+        top_n=10,
+        top_k=2,
+        score_cache=None,
+        parent_cache=None
+    )
+
+    questions = ['What is tuition per semester?', 'CS 140', 'housing', 'dining plans'] * 4
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        contents = list(executor.map(rag.run, questions))
+
+    assert 'CS 140 Programming with Objects' in contents[1]
+    assert contents[0] == contents[4]
@@ -0,0 +1,73 @@
+"""
+Unit tests for run_tools.
+"""
+
+import json
+import asyncio
+
+from openai.types.chat import ChatCompletion
+
+from src import agent, run_tools
+
+
+def _completion(content=None, tool_calls=None) -> ChatCompletion:
+    """Create a chat completion with a single choice."""
+    return ChatCompletion.model_validate({
+        'id': 'completion',
+        'created': 0,
+        'model': 'gpt-4o',
+        'object': 'chat.completion',
+        'choices': [{
+            'index': 0,
+            'finish_reason': 'tool_calls' if tool_calls else 'stop',
+            'message': {'role': 'assistant', 'content': content, 'tool_calls': tool_calls}
+        }]
+    })
+
+
+class _FakeAsyncClient:
+    """Returns the given responses in order, yielding to the event loop on each call."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.chat = self
+        self.completions = self
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(0.01)
+        return self.responses.pop(0)
+
+
+def test_aprocess_user_input(monkeypatch):
+    """
+    Test the async counselor -> suny -> tool -> suny round trip for concurrent sessions.
+    """
+    monkeypatch.setitem(agent.function_map, 'get_info', lambda school: f'{school} info')
+
+    def _session(school: str):
+        counselor = agent.Agent(None, 'counselor', None, 'counselor prompt', 'gpt-4o', async_client=_FakeAsyncClient([
+            _completion(json.dumps({'phase': 'discovery', 'recipient': 'suny', 'message': f'Tell me about {school}'}))
+        ]))
+        suny = agent.Agent(None, 'suny', None, 'suny prompt', 'gpt-4o', async_client=_FakeAsyncClient([
+            _completion(tool_calls=[{
+                'id': 'call_0',
+                'type': 'function',
+                'function': {'name': 'get_info', 'arguments': json.dumps({'school': school})}
+            }]),
+            _completion(f'{school} is great')
+        ]))
+        return counselor, suny
+
+    sessions = [_session('Albany'), _session('Buffalo')]
+
+    async def _run():
+        return await asyncio.gather(*[
+            run_tools.aprocess_user_input(counselor, suny, None, 'hello', chat_id=0)
+            for counselor, suny in sessions
+        ])
+
+    assert asyncio.run(_run()) == ['Albany is great', 'Buffalo is great']
+
+    counselor, suny = sessions[0]
+    assert json.loads(suny.messages[2].message)['result'] == 'Albany info'
+    assert json.loads(counselor.messages[-1].message)['message'] == 'Albany is great'
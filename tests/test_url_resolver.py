@@ -0,0 +1,114 @@
+"""
+Unit tests for url_resolver.
+"""
+
+from types import SimpleNamespace
+
+import requests
+
+from src import url_resolver
+from src.url_resolver import URLCache, get_local_url, resolve_urls
+
+UNIVERSITY = 'Alfred State College'
+ROOT = f'/data/suny/{UNIVERSITY}/www.alfredstate.edu/'
+
+
+class _FakeSession:
+    """Answers requests for a fixed set of URLs and records every request."""
+
+    def __init__(self, existing, head_allowed=True, fail=(), status_codes=None):
+        self.existing = set(existing)
+        self.head_allowed = head_allowed
+        self.fail = set(fail)
+        self.status_codes = status_codes or {}
+        self.requests = []
+
+    def _respond(self, method, url):
+        self.requests.append((method, url))
+        if url in self.fail:
+            raise requests.ConnectionError('dropped')
+        if method == 'HEAD' and not self.head_allowed:
+            return SimpleNamespace(status_code=405)
+        if url in self.status_codes:
+            codes = self.status_codes[url]
+            status_code = codes.pop(0) if len(codes) > 1 else codes[0]
+            return SimpleNamespace(status_code=status_code, headers={'Retry-After': '0'}, close=lambda: None)
+        return SimpleNamespace(status_code=200 if url in self.existing else 404, close=lambda: None)
+
+    def head(self, url, **kwargs):
+        return self._respond('HEAD', url)
+
+    def get(self, url, **kwargs):
+        return self._respond('GET', url)
+
+    def close(self):
+        pass
+
+
+def test_local_url_from_crawl_layout():
+    """
+    Test that URLs are derived from the wget layout without any requests.
+    """
+    assert get_local_url(UNIVERSITY, ROOT + 'index.html') == 'https://www.alfredstate.edu/'
+    assert get_local_url(UNIVERSITY, ROOT + 'admissions/index.html') == 'https://www.alfredstate.edu/admissions/'
+    assert get_local_url(UNIVERSITY, ROOT + 'tuition.html') == 'https://www.alfredstate.edu/tuition'
+    assert get_local_url(UNIVERSITY, ROOT + 'apply.cfm.html') == 'https://www.alfredstate.edu/apply.cfm'
+
+
+def test_resolve_urls_uses_cache(tmp_path, monkeypatch):
+    """
+    Test that resolved URLs are saved and served from the cache on the next run.
+    """
+    session = _FakeSession(['https://www.alfredstate.edu/tuition', 'https://www.alfredstate.edu/housing.html'])
+    monkeypatch.setattr(url_resolver, 'get_session', lambda max_connections: session)
+
+    files = [ROOT + 'tuition.html', ROOT + 'housing.html', ROOT + 'gone.html']
+    cache_path = str(tmp_path / 'url_cache.json')
+
+    urls = resolve_urls(UNIVERSITY, files, cache=URLCache(cache_path), max_workers=2)
+    assert urls == {
+        files[0]: 'https://www.alfredstate.edu/tuition',
+        files[1]: 'https://www.alfredstate.edu/housing.html',
+        files[2]: None
+    }
+    assert all(method == 'HEAD' for method, _ in session.requests)
+
+    session.requests.clear()
+    assert resolve_urls(UNIVERSITY, files, cache=URLCache(cache_path)) == urls
+    assert session.requests == []
+
+
+def test_resolve_url_falls_back_to_get_and_skips_caching_failures(tmp_path, monkeypatch):
+    """
+    Test that servers rejecting HEAD are checked with GET and that failed requests aren't cached.
+    """
+    session = _FakeSession(['https://www.alfredstate.edu/tuition'], head_allowed=False)
+    assert url_resolver.resolve_url(session, 'https://www.alfredstate.edu/tuition') == ('https://www.alfredstate.edu/tuition', True)
+    assert ('GET', 'https://www.alfredstate.edu/tuition') in session.requests
+
+    session = _FakeSession([], fail=['https://www.alfredstate.edu/housing'])
+    monkeypatch.setattr(url_resolver, 'get_session', lambda max_connections: session)
+
+    cache = URLCache(str(tmp_path / 'url_cache.json'))
+    assert resolve_urls(UNIVERSITY, [ROOT + 'housing.html'], cache=cache) == {ROOT + 'housing.html': None}
+    assert len(cache) == 0
+
+
+def test_resolve_url_backs_off_and_skips_caching_server_errors(monkeypatch):
+    """
+    Test that rate limited requests are retried and that 429 and 5xx answers aren't cached as missing pages.
+    """
+    monkeypatch.setattr(url_resolver.time, 'sleep', lambda seconds: None)
+
+    tuition = 'https://www.alfredstate.edu/tuition/'
+    session = _FakeSession([], status_codes={tuition: [429, 429, 200]})
+    assert url_resolver.resolve_url(session, 'https://www.alfredstate.edu/tuition') == (tuition, True)
+    assert session.requests.count(('HEAD', tuition)) == 3
+
+    for status_code in [429, 500, 503]:
+        housing = 'https://www.alfredstate.edu/housing/'
+        session = _FakeSession([], status_codes={housing: [status_code]})
+        assert url_resolver.resolve_url(session, 'https://www.alfredstate.edu/housing') == (None, False)
+
+    session = _FakeSession([])
+    assert url_resolver.resolve_url(session, 'https://www.alfredstate.edu/housing') == (None, True)
@@ -0,0 +1,131 @@
+"""
+Unit tests for utils.
+"""
+
+from tokenizers import Tokenizer
+from tokenizers.models import WordPiece
+from tokenizers.pre_tokenizers import BertPreTokenizer
+
+from src import utils
+
+
+def _split(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_stream_json_message():
+    """
+    Test that the message field is streamed only for the requested recipient.
+    """
+    response = '{"phase": "discovery", "recipient": "student", "message": "Hi \\"there\\"\\n\\u00e9!"}'
+    for size in [1, 2, 5, len(response)]:
+        assert ''.join(utils.stream_json_message(_split(response, size))) == 'Hi "there"\né!'
+
+    response = '{"phase": "discovery", "recipient": "suny", "message": "What are the dorms like?"}'
+    assert list(utils.stream_json_message(_split(response, 3))) == []
+
+
+def test_chunk_text():
+    """
+    Test that chunks keep their formatting and overlap by whole words.
+    """
+    chunks = utils.chunk_text(' one two  three\nfour five six ', chunk_size=3, overlap_size=1)
+    assert chunks == [' one two  three', 'three\nfour five', 'five six ']
+    assert utils.chunk_text('', chunk_size=3, overlap_size=1) == []
+
+
+def test_chunk_pages():
+    """
+    Test that chunks span pages and record their word offsets and pages.
+    """
+    chunks = utils.chunk_pages(['one two three ', 'four five\n', 'six seven eight nine'], chunk_size=4, overlap_size=1)
+    assert [x['text'] for x in chunks] == ['one two three four', ' four five\nsix seven', ' seven eight nine']
+    assert [x['metadata'] for x in chunks] == [
+        {'chunk_id': 0, 'start_word': 0, 'end_word': 3, 'word_count': 4, 'start_page': 1, 'end_page': 2},
+        {'chunk_id': 1, 'start_word': 3, 'end_word': 6, 'word_count': 4, 'start_page': 1, 'end_page': 3},
+        {'chunk_id': 2, 'start_word': 6, 'end_word': 8, 'word_count': 3, 'start_page': 3, 'end_page': 3}
+    ]
+
+
+def _wordpiece_tokenizer() -> Tokenizer:
+    vocab = ['[UNK]', 'the', 'cat', 'sat', '.', 'on', 'mat', '##s', 'dog', '#', 'Housing']
+    tokenizer = Tokenizer(WordPiece({x: i for i, x in enumerate(vocab)}, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = BertPreTokenizer()
+    return tokenizer
+
+
+def test_chunk_text_by_tokens():
+    """
+    Test that token chunks fit the budget, don't split words and end at sentences when possible.
+    """
+    tokenizer = _wordpiece_tokenizer()
+    text = 'the cats sat on the mat. the dog sat.\n# Housing the cat sat on the mats'
+
+    chunks = utils.chunk_text_by_tokens(text, tokenizer, chunk_size=6, overlap_size=2)
+    assert chunks == [
+        'the cats sat on the',
+        'on the mat.',
+        'mat. the dog sat.',
+        'sat.\n# Housing the cat',
+        'the cat sat on the',
+        'on the mats'
+    ]
+    assert all(len(tokenizer.encode(x).ids) <= 6 for x in chunks)
+
+    chunks = utils.chunk_pages_by_tokens(['the cats sat. ', 'the dog', '', '\nthe mat'], tokenizer, chunk_size=4, overlap_size=1)
+    assert [x['text'] for x in chunks] == ['the cats', 'sat. the dog', 'dog\nthe mat']
+    assert [(x['metadata']['start_page'], x['metadata']['end_page']) for x in chunks] == [(1, 1), (1, 2), (2, 4)]
+
+
+def test_extract_html(tmp_path):
+    """
+    Test that text and metadata come from one pass and boilerplate is left out.
+    """
+    path = tmp_path / 'tuition.html'
+    path.write_text(
+        '<html lang="en"><head><title>Tuition&nbsp;| Alfred</title>'
+        '<meta name="description" content=" Costs for 2024 ">'
+        '<style>body { color: red }</style><script>var x = 1;</script></head>'
+        '<body><nav><ul><li>Home</li></ul></nav><div role="navigation">Skip</div>'
+        '<h1>Tuition <em>and</em> Fees</h1><!-- hidden -->'
+        '<table><tr><td>In-state</td><td>$3,535</td></tr></table>'
+        '<p>Per semester.</p><h2>Housing</h2><footer>Copyright</footer></body></html>'
+    )
+
+    page = utils.extract_html(str(path))
+    assert page['text'] == 'Tuition\xa0| Alfred\nTuition and Fees\nIn-state\n$3,535\n\nPer semester.\nHousing'
+    assert page['title'] == 'Tuition | Alfred'
+    assert page['description'] == 'Costs for 2024'
+    assert page['headers'] == {'h1': ['Tuition and Fees'], 'h2': ['Housing']}
+    assert page['language'] == 'en'
+    assert utils.get_text_from_html(str(path)) == page['text']
+
+
+def test_extract_html_unclosed_navigation(tmp_path):
+    """
+    Test that a nav or footer left open doesn't hide the rest of the page.
+    """
+    path = tmp_path / 'index.html'
+    path.write_text('<nav><ul><li>Home<p>Main content here</p></body>')
+    assert utils.extract_html(str(path))['text'] == 'Main content here'
+
+    path.write_text(
+        '<html><body><div role="navigation"><a>Home</a><main><h1>Admissions</h1>'
+        '<nav><a>Apply</a></nav><p>Apply by May 1.</p></main>'
+        '<footer><p>Copyright</p></body></html>'
+    )
+    assert utils.extract_html(str(path))['text'] == 'Admissions\nApply by May 1.'
+
+
+def test_extract_html_closed_navigation_stays_skipped(tmp_path):
+    """
+    Test that headings and paragraphs inside a closed nav or footer don't end the skip.
+    """
+    path = tmp_path / 'index.html'
+    path.write_text(
+        '<html><body><nav><p>Quick Links</p><ul><li>Apply</li><li>Visit</li></ul></nav>'
+        '<main><h1>Admissions</h1><p>Apply by May 1.</p></main>'
+        '<footer><article><h1>News</h1></article><p>Copyright</p></footer></body></html>'
+    )
+    assert utils.extract_html(str(path))['text'] == 'Admissions\nApply by May 1.'
+    assert utils.extract_html(str(path), block_size=7)['text'] == 'Admissions\nApply by May 1.'